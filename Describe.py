@@ -9,9 +9,144 @@ The goal of this module is to provide a simpler, more robust module for
 describing data sets.
 """
 from __future__ import division, print_function
-import arcpy, os
-from ez.Stats import runningStats
+import arcpy, os, numpy
+from collections import OrderedDict
+from ez.Stats import runningStats, hyperLogLog, groupedStats, runningCovariance
 from ez.Python import OrderedSet
+from ez.Misc import chunkIterable, randomString
+from ez.Query import valuesToArray
+from ez.Table import ezTable
+
+## Process-wide cache of the schema (fields, indexes and dataType) of data sets.
+## See describeDataset for how entries are keyed and invalidated.
+_describeCache = {}
+_describeCacheCounters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def _catalogPath(inputOBJ):
+    ## Only absolute paths are cached, and they are used as is so that a lookup
+    ## needs no arcpy call.  Layers and table views are not cached: their fields
+    ## can differ from those of their source (joins, hidden fields), so they must
+    ## not share its entry.  Returns None for them (and for relative names).
+    if isinstance(inputOBJ, basestring) and os.path.isabs(inputOBJ):
+        return os.path.normcase(os.path.normpath(inputOBJ))
+    return None
+
+def _schemaStamp(catalogPath):
+    ## Returns a value that changes whenever the schema of the data set may have
+    ## changed, or None if that cannot be determined (in which case the data set
+    ## is never cached).  The value is the modification time of the file that
+    ## stores the schema; schema changes made by this package also clear the
+    ## entry explicitly (see clearDescribeCache).
+    storagePath = catalogPath
+    while os.path.exists(storagePath) == False:
+        parentPath = os.path.dirname(storagePath)
+        if parentPath == storagePath or parentPath == "":
+            return None
+        storagePath = parentPath
+
+    if storagePath.endswith(".gdb"):
+        ## File geodatabases store the definition of every data set in the
+        ## GDB_Items system table, which is always a00000004
+        stampFiles = [os.path.join(storagePath, "a00000004.gdbtable"),
+                      os.path.join(storagePath, "a00000004.gdbtablx")]
+    elif os.path.isfile(storagePath) and storagePath.endswith(".sde") == False:
+        ## Shapefiles, dBASE/CSV tables and personal geodatabases
+        stampFiles = [storagePath, os.path.splitext(storagePath)[0] + ".dbf"]
+    else:
+        return None
+
+    modifiedTimes = [os.path.getmtime(stampFile) for stampFile in stampFiles if os.path.exists(stampFile)]
+    if len(modifiedTimes) == 0:
+        return None
+
+    return max(modifiedTimes)
+
+def describeDataset(inputOBJ, item):
+    """Returns the fields, indexes or dataType of a data set from a cache.
+
+    Functions such as listFieldNames and getFieldObject are often called many
+    times on the same data set (e.g. once per field), and every call to
+    arcpy.ListFields [1], arcpy.ListIndexes [2] or arcpy.Describe [3] has to
+    go back to the data set.  This function keeps a process-wide cache of
+    those results keyed by the catalog path of the data set.
+
+    Only data sets given by an absolute path are cached.  An entry is
+    invalidated when the modification time of the file storing the schema of
+    the data set (the GDB_Items table of a file geodatabase or the files of a
+    shapefile/table) changes, and the functions of this package that alter a
+    schema clear the entry of the data set they alter.  Data sets whose schema
+    storage cannot be checked this way (in_memory workspaces, enterprise
+    geodatabases) are never cached, and neither are layers and table views,
+    whose fields may differ from those of their source.
+
+    Parameter Types:
+    inputOBJ    - String
+    item        - String ["FIELDS", "INDEXES" or "DATATYPE"]
+
+    References:
+    [1] http://pro.arcgis.com/en/pro-app/arcpy/functions/listfields.htm
+    [2] http://pro.arcgis.com/en/pro-app/arcpy/functions/listindexes.htm
+    [3] http://pro.arcgis.com/en/pro-app/arcpy/functions/describe.htm
+    """
+
+    item = item.upper()
+    if item not in ["FIELDS", "INDEXES", "DATATYPE"]:
+        raise ValueError("item must be 'FIELDS', 'INDEXES' or 'DATATYPE'")
+
+    catalogPath = _catalogPath(inputOBJ)
+    stamp = _schemaStamp(catalogPath) if catalogPath != None else None
+
+    entry = _describeCache.get(catalogPath)
+    if entry != None and entry["stamp"] != stamp:
+        del _describeCache[catalogPath]
+        _describeCacheCounters["invalidations"] += 1
+        entry = None
+
+    if entry != None and item in entry:
+        _describeCacheCounters["hits"] += 1
+        return entry[item]
+
+    _describeCacheCounters["misses"] += 1
+    if item == "FIELDS":
+        value = arcpy.ListFields(inputOBJ)
+    elif item == "INDEXES":
+        value = arcpy.ListIndexes(inputOBJ)
+    elif item == "DATATYPE":
+        value = arcpy.Describe(inputOBJ).dataType
+
+    if stamp != None:
+        if entry == None:
+            entry = _describeCache[catalogPath] = {"stamp": stamp}
+        entry[item] = value
+
+    return value
+
+def clearDescribeCache(inputOBJ = None):
+    """Removes a data set (or every data set) from the describe cache.
+
+    Parameter Types:
+    inputOBJ    - String
+
+    Default Parameters:
+    inputOBJ = None
+        The entire cache is cleared when no data set is specified.
+    """
+
+    if inputOBJ == None:
+        _describeCache.clear()
+    else:
+        catalogPath = _catalogPath(inputOBJ)
+        if catalogPath == None:
+            ## A layer, table view or relative name alters its source data set
+            catalogPath = os.path.normcase(os.path.normpath(arcpy.Describe(inputOBJ).catalogPath))
+        _describeCache.pop(catalogPath, None)
+
+def describeCacheInfo():
+    """Returns the hit, miss and invalidation counts and size of the describe cache."""
+
+    info = dict(_describeCacheCounters)
+    info["size"] = len(_describeCache)
+    return info
 
 def countFeatures(inputOBJ):
     """Returns the count of rows in the specified data set.
@@ -55,7 +190,7 @@ def listFieldNames(inputOBJ, includeSystemFields = False, types = []):
     [2] http://pro.arcgis.com/en/pro-app/arcpy/classes/field.htm
     """
     
-    fieldObjects = arcpy.ListFields(inputOBJ)
+    fieldObjects = describeDataset(inputOBJ, "FIELDS")
     fieldNames = []
 
     for fieldObject in fieldObjects:
@@ -93,7 +228,33 @@ def getFieldObject(inputOBJ, fieldName):
     [1] http://pro.arcgis.com/en/pro-app/arcpy/classes/field.htm
     """
     
-    return arcpy.ListFields(inputOBJ, fieldName)[0]
+    for fieldObject in describeDataset(inputOBJ, "FIELDS"):
+        if fieldObject.name.upper() == fieldName.upper():
+            return fieldObject
+
+    raise ValueError("%s does not have a field named %s" % (inputOBJ, fieldName))
+
+def fieldTypeKeyword(fieldObject):
+    """Returns the Add Field type keyword [1] of an arcpy Field object [2].
+
+    The type property of a Field object (e.g. "String" or "SmallInteger")
+    is not the keyword that AddField_management expects (e.g. "TEXT" or
+    "SHORT").  This function translates it, so that fields of one data set
+    can be recreated in another.  ObjectID fields become "LONG" and any
+    other type (such as "Geometry" or "Raster") becomes "TEXT".
+
+    Parameter Types:
+    fieldObject - arcpy Field object
+
+    References:
+    [1] http://pro.arcgis.com/en/pro-app/tool-reference/data-management/add-field.htm
+    [2] http://pro.arcgis.com/en/pro-app/arcpy/classes/field.htm
+    """
+
+    fieldTypes = {"String": "TEXT", "Integer": "LONG", "SmallInteger": "SHORT", "Double": "DOUBLE",
+                  "Single": "FLOAT", "Date": "DATE", "OID": "LONG", "GUID": "GUID",
+                  "GlobalID": "GUID", "Blob": "BLOB"}
+    return fieldTypes.get(fieldObject.type, "TEXT")
 
 def hasSpatialIndex(inputFC):
     """Determines if the specified feature class has a spatial index.
@@ -129,16 +290,16 @@ def hasSpatialIndex(inputFC):
     
     foundSpatialIndex = False
 
-    desc = arcpy.Describe(statesSHP)
+    dataType = describeDataset(inputFC, "DATATYPE")
 
-    if desc.dataType == "FeatureClass":
-        indexes = arcpy.ListIndexes(inputFC)
+    if dataType == "FeatureClass":
+        indexes = describeDataset(inputFC, "INDEXES")
         for index in indexes:
             if index.name in ["FDO_Shape", "Shape_Index"]:
                 foundSpatialIndex = True
 
-    elif desc.dataType == "ShapeFile":
-         spatialIndexFile = "%s.sbn" % desc.catalogPath[:-4]
+    elif dataType == "ShapeFile":
+         spatialIndexFile = "%s.sbn" % arcpy.Describe(inputFC).catalogPath[:-4]
          if os.path.exists(spatialIndexFile) == True:
              foundSpatialIndex = True
 
@@ -175,7 +336,7 @@ def hasAttributeIndex(inputOBJ,
     
     foundAttributeIndex = False
     
-    indexes = arcpy.ListIndexes(inputOBJ)
+    indexes = describeDataset(inputOBJ, "INDEXES")
     for index in indexes:
         if fieldName <> None:
             indexFields = index.fields
@@ -213,8 +374,121 @@ def fieldToNumPyArray(inputOBJ, fieldName,
 
     return arcpy.da.FeatureClassToNumPyArray(inputOBJ, (fieldName, ), skip_nulls = skipNULLs)[fieldName]
 
+def oidRange(inputOBJ):
+    """ Returns the minimum and maximum ObjectID of the specified data set.
+
+    The ObjectIDs of a data set are not guaranteed to be contiguous, but every
+    row lies between the minimum and maximum ObjectID.  This makes the ObjectID
+    range a convenient way to split a data set into windows that can each be
+    read with a where clause.  The range is calculated with the Summary
+    Statistics tool [1] so that the ObjectIDs never have to be loaded into memory.
+    (None, None) is returned when the data set is empty.
+
+    Parameter Types:
+    inputOBJ    - String
+
+    References:
+    [1] http://pro.arcgis.com/en/pro-app/tool-reference/analysis/summary-statistics.htm
+    """
+
+    oidFieldName = arcpy.Describe(inputOBJ).OIDFieldName
+    statisticsTable = os.path.join("in_memory", randomString())
+
+    arcpy.Statistics_analysis(inputOBJ, statisticsTable, [[oidFieldName, "MIN"], [oidFieldName, "MAX"]])
+    with arcpy.da.SearchCursor(statisticsTable, ["MIN_%s" % oidFieldName, "MAX_%s" % oidFieldName]) as cursor:
+        minOID, maxOID = next(cursor)
+    arcpy.Delete_management(statisticsTable)
+
+    if minOID == None or maxOID == None:
+        return None, None
+
+    return int(minOID), int(maxOID)
+
+def fieldToNumPyArrayChunks(inputOBJ, fieldName,
+                            chunkSize = 500000, skipNULLs = True):
+    """ Yields a single column of a data set as a series of NumPy arrays.
+
+    fieldToNumPyArray loads an entire column into memory at once, which can
+    result in Out Of Memory errors on very large data sets.  This generator
+    instead splits the data set into windows of chunkSize ObjectIDs and
+    converts each window to a 1-dimensional NumPy array with
+    arcpy.da.FeatureClassToNumPyArray [1] using an ObjectID where clause.
+    Only one window is held in memory at a time, so each block can be reduced
+    with NumPy and then discarded.
+
+    Because ObjectIDs may have gaps, a block can contain fewer than chunkSize
+    values (or none at all, in which case it is not yielded).
+
+    Parameter Types:
+    inputOBJ    - String
+    fieldName   - String
+    chunkSize   - Integer
+    skipNULLs   - Boolean
+
+    Default Parameters:
+    chunkSize = 500000
+        The number of ObjectIDs covered by each window.
+    skipNULLs = True
+        Null values will not be returned in the NumPy arrays
+
+    References:
+    [1] http://desktop.arcgis.com/en/arcmap/10.3/analyze/arcpy-data-access/featureclasstonumpyarray.htm
+    """
+
+    minOID, maxOID = oidRange(inputOBJ)
+    if minOID == None:
+        return
+
+    oidFieldName = arcpy.AddFieldDelimiters(inputOBJ, arcpy.Describe(inputOBJ).OIDFieldName)
+
+    for windowStart in range(minOID, maxOID + 1, chunkSize):
+        query = "%s >= %s AND %s < %s" % (oidFieldName, windowStart, oidFieldName, windowStart + chunkSize)
+        array = arcpy.da.FeatureClassToNumPyArray(inputOBJ, (fieldName, ), where_clause = query,
+                                                  skip_nulls = skipNULLs)[fieldName]
+        if len(array) > 0:
+            yield array
+
+def cursorChunks(inputOBJ, fieldNames,
+                 chunkSize = 500000, query = None, spatialReference = None):
+    """ Yields the specified fields of a data set as chunks of NumPy arrays.
+
+    Unlike fieldToNumPyArrayChunks, this generator reads the data set in a
+    single arcpy.da.SearchCursor [1] pass and keeps NULL values, which makes
+    it suitable for reading several fields of mixed types at once.  Each chunk
+    is a dictionary keyed by the upper case field name.  Numeric fields are
+    float64 arrays with NULLs as NaN, all other fields are object arrays with
+    NULLs as None (see valuesToArray in ez.Query).
+
+    Parameter Types:
+    inputOBJ    - String
+    fieldNames          - List of Strings
+    chunkSize           - Integer
+    query               - String
+    spatialReference    - arcpy.SpatialReference
+
+    Default Parameters:
+    chunkSize = 500000
+        The number of rows in each chunk.
+    query = None
+        An optional where clause limiting the rows that are read.
+    spatialReference = None
+        Geometry tokens (SHAPE@XY, SHAPE@, ...) are returned in the spatial
+        reference of the data set unless another one is specified.
+
+    References:
+    [1] http://desktop.arcgis.com/en/arcmap/latest/analyze/arcpy-data-access/searchcursor-class.htm
+    """
+
+    with arcpy.da.SearchCursor(inputOBJ, fieldNames, query, spatialReference) as cursor:
+        for chunk in chunkIterable(cursor, chunkSize):
+            rows = list(chunk)
+            columns = {}
+            for i in range(len(fieldNames)):
+                columns[fieldNames[i].upper()] = valuesToArray([row[i] for row in rows])
+            yield columns
+
 def fieldMax(inputOBJ, fieldName,
-             method = "NUMPY"):
+             method = "NUMPY", chunkSize = 500000):
     """ Returns the maximum value of a field within the specified data set.
 
     Determining the maximum of a column in a data set is a very common task.
@@ -242,17 +516,29 @@ def fieldMax(inputOBJ, fieldName,
         Disadvantages:
             Even though this function uses the quicker arcpy.da.SearchCursor [3],
             iterating with Python is not as quick as NumPy's C programming.
+    method = "CHUNKED"
+        This methodology streams the field as a series of NumPy arrays (see
+        fieldToNumPyArrayChunks), finds the maximum of each block with NumPy and
+        keeps the running maximum of the blocks.
+        Advantages of this methodology:
+            NumPy speed with a memory footprint limited by chunkSize.
+        Disadvantages:
+            Each block is a separate query of the data set, which adds some
+            overhead on small data sets.
 
     Parameter Types:
     inputOBJ    - String
     fieldName   - String
-    method      - String ["NUMPY" or "CURSOR"]
+    method      - String ["NUMPY", "CURSOR" or "CHUNKED"]
+    chunkSize   - Integer
 
     Default Parameters:
     method = "NUMPY"
         Except with very large datasets that would use lots of memory, creating
         a NumPy array from the field and using numpy to calculate the maximum value
         is probably the quickest method and therefore used as the default
+    chunkSize = 500000
+        The number of ObjectIDs read per block when method = "CHUNKED"
 
     References:
     [1] http://gis.stackexchange.com/a/101462
@@ -276,13 +562,20 @@ def fieldMax(inputOBJ, fieldName,
         maxValue = array.max()
         del array
 
+    elif method.upper() == "CHUNKED":
+        maxValue = None
+        for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+            chunkMax = array.max()
+            if maxValue == None or chunkMax > maxValue:
+                maxValue = chunkMax
+
     else:
-        raise ValueError("method must be 'CURSOR' or 'NUMPY'")
+        raise ValueError("method must be 'CURSOR', 'NUMPY' or 'CHUNKED'")
 
     return maxValue
 
 def fieldMin(inputOBJ, fieldName,
-             method = "NUMPY"):
+             method = "NUMPY", chunkSize = 500000):
     """ Returns the minimum value of a field within the specified data set.
 
     Determining the minimum of a column in a data set is a very common task.
@@ -310,17 +603,29 @@ def fieldMin(inputOBJ, fieldName,
         Disadvantages:
             Even though this function uses the quicker arcpy.da.SearchCursor [3],
             iterating with Python is not as quick as NumPy's C programming.
+    method = "CHUNKED"
+        This methodology streams the field as a series of NumPy arrays (see
+        fieldToNumPyArrayChunks), finds the minimum of each block with NumPy and
+        keeps the running minimum of the blocks.
+        Advantages of this methodology:
+            NumPy speed with a memory footprint limited by chunkSize.
+        Disadvantages:
+            Each block is a separate query of the data set, which adds some
+            overhead on small data sets.
 
     Parameter Types:
     inputOBJ    - String
     fieldName   - String
-    method      - String ["NUMPY" or "CURSOR"]
+    method      - String ["NUMPY", "CURSOR" or "CHUNKED"]
+    chunkSize   - Integer
 
     Default Parameters:
     method = "NUMPY"
         Except with very large datasets that would use lots of memory, creating
         a NumPy array from the field and using numpy to calculate the minimum value
         is probably the quickest method and therefore used as the default
+    chunkSize = 500000
+        The number of ObjectIDs read per block when method = "CHUNKED"
 
     References:
     [1] http://gis.stackexchange.com/a/101462
@@ -330,7 +635,7 @@ def fieldMin(inputOBJ, fieldName,
 
     if method.upper() == "CURSOR":
         minValue = None
-        cursor = arcpy.da.SearchCursor(table, fieldName)
+        cursor = arcpy.da.SearchCursor(inputOBJ, fieldName)
         for row in cursor:
             if minValue == None:
                 minValue = row[0]
@@ -344,13 +649,20 @@ def fieldMin(inputOBJ, fieldName,
         minValue = array.min()
         del array
 
+    elif method.upper() == "CHUNKED":
+        minValue = None
+        for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+            chunkMin = array.min()
+            if minValue == None or chunkMin < minValue:
+                minValue = chunkMin
+
     else:
-        raise ValueError("method must be 'CURSOR' or 'NUMPY'")
+        raise ValueError("method must be 'CURSOR', 'NUMPY' or 'CHUNKED'")
 
     return minValue
 
 def fieldMean(inputOBJ, fieldName,
-              method = "NUMPY"):
+              method = "NUMPY", chunkSize = 500000):
     if method.upper() == "NUMPY":
         return fieldToNumPyArray(inputOBJ, fieldName).mean()
     
@@ -358,7 +670,7 @@ def fieldMean(inputOBJ, fieldName,
         valuesCount = 0
         valuesSum   = 0
         
-        cursor = arcpy.da.SearchCursor(table, fieldName)
+        cursor = arcpy.da.SearchCursor(inputOBJ, fieldName)
         for row in cursor:
             if row[0] != None:
                 valuesCount += 1
@@ -367,45 +679,465 @@ def fieldMean(inputOBJ, fieldName,
         
         return valuesSum / valuesCount
 
+    elif method.upper() == "CHUNKED":
+        valuesCount = 0
+        valuesSum   = 0
+
+        for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+            valuesCount += len(array)
+            valuesSum   += array.sum(dtype = numpy.float64)
+
+        ## Empty or all NULL
+        if valuesCount == 0:
+            return None
+        return valuesSum / valuesCount
+
     else:
-        raise ValueError("method must be 'CURSOR' or 'NUMPY'")
+        raise ValueError("method must be 'CURSOR', 'NUMPY' or 'CHUNKED'")
 
 def fieldStdDev(inputOBJ, fieldName,
-              method = "NUMPY"):
+              method = "NUMPY", chunkSize = 500000):
     if method.upper() == "NUMPY":
         return fieldToNumPyArray(inputOBJ, fieldName).std()
     elif method.upper() == "CURSOR":
         stats = runningStats()
         
-        cursor = arcpy.da.SearchCursor(table, fieldName)
+        cursor = arcpy.da.SearchCursor(inputOBJ, fieldName)
         for row in cursor:
             if row[0] != None:
-                stats.add(row[0])
+                stats.push(row[0])
         del cursor
 
         return stats.stdDev()
+    elif method.upper() == "CHUNKED":
+        ## Population standard deviation, the same as the "NUMPY" method
+        stats = runningStats()
+        for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+            stats.pushMany(array)
+        ## Empty or all NULL
+        if stats.n == 0:
+            return None
+        return stats.stdDev(ddof = 0)
     else:
-        raise ValueError("method must be 'CURSOR' or 'NUMPY'")
+        raise ValueError("method must be 'CURSOR', 'NUMPY' or 'CHUNKED'")
 
 def fieldSum(inputOBJ, fieldName,
-              method = "NUMPY"):
+              method = "NUMPY", chunkSize = 500000):
     if method.upper() == "NUMPY":
         return fieldToNumPyArray(inputOBJ, fieldName).sum()
     elif method.upper() == "CURSOR":
         valuesSum = 0
         
-        cursor = arcpy.da.SearchCursor(table, fieldName)
+        cursor = arcpy.da.SearchCursor(inputOBJ, fieldName)
         for row in cursor:
             if row[0] != None:
                 valuesSum += row[0]
         del cursor
         
-        return valuesSum / valuesCount
+        return valuesSum
+    elif method.upper() == "CHUNKED":
+        ## Accumulated in float64 like fieldMean, rather than in the dtype of
+        ## the field (e.g. float32 for Single fields)
+        valuesSum = 0
+        for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+            valuesSum += array.sum(dtype = numpy.float64)
+        return valuesSum
     else:
-        raise ValueError("method must be 'CURSOR' or 'NUMPY'")
+        raise ValueError("method must be 'CURSOR', 'NUMPY' or 'CHUNKED'")
+
+def fieldSummary(inputOBJ, fields,
+                 stats = ["MIN", "MAX", "MEAN", "STD", "SUM", "COUNT", "NULLS"],
+                 chunkSize = 500000):
+    """Returns summary statistics for several fields in a single pass.
+
+    Calling fieldMax, fieldMin, fieldMean, fieldStdDev and fieldSum for every
+    field of a wide table scans the data set once per field per statistic.
+    This function reads all of the requested fields with one
+    arcpy.da.SearchCursor [1], converts each chunk of rows into a NumPy array
+    and pushes each column of the chunk into a runningStats object (see
+    ez.Stats), which reduces it with NumPy and merges it into the running
+    moments with the parallel variance algorithm [2].  Memory use therefore
+    depends on chunkSize and not on the size of the data set.
+
+    The output is an OrderedDict keyed by field name (in the order given)
+    whose values are dictionaries keyed by statistic name:
+    "MIN"   - The minimum non-NULL value
+    "MAX"   - The maximum non-NULL value
+    "MEAN"  - The mean of the non-NULL values
+    "STD"   - The population standard deviation of the non-NULL values
+              (the same as the default "NUMPY" method of fieldStdDev)
+    "SKEW"  - The skewness of the non-NULL values (not returned by default)
+    "KURTOSIS" - The excess kurtosis of the non-NULL values (not returned by default)
+    "SUM"   - The sum of the non-NULL values
+    "COUNT" - The number of non-NULL values
+    "NULLS" - The number of NULL values
+    MIN, MAX, MEAN, STD, SKEW and KURTOSIS are None for a field without any
+    non-NULL values.
+
+    Parameter Types:
+    inputOBJ    - String
+    fields      - String or List of Strings (numeric fields only)
+    stats       - List of Strings
+    chunkSize   - Integer
+
+    Default Parameters:
+    stats = ["MIN", "MAX", "MEAN", "STD", "SUM", "COUNT", "NULLS"]
+        All of the available statistics are returned by default.
+    chunkSize = 500000
+        The number of rows converted to a NumPy array at a time.
+
+    References:
+    [1] http://desktop.arcgis.com/en/arcmap/latest/analyze/arcpy-data-access/searchcursor-class.htm
+    [2] https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    """
+
+    if type(fields) == str:
+        fields = [fields]
+    stats = [stat.upper() for stat in stats]
+    for stat in stats:
+        if stat not in ["MIN", "MAX", "MEAN", "STD", "SKEW", "KURTOSIS", "SUM", "COUNT", "NULLS"]:
+            raise ValueError("stats must only contain 'MIN', 'MAX', 'MEAN', 'STD', 'SKEW', 'KURTOSIS', 'SUM', 'COUNT' or 'NULLS'")
+
+    fieldStats  = [runningStats() for field in fields]
+    nulls       = [0] * len(fields)
+
+    with arcpy.da.SearchCursor(inputOBJ, fields) as cursor:
+        for chunk in chunkIterable(cursor, chunkSize):
+            ## NULL values become NaN when converted to a float array
+            block = numpy.array(list(chunk), dtype = numpy.float64).reshape(-1, len(fields))
+            for i in range(len(fields)):
+                nulls[i] += int(numpy.isnan(block[:, i]).sum())
+                fieldStats[i].pushMany(block[:, i])
+
+    summary = OrderedDict()
+    for i in range(len(fields)):
+        values = {}
+        hasValues = fieldStats[i].n > 0
+        for stat in stats:
+            if stat == "MIN":
+                values[stat] = fieldStats[i].minimum()
+            elif stat == "MAX":
+                values[stat] = fieldStats[i].maximum()
+            elif stat == "MEAN":
+                values[stat] = fieldStats[i].mean() if hasValues else None
+            elif stat == "STD":
+                values[stat] = fieldStats[i].stdDev(ddof = 0) if hasValues else None
+            elif stat == "SKEW":
+                values[stat] = fieldStats[i].skewness() if hasValues else None
+            elif stat == "KURTOSIS":
+                values[stat] = fieldStats[i].kurtosis() if hasValues else None
+            elif stat == "SUM":
+                values[stat] = fieldStats[i].sum()
+            elif stat == "COUNT":
+                values[stat] = fieldStats[i].n
+            elif stat == "NULLS":
+                values[stat] = nulls[i]
+        summary[fields[i]] = values
+
+    return summary
+
+def fieldGroupStats(inputOBJ, groupField, valueFields,
+                    stats = ["COUNT", "SUM", "MEAN", "MIN", "MAX"],
+                    outputTable = None, display = False, chunkSize = 500000):
+    """Returns statistics of value fields for every distinct value of a group field.
+
+    This is the equivalent of the Summary Statistics tool [1] with a case
+    field, or of one fieldSum call per group, in a single pass over the data.
+    The group field and the value fields are read with a SearchCursor, and each
+    chunk of rows is pushed into a groupedStats object (see ez.Stats), which
+    factorizes the group keys of the chunk into integer IDs once and computes
+    every statistic of every group with numpy.bincount and
+    numpy.minimum/maximum.reduceat [2].  Memory use depends on chunkSize and
+    the number of groups, not on the size of the data set.
+
+    The output is a tuple of (rows, columnHeaders), sorted by the group
+    value with the NULL group (None) last, so that it can be passed directly
+    to ezTable (i.e. ezTable(*fieldGroupStats(...))).  Like the Summary
+    Statistics tool, the columns are the group field, FREQUENCY (the number of
+    rows in the group) and then "<STAT>_<valueField>" for every value field
+    and statistic:
+    "COUNT" - The number of non-NULL values
+    "SUM"   - The sum of the non-NULL values
+    "MEAN"  - The mean of the non-NULL values
+    "MIN"   - The minimum non-NULL value
+    "MAX"   - The maximum non-NULL value
+    "STD"   - The population standard deviation of the non-NULL values
+    MEAN, MIN, MAX and STD are None for a group without any non-NULL values.
+
+    Parameter Types:
+    inputOBJ    - String
+    groupField  - String
+    valueFields - String or List of Strings (numeric fields only)
+    stats       - List of Strings
+    outputTable - String
+    display     - Boolean
+    chunkSize   - Integer
+
+    Default Parameters:
+    stats = ["COUNT", "SUM", "MEAN", "MIN", "MAX"]
+    outputTable = None
+        If specified, the results are also written to a new table, with the
+        group field having the same type as in inputOBJ.
+    display = False
+        If True, the results are also printed with ezTable.
+    chunkSize = 500000
+        The number of rows in each chunk.
+
+    References:
+    [1] http://desktop.arcgis.com/en/arcmap/latest/tools/analysis-toolbox/summary-statistics.htm
+    [2] https://docs.scipy.org/doc/numpy/reference/generated/numpy.bincount.html
+    """
+
+    if type(valueFields) == str:
+        valueFields = [valueFields]
+    stats = [stat.upper() for stat in stats]
+    for stat in stats:
+        if stat not in ["COUNT", "SUM", "MEAN", "MIN", "MAX", "STD"]:
+            raise ValueError("stats must only contain 'COUNT', 'SUM', 'MEAN', 'MIN', 'MAX' or 'STD'")
+
+    ## The group keys are kept as the cursor returns them (rather than with
+    ## valuesToArray, which turns numbers into float64), so that integer
+    ## groups stay integers
+    groups = groupedStats(len(valueFields))
+    with arcpy.da.SearchCursor(inputOBJ, [groupField] + valueFields) as cursor:
+        for chunk in chunkIterable(cursor, chunkSize):
+            rows = list(chunk)
+            keys = numpy.empty(len(rows), dtype = object)
+            keys[:] = [row[0] for row in rows]
+            values = numpy.column_stack([valuesToArray([row[i + 1] for row in rows]).astype(numpy.float64)
+                                         for i in range(len(valueFields))])
+            groups.pushMany(keys, values)
+
+    results = {"COUNT": groups.count(), "SUM": groups.sum(), "MEAN": groups.mean(),
+               "MIN": groups.minimum(), "MAX": groups.maximum(), "STD": groups.stdDev(ddof = 0)}
+
+    columnHeaders = [groupField, "FREQUENCY"]
+    for fieldName in valueFields:
+        for stat in stats:
+            columnHeaders.append("%s_%s" % (stat, fieldName))
+
+    order = sorted(range(len(groups.keys)), key = lambda i: (groups.keys[i] is None, groups.keys[i]))
+    rows = []
+    for i in order:
+        row = [groups.keys[i], int(groups.frequency[i])]
+        for j in range(len(valueFields)):
+            for stat in stats:
+                value = results[stat][i, j].item()
+                row.append(None if value != value else value)
+        rows.append(row)
+
+    if outputTable != None:
+        ## Imported here because ez.FC imports this module
+        from ez.FC import createTable
+
+        groupFieldType = fieldTypeKeyword(getFieldObject(inputOBJ, groupField))
+        createTable(outputTable, [[groupField, groupFieldType], ["FREQUENCY", "LONG"]] +
+                    [[columnHeader, "LONG" if columnHeader.startswith("COUNT_") else "DOUBLE"]
+                     for columnHeader in columnHeaders[2:]])
+        with arcpy.da.InsertCursor(outputTable, columnHeaders) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+
+    if display == True:
+        ezTable(rows, columnHeaders, title = "%s by %s" % (", ".join(valueFields), groupField))
+
+    return rows, columnHeaders
+
+def fieldCorrelationMatrix(inputOBJ, fields, weights = None,
+                           statistic = "CORRELATION", display = False,
+                           chunkSize = 500000):
+    """Returns the correlation (or covariance) matrix of several numeric fields.
+
+    The fields (and the weight field) are read in a single pass with
+    cursorChunks, and each chunk is pushed into a runningCovariance object (see
+    ez.Stats), which reduces it to its means and co-moment matrix with one
+    matrix product and merges them into the running values [1].  Memory use
+    depends on chunkSize and the square of the number of fields, not on the
+    size of the data set.
+
+    Rows with a NULL value in any of the fields (or in the weight field) are
+    skipped, so every coefficient is computed from the same rows.
+
+    The output is a len(fields) x len(fields) NumPy array in the order of
+    fields.  Correlations involving a field without any variance are NaN.
+
+    Parameter Types:
+    inputOBJ    - String
+    fields      - List of Strings (numeric fields only)
+    weights     - String (numeric field)
+    statistic   - String ["CORRELATION", "COVARIANCE"]
+    display     - Boolean
+    chunkSize   - Integer
+
+    Default Parameters:
+    weights = None
+        Every row counts equally.  If a field is specified, each row is
+        weighted by its value, as if it were repeated that many times (for
+        example, to weight block groups by population).
+    statistic = "CORRELATION"
+        Pearson correlation coefficients.  "COVARIANCE" returns the sample
+        covariance matrix instead.
+    display = False
+        If True, the matrix is also printed with ezTable.
+    chunkSize = 500000
+        The number of rows in each chunk.
+
+    References:
+    [1] https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Covariance
+    """
+
+    if statistic.upper() not in ["CORRELATION", "COVARIANCE"]:
+        raise ValueError("statistic must be 'CORRELATION' or 'COVARIANCE'")
+
+    readFields = list(fields) + ([weights] if weights != None else [])
+    accumulator = runningCovariance(len(fields))
+    for chunk in cursorChunks(inputOBJ, readFields, chunkSize):
+        values = numpy.column_stack([chunk[fieldName.upper()].astype(numpy.float64) for fieldName in fields])
+        accumulator.pushMany(values, chunk[weights.upper()].astype(numpy.float64) if weights != None else None)
+
+    if statistic.upper() == "CORRELATION":
+        matrix = accumulator.correlation()
+    else:
+        matrix = accumulator.covariance()
+
+    if display == True:
+        ezTable(matrix, list(fields), list(fields),
+                title = "%s (%s rows)" % (statistic.title(), accumulator.n))
+
+    return matrix
+
+def fieldValueCounts(inputOBJ, fieldName,
+                     sort = False, reverse = False, skipNULLs = True,
+                     chunkSize = 500000):
+    """Returns the distinct values of a field and how many times each occurs.
+
+    The field is read as a series of NumPy arrays (see fieldToNumPyArrayChunks)
+    and each block is reduced with numpy.unique [1], which returns the distinct
+    values of the block along with their counts and first positions.  The
+    results of each block are merged into the results of the previous blocks,
+    so only the distinct values (and never the whole field) are held in memory.
+
+    The output is an OrderedDict mapping each value to its count.  By default
+    the values are in the order they first occur in the data set, like
+    fieldUniqueValues.
+
+    Parameter Types:
+    inputOBJ    - String
+    fieldName   - String
+    sort        - Boolean
+    reverse     - Boolean
+    skipNULLs   - Boolean
+    chunkSize   - Integer
+
+    Default Parameters:
+    sort = False
+        The values are returned in order of their first occurrence.  If True,
+        the values are sorted instead.
+    reverse = False
+        Only used when sort = True.  If True, the values are sorted in
+        descending order.
+    skipNULLs = True
+        NULL values are not counted.  If False, the number of NULL values is
+        determined with an additional query and None is added as the last value.
+    chunkSize = 500000
+        The number of ObjectIDs read per block.
+
+    References:
+    [1] https://docs.scipy.org/doc/numpy/reference/generated/numpy.unique.html
+    """
+
+    uniqueValues    = None
+    firstPositions  = None
+    counts          = None
+    position        = 0
+
+    for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+        chunkValues, chunkFirstPositions, chunkCounts = numpy.unique(array, return_index = True, return_counts = True)
+        chunkFirstPositions = chunkFirstPositions + position
+        position += len(array)
+
+        if uniqueValues is None:
+            uniqueValues, firstPositions, counts = chunkValues, chunkFirstPositions, chunkCounts
+        else:
+            uniqueValues, inverse = numpy.unique(numpy.concatenate([uniqueValues, chunkValues]), return_inverse = True)
+            counts = numpy.bincount(inverse, weights = numpy.concatenate([counts, chunkCounts])).astype(numpy.int64)
+            allFirstPositions = numpy.concatenate([firstPositions, chunkFirstPositions])
+            firstPositions = numpy.repeat(position, len(uniqueValues))
+            numpy.minimum.at(firstPositions, inverse, allFirstPositions)
+
+    valueCounts = OrderedDict()
+
+    if uniqueValues is not None:
+        if sort == False:
+            order = numpy.argsort(firstPositions, kind = "mergesort")
+        elif reverse == True:
+            order = numpy.arange(len(uniqueValues))[::-1]
+        else:
+            order = numpy.arange(len(uniqueValues))
+        for value, count in zip(uniqueValues[order].tolist(), counts[order].tolist()):
+            valueCounts[value] = count
+
+    if skipNULLs == False:
+        nullView = randomString()
+        nullQuery = "%s IS NULL" % arcpy.AddFieldDelimiters(inputOBJ, fieldName)
+        arcpy.MakeTableView_management(inputOBJ, nullView, nullQuery)
+        nullCount = countFeatures(nullView)
+        arcpy.Delete_management(nullView)
+        if nullCount > 0:
+            valueCounts[None] = nullCount
+
+    return valueCounts
+
+def fieldDistinctCount(inputOBJ, fieldName,
+                       approximate = True, precision = 14, chunkSize = 500000):
+    """Returns the number of distinct non-NULL values of a field.
+
+    When only the number of distinct values is needed, keeping every distinct
+    value in memory is wasteful.  With approximate = True, the field is read
+    in blocks (see fieldToNumPyArrayChunks) and every block is added to a
+    HyperLogLog sketch [1] (see hyperLogLog in ez.Stats), which uses
+    2 ** precision bytes of memory no matter how many distinct values there are.
+
+    Parameter Types:
+    inputOBJ    - String
+    fieldName   - String
+    approximate - Boolean
+    precision   - Integer [4 - 18]
+    chunkSize   - Integer
+
+    Default Parameters:
+    approximate = True
+        The count is estimated with a relative standard error of about
+        1.04 / sqrt(2 ** precision).  If False, the exact count is calculated
+        with fieldValueCounts.
+    precision = 14
+        16 KB of memory and a relative standard error of about 0.8%
+    chunkSize = 500000
+        The number of ObjectIDs read per block.
+
+    References:
+    [1] http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+    """
+
+    if approximate == False:
+        return len(fieldValueCounts(inputOBJ, fieldName, chunkSize = chunkSize))
+
+    sketch = hyperLogLog(precision)
+    for array in fieldToNumPyArrayChunks(inputOBJ, fieldName, chunkSize):
+        sketch.pushMany(array)
+
+    return sketch.count()
 
 def fieldUniqueValues(inputOBJ, fieldName,
-                      sort = False, reverse = False, skipNULLs = True):
+                      sort = False, reverse = False, skipNULLs = True,
+                      method = "CURSOR", chunkSize = 500000):
+    ## method = "CHUNKED" uses fieldValueCounts, which reduces blocks of the
+    ## field with NumPy instead of adding every row to a set in Python
+    if method.upper() == "CHUNKED":
+        return list(fieldValueCounts(inputOBJ, fieldName, sort, reverse, skipNULLs, chunkSize).keys())
+    elif method.upper() != "CURSOR":
+        raise ValueError("method must be 'CURSOR' or 'CHUNKED'")
+
     if sort == True:
         uniqueValues = set()
     elif sort == False:
@@ -461,12 +1193,18 @@ if __name__ == "__main__":
         arcpy.AddIndex_management (statesSHP, "GEOID")
         print("\t'GEOID' Field Indexed? %s" % hasAttributeIndex(statesSHP, "GEOID"))
 
+    print("\n\tDescribe cache: %s" % describeCacheInfo())
+
     print("\nThe maximum land area in a state is %s" % fieldMax(statesSHP, "ALAND"))
     print("The minimum land area in a state is %s" % fieldMin(statesSHP, "ALAND"))
     print("The average land area of a state is %s" % fieldMean(statesSHP, "ALAND"))
     print("The standard deviation of land area in the states is %s" % fieldStdDev(statesSHP, "ALAND"))
     print("The total land area of all the states is %s" % fieldSum(statesSHP, "ALAND"))
 
+    print("\nSummary of the land and water areas of the states:")
+    for fieldName, fieldStats in fieldSummary(statesSHP, ["ALAND", "AWATER"]).items():
+        print("\t%s: %s" % (fieldName, fieldStats))
+
     print("\nState Names (feature class order):")
     for stateName in fieldValues(statesSHP, "NAME"):
         print("\t%s" % stateName)
@@ -1,6 +1,11 @@
 import arcpy
 import os
+import re
+import time
+from collections import OrderedDict
 from ez.Describe import *
+from ez.Misc import chunkIterable, randomString
+from ez.Table import ezTable
 
 def FCToFC(inputFC, outputFC,
            subsetQuery = None, keepFields = "ALL", omitFields = None):
@@ -135,18 +140,114 @@ def TableToTable(inputTable, outputTable,
     return True
 
 def copyFieldsToFC(inputOBJ, outputFC, fieldsToCopy):
-    ## This only recreates the fields by name and type.
+    ## This only recreates the fields by name, type, length, alias, etc.
     ## This does NOT copy any data or do any type of join.
-    for fieldToCopy in fieldsToCopy:
-        templateField = getFieldObject(inputOBJ, fieldToCopy)
-        ## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/add-field.htm
-        arcpy.AddField_management(outputFC, templateField.name, templateField.type, templateField.precision,
-                                  templateField.scale, templateField.length, templateField.aliasName,
-                                  templateField.isNullable, templateField.required, templateField.domain)
+    ## The template fields are all looked up from a single (cached) listing of
+    ## the input fields and added with addFields.
+    templateFields = {}
+    for templateField in describeDataset(inputOBJ, "FIELDS"):
+        templateFields[templateField.name.upper()] = templateField
+
+    addFields(outputFC, [templateFields[fieldToCopy.upper()] for fieldToCopy in fieldsToCopy])
+    return True
+
+## Returns the parameters of Add Field (after the data set) for a field, which is
+## either an arcpy Field object or a list of [fieldName, fieldType] optionally
+## followed by precision, scale, length, alias, isNullable, required and domain.
+## Parameters that are not given are "" (the tool's default).
+## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/add-field.htm
+def _fieldDefinition(field):
+    if type(field) in [list, tuple]:
+        definition = list(field) + [""] * (9 - len(field))
+    else:
+        definition = [field.name, fieldTypeKeyword(field), field.precision, field.scale, field.length,
+                      field.aliasName, field.isNullable, field.required, field.domain]
+    return ["" if value == None else value for value in definition]
+
+## File geodatabases and in_memory workspaces ignore the precision and scale
+## of fields, so those can be left out when adding fields to them
+def _ignoresPrecision(inputOBJ):
+    path = inputOBJ.replace("\\", "/").lower()
+    return ".gdb/" in path or path.startswith("in_memory/")
+
+def addFields(inputOBJ, fields):
+    ## Adds several fields to an existing data set.
+    ## fields is a list of [fieldName, fieldType] lists (the same as createFC),
+    ## optionally with the other Add Field parameters, or of arcpy Field
+    ## objects (e.g. from the listing of another data set), see _fieldDefinition.
+    ## On ArcGIS Pro 2.0+ the Add Fields tool adds all of them with a single
+    ## schema lock.  ArcMap has no such tool, so there every field still takes
+    ## its own Add Field call (and schema lock); new data sets get their whole
+    ## schema in one step from createFC and createTable instead.  Add Fields
+    ## has no precision, scale, nullability or required parameters, so fields
+    ## that set those fall back to one Add Field call each as well (precision
+    ## and scale are dropped instead where they are ignored anyway).
+    ## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/add-fields.htm
+    if len(fields) == 0:
+        return True
+
+    ignoresPrecision = _ignoresPrecision(inputOBJ)
+    batchedFields = []
+    singleFields = []
+    for field in fields:
+        fieldName, fieldType, precision, scale, length, alias, isNullable, required, domain = _fieldDefinition(field)
+        if hasattr(arcpy, "AddFields_management") and \
+           (ignoresPrecision == True or (precision in ["", 0] and scale in ["", 0])) and \
+           isNullable in ["", True, "NULLABLE"] and required in ["", False, "NON_REQUIRED"]:
+            ## [Field Name, Field Type, Field Alias, Field Length, Default Value, Field Domain]
+            batchedFields.append([fieldName, fieldType, alias, length if fieldType == "TEXT" else "", "", domain])
+        else:
+            singleFields.append([fieldName, fieldType, precision, scale, length, alias, isNullable, required, domain])
+
+    if len(batchedFields) > 0:
+        arcpy.AddFields_management(inputOBJ, batchedFields)
+    for fieldName, fieldType, precision, scale, length, alias, isNullable, required, domain in singleFields:
+        arcpy.AddField_management(inputOBJ, fieldName, fieldType, precision, scale, length, alias,
+                                  isNullable, required, domain)
+    clearDescribeCache(inputOBJ)
+
     return True
 
+## Creates a temporary data set in workspace (in_memory by default) with the
+## fields of template (optional) and fields, to be passed as the template of a
+## Create tool, so that the data set on disk gets its whole schema in the same
+## step as it is created.  The fields are added to the temporary data set one
+## by one on ArcMap (see addFields), but in memory that does not take a schema
+## lock or rewrite anything on disk.  Domains only exist in the workspace of the
+## output, so fields with a domain are left out and returned to be added to the
+## output afterwards.  Returns the template and those fields.
+def _schemaTemplate(fields, template = "", geometryType = None, spatialReference = "",
+                    workspace = "in_memory"):
+    schemaFields = []
+    domainFields = []
+    for field in fields:
+        definition = _fieldDefinition(field)
+        if definition[8] == "":
+            schemaFields.append(definition)
+        else:
+            domainFields.append(definition)
+
+    templateName = randomString()
+    if geometryType == None:
+        arcpy.CreateTable_management(workspace, templateName, template)
+    else:
+        arcpy.CreateFeatureclass_management(workspace, templateName, geometryType, template,
+                                            spatial_reference = spatialReference)
+    schemaTemplate = os.path.join(workspace, templateName)
+    addFields(schemaTemplate, schemaFields)
+
+    return schemaTemplate, domainFields
+
+## fields is a list of [fieldName, fieldType] lists, optionally with the other
+## Add Field parameters, or of arcpy Field objects (see addFields).
+## template (optional) is a data set whose fields the new one starts with.
+## The data set is created from a temporary template holding all of the fields
+## (see _schemaTemplate), so its schema is created in a single step rather
+## than with one Add Field call per field.
+## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/create-feature-class.htm
+## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/create-table.htm
 def createFC(outputFC, geometryType, fields,
-             spatialReference = ""):
+             spatialReference = "", template = "", scratchWorkspace = "in_memory"):
 
     outputFCPath = os.path.dirname(outputFC)
     if outputFCPath == "":
@@ -157,16 +258,22 @@ def createFC(outputFC, geometryType, fields,
         
     outputFCName = os.path.basename(outputFC)
     
-    arcpy.CreateFeatureclass_management(outputFCPath, outputFCName, geometryType,
-                                        spatial_reference = spatialReference)
-
-    for field in fields:
-        fieldName, fieldType = field
-        arcpy.AddField_management(outputFC, fieldName, fieldType)
+    domainFields = []
+    if len(fields) > 0:
+        template, domainFields = _schemaTemplate(fields, template, geometryType, spatialReference,
+                                                 scratchWorkspace)
+    try:
+        arcpy.CreateFeatureclass_management(outputFCPath, outputFCName, geometryType, template,
+                                            spatial_reference = spatialReference)
+    finally:
+        if len(fields) > 0:
+            arcpy.Delete_management(template)
+
+    addFields(outputFC, domainFields)
 
     return True
 
-def createTable(outputTable, fields):
+def createTable(outputTable, fields, template = "", scratchWorkspace = "in_memory"):
 
     outputTablePath = os.path.dirname(outputTable)
     if outputTablePath == "":
@@ -177,24 +284,203 @@ def createTable(outputTable, fields):
         
     outputTableName = os.path.basename(outputTable)
     
-    arcpy.CreateTable_management(outputTablePath, outputTableName)
+    domainFields = []
+    if len(fields) > 0:
+        template, domainFields = _schemaTemplate(fields, template, workspace = scratchWorkspace)
+    try:
+        arcpy.CreateTable_management(outputTablePath, outputTableName, template)
+    finally:
+        if len(fields) > 0:
+            arcpy.Delete_management(template)
 
-    for field in fields:
-        fieldName, fieldType = field
-        arcpy.AddField_management(outputTable, fieldName, fieldType)
+    addFields(outputTable, domainFields)
 
     return True
 
 def clearAliases(inputTable):
     fields = listFieldNames(inputTable)
-    for field in fields:
-        if getFieldObject(inputTable, field).isNullable == True:
+    ## Look up every field object before altering any of them (each
+    ## AlterField invalidates the describe cache of the data set)
+    fieldObjects = [getFieldObject(inputTable, field) for field in fields]
+    for fieldObject in fieldObjects:
+        if fieldObject.isNullable == True:
             nullability = "NULLABLE"
         else:
             nullability = "NON_NULLABLE"
-        arcpy.AlterField_management(inputTable, field, field_is_nullable = nullability, clear_field_alias = "TRUE")
+        arcpy.AlterField_management(inputTable, fieldObject.name, field_is_nullable = nullability, clear_field_alias = "TRUE")
+    clearDescribeCache(inputTable)
     return True
 
+## Returns the name of every field of fields in outputOBJ (None if it has no
+## such field).  Shapefiles and dBASE tables truncate field names to 10
+## characters and number the duplicates (POPULATION2000 and POPULATION2010
+## become POPULATION and POPULATI_1), so fields without a field of the same
+## name are matched, in order, with the remaining fields whose name is such a
+## truncation of theirs.
+def _outputFieldNames(fields, outputOBJ):
+    outputFields = listFieldNames(outputOBJ)
+    upperOutputFields = [outputField.upper() for outputField in outputFields]
+    outputNames = [outputFields[upperOutputFields.index(field.upper())] if field.upper() in upperOutputFields else None
+                   for field in fields]
+    remainingFields = [outputField for outputField in outputFields if outputField not in outputNames]
+    for index, field in enumerate(fields):
+        if outputNames[index] != None or len(field) <= 10:
+            continue
+        for outputField in remainingFields:
+            if len(outputField) == 10 and field.upper().startswith(re.sub(r"_\d+$", "", outputField).upper()):
+                outputNames[index] = outputField
+                remainingFields.remove(outputField)
+                break
+    return outputNames
+
+## ------------------------------------------------------------
+## Cursor copy engine
+## ------------------------------------------------------------
+## FCToFC and TableToTable hand the copy to the conversion tools, which first
+## need a FieldMappings object rebuilt field by field on every call.
+## cursorCopy creates the output with only the kept fields instead (see
+## _schemaTemplate) and moves the rows itself: a SearchCursor reads only the
+## kept fields (and the geometry) of only the rows selected by subsetQuery, and
+## an InsertCursor writes them, batchSize rows at a time.
+## keepFields and omitFields work the same way as in FCToFC.
+## transform (optional) is called with every batch as a list of row tuples, in
+## the order of the kept fields followed by the geometry ("SHAPE@") for
+## feature classes, and returns the list of rows to write, so rows can be
+## changed or dropped on the fly.
+## Returns an OrderedDict of the "Rows Read", "Rows Written", "Seconds" and
+## "Rows Per Second" (rows read per second) of the copy.
+## Shapefiles and dBASE tables truncate field names to 10 characters, so
+## kept fields with longer names are written to the truncated fields (see
+## _outputFieldNames), as FCToFC's field mappings do.
+
+def cursorCopy(inputOBJ, outputOBJ,
+               subsetQuery = None, keepFields = "ALL", omitFields = None,
+               transform = None, batchSize = 10000):
+
+    startTime = time.time()
+
+    keepAll = keepFields == "ALL" and omitFields == None
+    if keepFields == "ALL":
+        keepFields = listFieldNames(inputOBJ)
+    elif isinstance(keepFields, basestring):
+        keepFields = [keepFields]
+    if omitFields != None:
+        omitFields = [omitField.upper() for omitField in omitFields]
+        keepFields = [keepField for keepField in keepFields if keepField.upper() not in omitFields]
+
+    outputPath = os.path.dirname(outputOBJ)
+    if outputPath == "":
+        outputPath = arcpy.env.workspace
+    outputName = os.path.basename(outputOBJ)
+
+    description = arcpy.Describe(inputOBJ)
+    isFeatureClass = hasattr(description, "shapeType")
+
+    ## When every field is kept the output is created from the input as a
+    ## template, otherwise from a temporary template of the kept fields (see
+    ## _schemaTemplate), so that the fields are added in the same step
+    if keepAll == True:
+        template = inputOBJ
+    else:
+        templateFields = {}
+        for templateField in describeDataset(inputOBJ, "FIELDS"):
+            templateFields[templateField.name.upper()] = templateField
+        template, domainFields = _schemaTemplate([templateFields[keepField.upper()] for keepField in keepFields], "",
+                                                 description.shapeType if isFeatureClass == True else None,
+                                                 description.spatialReference if isFeatureClass == True else "")
+
+    try:
+        if isFeatureClass == True:
+            ## http://pro.arcgis.com/en/pro-app/tool-reference/data-management/create-feature-class.htm
+            arcpy.CreateFeatureclass_management(outputPath, outputName, description.shapeType, template,
+                                                has_m = "ENABLED" if description.hasM else "DISABLED",
+                                                has_z = "ENABLED" if description.hasZ else "DISABLED",
+                                                spatial_reference = description.spatialReference)
+        else:
+            arcpy.CreateTable_management(outputPath, outputName, template)
+    finally:
+        if keepAll == False:
+            arcpy.Delete_management(template)
+    outputOBJ = os.path.join(outputPath, outputName)
+
+    ## Fields with a domain are left out of the template, and new shapefiles
+    ## and dBASE tables already have a field (e.g. "Id")
+    outputFields = _outputFieldNames(keepFields, outputOBJ)
+    copyFieldsToFC(inputOBJ, outputOBJ, [keepField for keepField, outputField in zip(keepFields, outputFields)
+                                         if outputField == None])
+    outputFields = _outputFieldNames(keepFields, outputOBJ)
+    if None in outputFields:
+        raise ValueError("Unable to find %s in %s" % (", ".join(keepField for keepField, outputField in zip(keepFields, outputFields)
+                                                                if outputField == None), outputOBJ))
+
+    geometryFields = ["SHAPE@"] if isFeatureClass == True else []
+    rowsRead = 0
+    rowsWritten = 0
+    with arcpy.da.InsertCursor(outputOBJ, outputFields + geometryFields) as insertCursor:
+        with arcpy.da.SearchCursor(inputOBJ, keepFields + geometryFields, subsetQuery) as searchCursor:
+            for chunk in chunkIterable(searchCursor, batchSize):
+                rows = list(chunk)
+                rowsRead += len(rows)
+                if transform != None:
+                    rows = transform(rows)
+                for row in rows:
+                    insertCursor.insertRow(row)
+                rowsWritten += len(rows)
+
+    seconds = time.time() - startTime
+    return OrderedDict([("Rows Read", rowsRead), ("Rows Written", rowsWritten), ("Seconds", seconds),
+                        ("Rows Per Second", rowsRead / seconds if seconds > 0 else None)])
+
+## Copies inputOBJ into outputWorkspace (a file geodatabase or a folder for
+## shapefiles) once with FCToFC/TableToTable and once with cursorCopy, with the
+## same subsetQuery, keepFields and omitFields, and returns (and optionally
+## displays) the rows, seconds and rows per second of each, taking the fastest
+## of repeats runs.  The copies are deleted afterwards.
+def benchmarkCursorCopy(inputOBJ, outputWorkspace,
+                        subsetQuery = None, keepFields = "ALL", omitFields = None,
+                        repeats = 3, display = True):
+
+    isFeatureClass = hasattr(arcpy.Describe(inputOBJ), "shapeType")
+    if outputWorkspace.lower().endswith(".gdb"):
+        extension = ""
+    elif isFeatureClass == True:
+        extension = ".shp"
+    else:
+        extension = ".dbf"
+
+    def geoprocessingCopy(outputOBJ):
+        startTime = time.time()
+        if isFeatureClass == True:
+            FCToFC(inputOBJ, outputOBJ, subsetQuery, keepFields, omitFields)
+        else:
+            TableToTable(inputOBJ, outputOBJ, subsetQuery, keepFields, omitFields)
+        seconds = time.time() - startTime
+        rows = countFeatures(outputOBJ)
+        return OrderedDict([("Rows Read", rows), ("Rows Written", rows), ("Seconds", seconds),
+                            ("Rows Per Second", rows / seconds if seconds > 0 else None)])
+
+    def cursorEngineCopy(outputOBJ):
+        return cursorCopy(inputOBJ, outputOBJ, subsetQuery, keepFields, omitFields)
+
+    results = OrderedDict()
+    for method, copyFunction in [("Geoprocessing", geoprocessingCopy), ("Cursor", cursorEngineCopy)]:
+        outputOBJ = os.path.join(outputWorkspace, "ezCopy%s%s" % (method, extension))
+        for i in range(repeats):
+            if arcpy.Exists(outputOBJ):
+                arcpy.Delete_management(outputOBJ)
+            result = copyFunction(outputOBJ)
+            if method not in results or result["Seconds"] < results[method]["Seconds"]:
+                results[method] = result
+            arcpy.Delete_management(outputOBJ)
+
+    if display == True:
+        ezTable([[method] + [methodResult[column] for column in ["Rows Written", "Seconds", "Rows Per Second"]]
+                 for method, methodResult in results.items()],
+                ["Method", "Rows", "Seconds", "Rows Per Second"],
+                title = "Copying %s" % inputOBJ)
+
+    return results
+
 if __name__ == "__main__":
     arcpy.env.workspace = os.path.join(os.getcwd(), "testData")
     arcpy.env.overwriteOutput = True
@@ -216,3 +502,6 @@ if __name__ == "__main__":
     outputSHP = os.path.join(arcpy.env.workspace, "CountiesLarge.shp")
     FCToFC(inputSHP, outputSHP, '"DP0010001" >= 100000')
     print "%s created" % outputSHP
+
+##    benchmarkCursorCopy(inputSHP, arcpy.env.workspace, '"DP0010001" >= 100000',
+##                        keepFields = ["GEOID10", "NAMELSAD10", "DP0010001"])
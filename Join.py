@@ -3,9 +3,58 @@ from ez.Misc import *
 from ez.Describe import *
 from ez.FC import *
 from ez.Timer import *
+from ez.Stats import bloomFilter, hashArray, writeColumns, groupedStats
+from ez.Query import valuesToArray
 import os
+import math
+import heapq
+import shutil
+import tempfile
+import numpy
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
-def joinTables(inputTables, joinField, outputTable, scratchWorkspace = "in_memory"):
+## Joins several tables on a common joinField into a new outputTable in one pass.
+## Every table except the largest is loaded into a dictionary keyed by the join
+## field, and the largest table is then read once with a SearchCursor and
+## written straight to outputTable with an InsertCursor, looking up the rows of
+## the other tables as it goes.  No intermediate data sets are created.
+## outputTable has a row for every row of the largest table (the other tables
+## are left joined to it) and, after the join field, the fields of the largest
+## table and then those of the other tables in order.  If several tables have a
+## field with the same name, the field of the later table is prefixed with its
+## table name (e.g. Counties_NAME, see _prefixedFieldName).
+## scratchWorkspace holds the temporary template that the schema of
+## outputTable is created from (see createTable).
+## Returns a report (an OrderedDict keyed by table) of the number of rows of
+## every table, how many rows of the largest table found a match in it and the
+## match rate, along with the peak memory use of the process in bytes (None if
+## it cannot be determined, see peakMemoryUsage).
+## Returns the name under which fieldName of table is written when the output
+## already has a field of that name: the field name prefixed with the name of
+## the table, made valid for the output workspace (see ValidateFieldName) and
+## numbered if it is taken as well
+## http://pro.arcgis.com/en/pro-app/arcpy/functions/validatefieldname.htm
+def _prefixedFieldName(table, fieldName, usedFields, workspace):
+    tableName = os.path.splitext(os.path.basename(table))[0]
+    baseName = arcpy.ValidateFieldName("%s_%s" % (tableName, fieldName), workspace)
+    outputName = baseName
+    number = 0
+    while outputName.upper() in usedFields:
+        number += 1
+        suffix = "_%s" % number
+        outputName = arcpy.ValidateFieldName(baseName + suffix, workspace)
+        ## Workspaces with short field names (e.g. dBASE) truncate the suffix
+        if outputName.upper().endswith(suffix.upper()) == False:
+            outputName = arcpy.ValidateFieldName(baseName[:len(outputName) - len(suffix)] + suffix, workspace)
+    return outputName
+
+def joinTables(inputTables, joinField, outputTable, scratchWorkspace = "in_memory",
+               display = False):
 
     largestTable    = ""
     largestN        = 0
@@ -16,27 +65,590 @@ def joinTables(inputTables, joinField, outputTable, scratchWorkspace = "in_memor
             largestTable = table
             largestN = rowCount
 
-    intermediateCount = 0
-    for table in inputTables:
-        if intermediateCount == 0:
-            inputTable = largestTable
-        else:
-            inputTable = os.path.join(scratchWorkspace, "Output_%s" % (intermediateCount - 1))
+    ## The fields each table contributes, in the order they are written, and
+    ## the names they are written under
+    tableFields = OrderedDict()
+    outputNames = OrderedDict()
+    usedFields = [joinField.upper()]
+    outputWorkspace = os.path.dirname(outputTable) or arcpy.env.workspace
+    for table in [largestTable] + [table for table in inputTables if table != largestTable]:
+        tableFields[table] = []
+        outputNames[table] = []
+        for fieldName in listFieldNames(table):
+            if fieldName.upper() == joinField.upper():
+                continue
+            outputName = fieldName
+            if outputName.upper() in usedFields:
+                outputName = _prefixedFieldName(table, fieldName, usedFields, outputWorkspace)
+            tableFields[table].append(fieldName)
+            outputNames[table].append(outputName)
+            usedFields.append(outputName.upper())
 
-        if table <> largestTable:
-            intermediateTable = os.path.join(scratchWorkspace, "Output_%s" % intermediateCount)
-            joinTableToFC(inputTable, table, joinField, intermediateTable)
-            intermediateCount += 1
+    ## The whole schema is created in one step from a template in
+    ## scratchWorkspace (see createTable), using the (cached) fields of each table
+    outputFieldObjects = [getFieldObject(largestTable, joinField)]
+    for table, fields in tableFields.items():
+        fieldObjects = dict((fieldObject.name, fieldObject) for fieldObject in describeDataset(table, "FIELDS"))
+        for fieldName, outputName in zip(fields, outputNames[table]):
+            fieldObject = fieldObjects[fieldName]
+            if outputName == fieldName:
+                outputFieldObjects.append(fieldObject)
+            else:
+                outputFieldObjects.append([outputName, fieldTypeKeyword(fieldObject), fieldObject.precision,
+                                           fieldObject.scale, fieldObject.length, fieldObject.aliasName,
+                                           fieldObject.isNullable, fieldObject.required, fieldObject.domain])
+    createTable(outputTable, outputFieldObjects, scratchWorkspace = scratchWorkspace)
 
-    finalIntermediate = os.path.join(scratchWorkspace, "Output_%s" % (intermediateCount - 1))
-    TableToTable(finalIntermediate, outputTable)
+    lookups = OrderedDict()
+    rowCounts = OrderedDict()
+    for table, fields in list(tableFields.items())[1:]:
+        lookup = {}
+        rowCounts[table] = 0
+        with arcpy.da.SearchCursor(table, [joinField] + fields) as cursor:
+            for row in cursor:
+                lookup[row[0]] = row[1:]
+                rowCounts[table] += 1
+        lookups[table] = lookup
 
-    return True
+    report = OrderedDict()
+    report[largestTable] = OrderedDict([("Rows", largestN), ("Matched", largestN), ("Match Rate", 1.0)])
+    matched = OrderedDict((table, 0) for table in lookups)
+    missing = OrderedDict((table, (None, ) * len(tableFields[table])) for table in lookups)
+
+    outputFields = [joinField] + [outputName for names in outputNames.values() for outputName in names]
+    with arcpy.da.InsertCursor(outputTable, outputFields) as insertCursor:
+        with arcpy.da.SearchCursor(largestTable, [joinField] + tableFields[largestTable]) as cursor:
+            for row in cursor:
+                outputRow = row
+                for table, lookup in lookups.items():
+                    data = lookup.get(row[0])
+                    if data == None:
+                        data = missing[table]
+                    else:
+                        matched[table] += 1
+                    outputRow = outputRow + data
+                insertCursor.insertRow(outputRow)
+
+    for table in lookups:
+        report[table] = OrderedDict([("Rows", rowCounts[table]), ("Matched", matched[table]),
+                                     ("Match Rate", matched[table] / float(largestN) if largestN > 0 else None)])
+    report["Peak Memory"] = peakMemoryUsage()
+
+    if display == True:
+        ezTable([[table] + list(tableReport.values()) for table, tableReport in report.items() if table != "Peak Memory"],
+                ["Table", "Rows", "Matched", "Match Rate"],
+                title = "Join on %s (peak memory %s bytes)" % (joinField, report["Peak Memory"]))
+
+    return report
     
 
+## ------------------------------------------------------------
+## Compact join lookup
+## ------------------------------------------------------------
+## A dictionary of tuples costs several Python objects per value, which adds up
+## to gigabytes for tables with millions of rows and hundreds of columns.
+## joinLookup keeps the keys of a table as one sorted NumPy array (probed with
+## numpy.searchsorted) and the values as one NumPy structured array, with a
+## boolean array marking the NULL values.  Whole arrays of keys can be probed
+## at once.  Like a dictionary, the last row of a duplicated key wins.
+
+## Converts a list of values read with a cursor into a compact NumPy array and
+## a boolean array of the NULL positions (where the array holds 0 or '')
+def _compactArray(values):
+    nulls = numpy.array([value == None for value in values], dtype = bool)
+    sample = next((value for value in values if value != None), None)
+    if sample == None:
+        return numpy.zeros(len(values)), nulls
+    if isinstance(sample, bool):
+        dtype = bool
+    elif isinstance(sample, (int, long)):
+        dtype = numpy.int64
+    elif isinstance(sample, float):
+        dtype = numpy.float64
+    elif isinstance(sample, basestring):
+        return numpy.array([u"" if value == None else value for value in values]), nulls
+    else:
+        dtype = object
+    return numpy.array([0 if value == None and dtype != object else value for value in values], dtype = dtype), nulls
+
+## Concatenates the chunks of a column made by _compactArray, converting the
+## chunks that were entirely NULL to the type of the others
+def _concatenateChunks(chunks):
+    typed = [array for array, nulls in chunks if nulls.all() == False]
+    if len(typed) == 0:
+        return numpy.concatenate([array for array, nulls in chunks])
+    dtype = numpy.concatenate([array[:0] for array in typed]).dtype
+    return numpy.concatenate([array if nulls.all() == False else array.astype(dtype) for array, nulls in chunks])
+
+class joinLookup:
+
+    def __init__(self, inputTable, joinField, fields, chunkSize = 500000, query = None):
+        self.fields = list(fields)
+        keyChunks = []
+        columnChunks = [[] for field in self.fields]
+        with arcpy.da.SearchCursor(inputTable, [joinField] + self.fields, query) as cursor:
+            for chunk in chunkIterable(cursor, chunkSize):
+                ## NULL keys never match
+                rows = [row for row in chunk if row[0] != None]
+                if len(rows) == 0:
+                    continue
+                keyChunks.append(_compactArray([row[0] for row in rows]))
+                for i in range(len(self.fields)):
+                    columnChunks[i].append(_compactArray([row[i + 1] for row in rows]))
+
+        if len(keyChunks) == 0:
+            keyChunks = [(numpy.zeros(0), numpy.zeros(0, dtype = bool))]
+            columnChunks = [[(numpy.zeros(0), numpy.zeros(0, dtype = bool))] for field in self.fields]
+
+        keys = _concatenateChunks(keyChunks)
+        columns = [_concatenateChunks(chunks) for chunks in columnChunks]
+        nulls = numpy.column_stack([numpy.concatenate([chunkNulls for array, chunkNulls in chunks]) for chunks in columnChunks]) \
+                if len(self.fields) > 0 else numpy.zeros((len(keys), 0), dtype = bool)
+
+        ## Sort the keys, keeping only the last row of every key
+        order = numpy.argsort(keys, kind = "mergesort")
+        sortedKeys = keys[order]
+        isLast = numpy.concatenate([sortedKeys[1:] != sortedKeys[:-1], [True]]) if len(keys) > 0 else numpy.zeros(0, dtype = bool)
+        order = order[isLast]
+
+        self.rowCount = len(keys)
+        self.duplicateKeys = len(keys) - len(order)
+        self.keys = keys[order]
+        self.values = numpy.zeros(len(order), dtype = [("f%s" % i, column.dtype) for i, column in enumerate(columns)])
+        for i, column in enumerate(columns):
+            self.values["f%s" % i] = column[order]
+        self.nulls = nulls[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def memoryUsage(self):
+        ## The size of the arrays in bytes (object arrays only count their pointers)
+        return self.keys.nbytes + self.values.nbytes + self.nulls.nbytes
+
+    def probe(self, keys):
+        ## Returns the index of every key in the lookup, or -1 if it is not found
+        keys, nulls = _compactArray(list(keys))
+        indexes = numpy.repeat(-1, len(keys))
+        if len(self.keys) == 0 or len(keys) == 0:
+            return indexes
+        ## Keys of a different type (e.g. text and numbers) never match
+        isText = [array.dtype.kind in "SU" for array in (self.keys, keys)]
+        if isText[0] != isText[1]:
+            return indexes
+        positions = numpy.clip(numpy.searchsorted(self.keys, keys), 0, len(self.keys) - 1)
+        found = (self.keys[positions] == keys) & ~nulls
+        indexes[found] = positions[found]
+        return indexes
+
+    def find(self, key):
+        ## Returns the index of a single key, or -1 if it is not found.  This is
+        ## a binary search of the keys without building any arrays, so it is
+        ## cheap enough to call once per row of a cursor.
+        if key == None or len(self.keys) == 0:
+            return -1
+        ## Keys of a different type (e.g. text and numbers) never match
+        if isinstance(key, basestring) != (self.keys.dtype.kind in "SU"):
+            return -1
+        position = int(self.keys.searchsorted(key))
+        if position < len(self.keys) and self.keys[position] == key:
+            return position
+        return -1
+
+    def row(self, index):
+        ## The values of a row as a tuple, with None for NULL values
+        values = self.values[index].tolist()
+        nulls = self.nulls[index]
+        return tuple(None if nulls[i] else value for i, value in enumerate(values))
+
+    def get(self, key, default = None):
+        index = self.find(key)
+        return self.row(index) if index >= 0 else default
+
+## ------------------------------------------------------------
+## Partitioned (grace) hash join
+## ------------------------------------------------------------
+## When the table is too large to hold in memory at once, both sides of the
+## join are split by a hash of the join key into partitions that are spilled to
+## temporary files, so that matching keys always end up in the same partition.
+## Each partition of the table is then loaded into a dictionary on its own and
+## probed with the same partition of the feature class.
+## https://en.wikipedia.org/wiki/Hash_join#Grace_hash_join
+## The feature class side only records the position, ObjectID and key of each
+## row, and rows whose key fails a Bloom filter of the table keys (i.e. that
+## cannot match) are not spilled at all.  The matches of every partition are
+## already in feature class order, so they are merged back together with
+## heapq.merge and applied in a single UpdateCursor pass.
+
+def _dumpBatch(spillFile, batch):
+    pickle.dump(batch, spillFile, pickle.HIGHEST_PROTOCOL)
+
+def _readBatches(path):
+    with open(path, "rb") as spillFile:
+        while True:
+            try:
+                batch = pickle.load(spillFile)
+            except EOFError:
+                return
+            for item in batch:
+                yield item
+
+## Counts of what a join did, returned by joinTableToFC when report = True:
+## "Matched"        Rows of the feature class with a matching key in the table
+## "Unmatched"      Rows of the feature class without one
+## "Updated"        Matched rows that were written
+## "Unchanged"      Matched rows that already held the joined values and were
+##                  not written (only with skipUnchanged = True)
+## "Duplicate Keys" Rows of the table whose key appears again later in the
+##                  table (the last of them is the one joined)
+def _newJoinReport():
+    return OrderedDict([("Matched", 0), ("Unmatched", 0), ("Updated", 0),
+                        ("Unchanged", 0), ("Duplicate Keys", 0)])
+
+## Returns a function for every field of fields in outputFC that converts a
+## value to what the field actually stores (or None if it is stored as is), so
+## that skipUnchanged compares like with like: Single (Float) fields only keep
+## single precision, and numeric fields with a scale (shapefiles and dBASE
+## tables) only keep that many decimals
+def _storedValueFunctions(outputFC, fields):
+    fieldObjects = dict((fieldObject.name.upper(), fieldObject) for fieldObject in describeDataset(outputFC, "FIELDS"))
+    functions = []
+    for field in fields:
+        fieldObject = fieldObjects.get(field.upper())
+        if fieldObject == None or fieldObject.type not in ["Single", "Double"]:
+            functions.append(None)
+        elif fieldObject.type == "Single":
+            functions.append(lambda value: float(numpy.float32(value)))
+        elif fieldObject.scale > 0:
+            functions.append(lambda value, scale = fieldObject.scale: round(value, scale))
+        else:
+            functions.append(None)
+    return functions
+
+## True if a row holds the joined values, comparing numbers as stored (see
+## _storedValueFunctions) when storedValues is given
+def _sameValues(current, joined, storedValues):
+    if storedValues == None:
+        return tuple(current) == tuple(joined)
+    for currentValue, joinedValue, storedValue in zip(current, joined, storedValues):
+        if storedValue != None and isinstance(currentValue, (int, long, float)) and \
+           isinstance(joinedValue, (int, long, float)):
+            if storedValue(currentValue) != storedValue(joinedValue):
+                return False
+        elif currentValue != joinedValue:
+            return False
+    return True
+
+## Writes the joined values (data) to the current row of an UpdateCursor whose
+## fields are the join field, the joined fields and OID@, unless skipUnchanged
+## is True and the row already holds those values (see _sameValues)
+def _updateJoinedRow(cursor, row, data, skipUnchanged, report, storedValues = None):
+    report["Matched"] += 1
+    if skipUnchanged == True and _sameValues(row[1:-1], data, storedValues):
+        report["Unchanged"] += 1
+        return
+    ## Concatenation of tuples explained:
+    ## http://stackoverflow.com/a/8538676/6214388
+    cursor.updateRow((row[0], ) + tuple(data) + (row[-1], ))
+    report["Updated"] += 1
+
+def _partitionIndexes(keys, partitionCount):
+    return (hashArray(valuesToArray(keys)) % numpy.uint64(partitionCount)).astype(numpy.int64)
+
+## Every partition has a spill file that stays open while the data set is
+## partitioned (and a run file that stays open while the runs are merged), and
+## the C runtime of Python 2.7 on Windows only allows 512 open files, so the
+## partitions of large tables hold more than chunkSize rows instead
+_maxPartitions = 256
+
+def _partitionCount(tableRowCount, chunkSize):
+    return min(_maxPartitions, max(1, int(math.ceil(tableRowCount / float(chunkSize)))))
+
+## An order-sensitive checksum of the ObjectIDs (oids) of the rows read from
+## position start on.  The checksums of consecutive chunks add up (modulo
+## 2 ** 64) to the checksum of the whole data set.
+def _oidChecksum(oids, start):
+    positions = numpy.arange(start, start + len(oids), dtype = numpy.uint64)
+    with numpy.errstate(over = "ignore"):
+        weights = positions * numpy.uint64(2) + numpy.uint64(1)
+        return int((hashArray(numpy.asarray(oids, dtype = numpy.float64)) * weights).sum(dtype = numpy.uint64))
+
+def partitionedJoin(inputTable, outputFC, tableFields, fcFields, chunkSize,
+                    spillFolder = None, skipUnchanged = False):
+    ## tableFields and fcFields start with the join field of each side, the
+    ## other fields of tableFields are written to the other fields of fcFields.
+    ## The number of partitions is chosen so that each partition of the table
+    ## holds about chunkSize rows (see _partitionCount).  Rows with a NULL key
+    ## never match.  The ObjectIDs of the feature class are checked before
+    ## anything is written, so a feature class that changed since it was
+    ## partitioned raises a RuntimeError without being modified.
+    ## Returns a join report (see _newJoinReport).
+    report = _newJoinReport()
+    tableRowCount = countFeatures(inputTable)
+    partitionCount = _partitionCount(tableRowCount, chunkSize)
+    keyFilter = bloomFilter(tableRowCount)
+
+    spillFolder = tempfile.mkdtemp(dir = spillFolder)
+    try:
+        tablePaths  = [os.path.join(spillFolder, "table_%s.pkl" % i) for i in range(partitionCount)]
+        fcPaths     = [os.path.join(spillFolder, "fc_%s.pkl" % i) for i in range(partitionCount)]
+        runPaths    = [os.path.join(spillFolder, "run_%s.pkl" % i) for i in range(partitionCount)]
+
+        ## Partition the table
+        spillFiles = [open(path, "wb") for path in tablePaths]
+        with arcpy.da.SearchCursor(inputTable, tableFields) as tableCursor:
+            for chunk in chunkIterable(tableCursor, chunkSize):
+                rows = [row for row in chunk if row[0] != None]
+                if len(rows) == 0:
+                    continue
+                keys = [row[0] for row in rows]
+                keyFilter.addMany(valuesToArray(keys))
+                partitions = _partitionIndexes(keys, partitionCount)
+                for partition in numpy.unique(partitions):
+                    _dumpBatch(spillFiles[partition], [rows[i] for i in numpy.flatnonzero(partitions == partition)])
+        for spillFile in spillFiles:
+            spillFile.close()
+
+        ## Partition the feature class rows that can match
+        spillFiles = [open(path, "wb") for path in fcPaths]
+        position = 0
+        fcChecksum = 0
+        with arcpy.da.SearchCursor(outputFC, ["OID@", fcFields[0]]) as fcCursor:
+            for chunk in chunkIterable(fcCursor, chunkSize):
+                rows = list(chunk)
+                fcChecksum = (fcChecksum + _oidChecksum([row[0] for row in rows], position)) % 2 ** 64
+                candidates = [(position + i, row[0], row[1]) for i, row in enumerate(rows) if row[1] != None]
+                position += len(rows)
+                if len(candidates) == 0:
+                    continue
+                keys = [candidate[2] for candidate in candidates]
+                candidateIndexes = numpy.flatnonzero(keyFilter.containsMany(valuesToArray(keys)))
+                if len(candidateIndexes) == 0:
+                    continue
+                partitions = _partitionIndexes([keys[i] for i in candidateIndexes], partitionCount)
+                for partition in numpy.unique(partitions):
+                    _dumpBatch(spillFiles[partition], [candidates[candidateIndexes[i]] for i in numpy.flatnonzero(partitions == partition)])
+        for spillFile in spillFiles:
+            spillFile.close()
+        fcRowCount = position
+
+        ## Join each pair of partitions in memory
+        for partition in range(partitionCount):
+            tableData = {}
+            partitionRowCount = 0
+            for row in _readBatches(tablePaths[partition]):
+                tableData[row[0]] = row[1:]
+                partitionRowCount += 1
+            report["Duplicate Keys"] += partitionRowCount - len(tableData)
+            os.remove(tablePaths[partition])
+
+            with open(runPaths[partition], "wb") as runFile:
+                matches = []
+                for position, oid, joinValue in _readBatches(fcPaths[partition]):
+                    if joinValue in tableData:
+                        matches.append((position, oid, tableData[joinValue]))
+                        if len(matches) >= 10000:
+                            _dumpBatch(runFile, matches)
+                            matches = []
+                _dumpBatch(runFile, matches)
+            os.remove(fcPaths[partition])
+            del tableData
+
+        ## The matches are applied by position, so make sure that the rows of
+        ## the feature class are still the ones that were partitioned
+        position = 0
+        checksum = 0
+        with arcpy.da.SearchCursor(outputFC, ["OID@"]) as fcCursor:
+            for chunk in chunkIterable(fcCursor, chunkSize):
+                oids = [row[0] for row in chunk]
+                checksum = (checksum + _oidChecksum(oids, position)) % 2 ** 64
+                position += len(oids)
+        if position != fcRowCount or checksum != fcChecksum:
+            raise RuntimeError("The rows of %s changed during the join" % outputFC)
+
+        ## Apply the matches in one pass over the feature class
+        storedValues = _storedValueFunctions(outputFC, fcFields[1:]) if skipUnchanged == True else None
+        matches = heapq.merge(*[_readBatches(path) for path in runPaths])
+        nextMatch = next(matches, None)
+        with arcpy.da.UpdateCursor(outputFC, fcFields + ["OID@"]) as fcCursor:
+            for position, row in enumerate(fcCursor):
+                if nextMatch == None:
+                    break
+                if nextMatch[0] == position:
+                    if row[-1] != nextMatch[1]:
+                        raise RuntimeError("The rows of %s changed during the join" % outputFC)
+                    _updateJoinedRow(fcCursor, row, nextMatch[2], skipUnchanged, report, storedValues)
+                    nextMatch = next(matches, None)
+
+    finally:
+        shutil.rmtree(spillFolder, ignore_errors = True)
+
+    report["Unmatched"] = fcRowCount - report["Matched"]
+    return report
+
+## ------------------------------------------------------------
+## Join planner
+## ------------------------------------------------------------
+## joinTableToFC can join in three ways:
+## "HASH"           The table is loaded into a dictionary of tuples keyed by the
+##                  join field.  The feature class is only read by the
+##                  UpdateCursor, but every value is a Python object.
+## "LOOKUP"         The table is loaded into a joinLookup (NumPy arrays), which
+##                  the UpdateCursor searches for the key of every row.
+## "PARTITIONED"    partitionedJoin, which holds about chunkSize rows of the
+##                  table at a time (more with over 256 partitions, see
+##                  _partitionCount) and spills the rest to disk.
+## planJoin estimates the peak memory of each from the row counts
+## (countFeatures), the types and lengths of the fields (ListFields) and the
+## share of distinct keys in the first sampleSize rows of the table, and picks
+## the first of them that fits in memoryLimit bytes (1 GB by default, which
+## leaves room in a 32 bit ArcMap process).  The estimates are deliberately
+## rough: text values are counted at their full field length and the distinct
+## keys of the sample are extrapolated linearly, so they err on the high side.
+
+## Approximate sizes in bytes of CPython 2 objects on a 64 bit build
+_tupleBytes         = 56
+_pointerBytes       = 8
+_dictEntryBytes     = 100
+_defaultMemoryLimit = 1024 ** 3
+_planChunkSize      = 500000
+
+def _pythonValueBytes(fieldObject):
+    if fieldObject.type == "String":
+        return 50 + 2 * fieldObject.length
+    elif fieldObject.type in ["SmallInteger", "Integer", "OID", "Single", "Double"]:
+        return 24
+    elif fieldObject.type == "Date":
+        return 48
+    return 64 + fieldObject.length
+
+## The size of a value in the arrays of a joinLookup (see _compactArray),
+## including its NULL flag
+def _compactValueBytes(fieldObject):
+    if fieldObject.type == "String":
+        return 4 * fieldObject.length + 1
+    elif fieldObject.type in ["SmallInteger", "Integer", "OID", "Single", "Double"]:
+        return 9
+    return _pointerBytes + _pythonValueBytes(fieldObject) + 1
+
+def planJoin(inputTable, inputFC, joinField, fields = "ALL", memoryLimit = None,
+             chunkSize = None, sampleSize = 10000, display = False):
+    ## joinField works the same way as in joinTableToFC and fields are the
+    ## fields of inputTable to join ("ALL" for all of them).  chunkSize fixes
+    ## the partition size of "PARTITIONED", otherwise the largest one that fits
+    ## in memoryLimit is used.
+    ## Returns an OrderedDict with the chosen "Strategy", the row counts, the
+    ## estimated number of distinct keys and, under "Strategies", the
+    ## "Estimated Memory" (bytes), the passes over the table and the feature
+    ## class, the rows read and the most rows written by each strategy.
+    if type(joinField) is str:
+        joinFieldTable  = joinField
+        joinFieldFC     = joinField
+    elif type(joinField) is list:
+        joinFieldTable  = joinField[0]
+        joinFieldFC     = joinField[1]
+    if fields == "ALL":
+        fields = [fieldName for fieldName in listFieldNames(inputTable) if fieldName.upper() != joinFieldTable.upper()]
+    if memoryLimit == None:
+        memoryLimit = _defaultMemoryLimit
+
+    tableRows = countFeatures(inputTable)
+    fcRows = countFeatures(inputFC)
+    tableKey = getFieldObject(inputTable, joinFieldTable)
+    fcKey = getFieldObject(inputFC, joinFieldFC)
+    fieldObjects = [getFieldObject(inputTable, fieldName) for fieldName in fields]
+
+    ## Share of NULL and of distinct keys in the first rows of the table
+    with arcpy.da.SearchCursor(inputTable, [joinFieldTable]) as cursor:
+        sample = [row[0] for row in next(chunkIterable(cursor, sampleSize), [])]
+    keys = [key for key in sample if key != None]
+    if len(sample) == tableRows:
+        keyRows = len(keys)
+        distinctKeys = len(set(keys))
+    elif len(keys) > 0:
+        keyRows = int(round(tableRows * len(keys) / float(len(sample))))
+        distinctKeys = int(round(keyRows * len(set(keys)) / float(len(keys))))
+    else:
+        keyRows = 0
+        distinctKeys = 0
+
+    ## A row as a tuple (the values only, or the key and the values as read by
+    ## a cursor) and as compact arrays
+    valueBytes = sum(_pythonValueBytes(fieldObject) for fieldObject in fieldObjects)
+    tupleBytes = _tupleBytes + _pointerBytes * len(fields) + valueBytes
+    cursorRowBytes = _tupleBytes + _pointerBytes * (len(fields) + 1) + _pythonValueBytes(tableKey) + valueBytes
+    fcCursorRowBytes = _tupleBytes + _pointerBytes * 2 + 24 + _pythonValueBytes(fcKey)
+    compactRowBytes = _compactValueBytes(tableKey) + sum(_compactValueBytes(fieldObject) for fieldObject in fieldObjects)
+
+    strategies = OrderedDict()
+    strategies["HASH"] = OrderedDict([
+        ("Estimated Memory", distinctKeys * (_dictEntryBytes + _pythonValueBytes(tableKey) + tupleBytes)),
+        ("Table Passes", 1), ("Feature Passes", 1),
+        ("Rows Read", tableRows + fcRows), ("Rows Written", fcRows)])
+    ## The chunks are concatenated and then sorted, so the arrays exist twice
+    ## while the lookup is built
+    strategies["LOOKUP"] = OrderedDict([
+        ("Estimated Memory", 2 * keyRows * (compactRowBytes + _pointerBytes) +
+                             min(_planChunkSize, tableRows) * cursorRowBytes),
+        ("Table Passes", 1), ("Feature Passes", 1),
+        ("Rows Read", tableRows + fcRows), ("Rows Written", fcRows)])
+    ## A partition is held as a dictionary while its rows are read back from
+    ## the spill file, next to the Bloom filter (about 1.2 bytes per key)
+    bloomBytes = int(math.ceil(keyRows * 1.2))
+    partitionRowBytes = _dictEntryBytes + 2 * cursorRowBytes + fcCursorRowBytes
+    if chunkSize == None:
+        chunkSize = int(max(1000, (memoryLimit - bloomBytes) // partitionRowBytes))
+        chunkSize = min(chunkSize, max(tableRows, 1))
+    partitions = _partitionCount(tableRows, chunkSize)
+    ## The feature class is read to partition it, to check its ObjectIDs
+    ## (only OID@) and by the UpdateCursor
+    strategies["PARTITIONED"] = OrderedDict([
+        ("Estimated Memory", int(math.ceil(max(keyRows, 1) / float(partitions))) * partitionRowBytes + bloomBytes),
+        ("Table Passes", 1), ("Feature Passes", 3),
+        ("Rows Read", tableRows + 3 * fcRows), ("Rows Written", fcRows),
+        ("Chunk Size", chunkSize),
+        ("Partitions", partitions),
+        ("Spill Bytes", keyRows * compactRowBytes + fcRows * (16 + _compactValueBytes(fcKey)))])
+
+    strategy = "PARTITIONED"
+    for name in ["HASH", "LOOKUP"]:
+        if strategies[name]["Estimated Memory"] <= memoryLimit:
+            strategy = name
+            break
+
+    plan = OrderedDict([("Strategy", strategy), ("Table Rows", tableRows), ("Feature Rows", fcRows),
+                        ("Estimated Distinct Keys", distinctKeys), ("Memory Limit", memoryLimit),
+                        ("Strategies", strategies)])
+
+    if display == True:
+        ezTable([[name] + [estimates[column] for column in ["Estimated Memory", "Table Passes", "Feature Passes", "Rows Read", "Rows Written"]]
+                 for name, estimates in strategies.items()],
+                ["Strategy", "Estimated Memory", "Table Passes", "Feature Passes", "Rows Read", "Rows Written"],
+                title = "Join plan: %s (%s table rows, %s feature rows, ~%s distinct keys)" % (strategy, tableRows, fcRows, distinctKeys))
+
+    return plan
+
+## strategy = "AUTO" picks "HASH", "LOOKUP" or "PARTITIONED" with planJoin
+##      (see above), or one of those can be given.  "HASH" loads the whole
+##      table into a dictionary keyed by the join field and "LOOKUP" into a
+##      joinLookup; both update the feature class in one UpdateCursor pass.
+## chunkSize = an integer limits memory use to about chunkSize rows of the
+##      table with partitionedJoin, which spills the partitions to temporary
+##      files in spillFolder (the system's temporary folder by default) and
+##      still updates the feature class in one UpdateCursor pass.  Giving a
+##      chunkSize with strategy = "AUTO" always uses "PARTITIONED".
+## memoryLimit = the bytes the join may use when planning (1 GB by default)
+## dryRun = True returns the plan of planJoin without joining anything
+## skipUnchanged = True compares the joined values with the values already in
+##      each matching row and only writes the rows that differ, so rerunning a
+##      join only writes what changed (Float and scaled numeric fields are
+##      compared at the precision they store)
+## report = True returns a join report (see _newJoinReport) instead of True
 def joinTableToFC(inputTable, inputFC, joinField,
                   outputFC = None, fieldMappings = "ALL",
-                  chunkSize = None):
+                  chunkSize = None, spillFolder = None,
+                  skipUnchanged = False, report = False,
+                  strategy = "AUTO", memoryLimit = None, dryRun = False):
 
     #timer = ezTimer()
 
@@ -80,15 +692,6 @@ def joinTableToFC(inputTable, inputFC, joinField,
 ##
 ##    timer.update("Creating fields for join data")
 
-    if outputFC == None:
-        outputFC = inputFC
-    ## This else might not actually work
-    else:
-        if arcpy.Describe(inputFC).dataType == "Table":
-            TableToTable(inputFC, outputFC)
-        else:
-            FCToFC(inputFC, outputFC)
-
     if fieldMappings <> "ALL":
         scFields = [joinFieldTable]
         ucFields = [joinFieldFC]
@@ -115,6 +718,28 @@ def joinTableToFC(inputTable, inputFC, joinField,
 ##    print scFields
 ##    print ucFields
                 
+    if strategy not in ["AUTO", "HASH", "LOOKUP", "PARTITIONED"]:
+        raise ValueError("strategy must be 'AUTO', 'HASH', 'LOOKUP' or 'PARTITIONED'")
+    if strategy == "AUTO" and chunkSize != None:
+        strategy = "PARTITIONED"
+    if strategy == "AUTO" or dryRun == True:
+        plan = planJoin(inputTableView, inputFC, [joinFieldTable, joinFieldFC], scFields[1:],
+                        memoryLimit, chunkSize)
+        if dryRun == True:
+            return plan
+        if strategy == "AUTO":
+            strategy = plan["Strategy"]
+            chunkSize = plan["Strategies"]["PARTITIONED"]["Chunk Size"]
+
+    if outputFC == None:
+        outputFC = inputFC
+    ## This else might not actually work
+    else:
+        if arcpy.Describe(inputFC).dataType == "Table":
+            TableToTable(inputFC, outputFC)
+        else:
+            FCToFC(inputFC, outputFC)
+
     ## Determine if the fields that are to be joined exist in the outputFC
     ## If they do not exist, create them
     ucExistingFields = listFieldNames(outputFC)
@@ -128,44 +753,240 @@ def joinTableToFC(inputTable, inputFC, joinField,
 
     
 
-    with arcpy.da.SearchCursor(inputTableView, scFields) as tableCursor:
-        
+    if strategy == "PARTITIONED":
         if chunkSize == None:
-            chunkSize = 10**9
-            
-        chunks = chunkIterable(tableCursor, chunkSize)
-        
-        for tableCursorChunk in chunks:
-            tableData = {}
-            
-            for row in tableCursorChunk:
-                joinValue    = row[0]
-                data         = row[1:]
-                tableData[joinValue] = data
-
-            #timer.update("Creating in-memory dictionary")
-
-            
-            
-            fcCursor = arcpy.da.UpdateCursor(outputFC, ucFields)
-            for row in fcCursor:
-                joinValue = row[0]
-                if joinValue in tableData:
-                    data = tableData[joinValue]
-                    ## Concatenation of tuples explained:
-                    ## http://stackoverflow.com/a/8538676/6214388
-                    updatedRow = (joinValue, ) + data
-##                    print ucFields
-##                    print updatedRow
-                    fcCursor.updateRow(updatedRow)
-            del fcCursor
-
-            #timer.update("Joining with update cursor")
-
-            #timer.report()
+            chunkSize = _planChunkSize
+        joinReport = partitionedJoin(inputTableView, outputFC, scFields, ucFields, chunkSize,
+                                     spillFolder, skipUnchanged)
+        return joinReport if report == True else True
+
+    joinReport = _newJoinReport()
+    storedValues = _storedValueFunctions(outputFC, ucFields[1:]) if skipUnchanged == True else None
+
+    if strategy == "HASH":
+        tableData = {}
+        tableRowCount = 0
+        with arcpy.da.SearchCursor(inputTableView, scFields) as tableCursor:
+            for row in tableCursor:
+                ## NULL keys never match
+                if row[0] != None:
+                    tableData[row[0]] = row[1:]
+                    tableRowCount += 1
+        joinReport["Duplicate Keys"] = tableRowCount - len(tableData)
+
+        fcCursor = arcpy.da.UpdateCursor(outputFC, ucFields + ["OID@"])
+        for row in fcCursor:
+            data = tableData.get(row[0]) if row[0] != None else None
+            if data != None:
+                _updateJoinedRow(fcCursor, row, data, skipUnchanged, joinReport, storedValues)
+            else:
+                joinReport["Unmatched"] += 1
+        del fcCursor
+
+        return joinReport if report == True else True
+
+    tableData = joinLookup(inputTableView, joinFieldTable, scFields[1:])
+    joinReport["Duplicate Keys"] = tableData.duplicateKeys
+
+    #timer.update("Creating in-memory lookup")
+
+    ## The key of every row is looked up as the rows are updated, so the
+    ## feature class is only read once
+    fcCursor = arcpy.da.UpdateCursor(outputFC, ucFields + ["OID@"])
+    for row in fcCursor:
+        index = tableData.find(row[0])
+        if index >= 0:
+            _updateJoinedRow(fcCursor, row, tableData.row(index), skipUnchanged, joinReport, storedValues)
+        else:
+            joinReport["Unmatched"] += 1
+    del fcCursor
+
+    #timer.update("Joining with update cursor")
+
+    #timer.report()
     
+    return joinReport if report == True else True
+
+## ------------------------------------------------------------
+## Aggregating (one-to-many) join
+## ------------------------------------------------------------
+## joinTableToFC expects one row of inputTable per key and keeps the last one.
+## aggregateTableToFC instead rolls up every row of inputTable (the children)
+## into the feature of inputFC (the parent) with the same key, for example jobs
+## by block summed into block groups, without creating a Summary Statistics
+## table first.  inputTable is streamed in chunks into a groupedStats object
+## (see ez.Stats), which keeps the statistics of every key in NumPy arrays,
+## and inputFC is then updated in a single UpdateCursor pass, which looks up
+## the statistics of the key of every feature as it goes.
+##
+## joinField works the same way as in joinTableToFC.  For every field and
+## statistic, inputFC gets a "<STAT>_<field>" field (like Summary Statistics):
+## "SUM", "MEAN", "MIN", "MAX", "STD" (population standard deviation) and
+## "COUNT" (the number of non-NULL values).  Parents without any children get
+## 0 for SUM and COUNT and NULL for the others.
+## report = True returns the number of parents with and without children and the
+## number of keys of inputTable without a parent instead of True.
+def aggregateTableToFC(inputTable, inputFC, joinField, fields, stats = ["SUM"],
+                       chunkSize = 500000, report = False):
+    if type(joinField) is str:
+        joinFieldTable  = joinField
+        joinFieldFC     = joinField
+    elif type(joinField) is list:
+        joinFieldTable  = joinField[0]
+        joinFieldFC     = joinField[1]
+    if type(fields) == str:
+        fields = [fields]
+    stats = [stat.upper() for stat in stats]
+    for stat in stats:
+        if stat not in ["COUNT", "SUM", "MEAN", "MIN", "MAX", "STD"]:
+            raise ValueError("stats must only contain 'COUNT', 'SUM', 'MEAN', 'MIN', 'MAX' or 'STD'")
+
+    children = groupedStats(len(fields))
+    for chunk in cursorChunks(inputTable, [joinFieldTable] + fields, chunkSize):
+        values = numpy.column_stack([chunk[field.upper()].astype(numpy.float64) for field in fields])
+        children.pushMany(chunk[joinFieldTable.upper()], values)
+
+    results = {"COUNT": children.count().astype(numpy.float64), "SUM": children.sum(), "MEAN": children.mean(),
+               "MIN": children.minimum(), "MAX": children.maximum(), "STD": children.stdDev(ddof = 0)}
+
+    ## One row of output values per group, in the order of the output fields
+    outputFields = []
+    countColumns = []
+    groupColumns = []
+    for i, field in enumerate(fields):
+        for stat in stats:
+            outputFields.append(["%s_%s" % (stat, field), "LONG" if stat == "COUNT" else "DOUBLE"])
+            countColumns.append(stat == "COUNT")
+            groupColumns.append(results[stat][:, i])
+    groupTable = numpy.column_stack(groupColumns) if len(children.keys) > 0 else numpy.zeros((0, len(groupColumns)))
+    noChildren = [0 if stat == "COUNT" else 0.0 if stat == "SUM" else None for field in fields for stat in stats]
+
+    existingFields = [fieldName.upper() for fieldName in listFieldNames(inputFC)]
+    addFields(inputFC, [outputField for outputField in outputFields if outputField[0].upper() not in existingFields])
+
+    ## Look up the group of every parent as it is updated; NULL keys never match
+    hasParent = numpy.zeros(len(children.keys), dtype = bool)
+    parentsWithChildren = 0
+    parentsWithoutChildren = 0
+    with arcpy.da.UpdateCursor(inputFC, [joinFieldFC] + [outputField[0] for outputField in outputFields]) as cursor:
+        for row in cursor:
+            group = children.groupIDs.get(row[0], -1) if row[0] != None else -1
+            if group >= 0:
+                values = [None if value != value else int(value) if isCount == True else value
+                          for value, isCount in zip(groupTable[group].tolist(), countColumns)]
+                hasParent[group] = True
+                parentsWithChildren += 1
+            else:
+                values = noChildren
+                parentsWithoutChildren += 1
+            cursor.updateRow([row[0]] + values)
+
+    if report == True:
+        return OrderedDict([("Parents With Children", parentsWithChildren),
+                            ("Parents Without Children", parentsWithoutChildren),
+                            ("Keys Without Parent", int((~hasParent).sum()) -
+                             (1 if None in children.groupIDs else 0))])
     return True
 
+## ------------------------------------------------------------
+## Nearest feature join
+## ------------------------------------------------------------
+## Joins the k nearest features of sourceFC (within maxDistance, if given) to
+## every feature of targetFC, like the Near and Spatial Join tools but in
+## memory: the locations (SHAPE@XY, i.e. the centroids of lines and polygons)
+## of sourceFC are read once into a scipy.spatial.cKDTree, the locations of
+## targetFC are read in chunks (in the coordinate system of sourceFC) and every
+## chunk is queried at once, and the results are written back in a single
+## UpdateCursor pass (see writeColumns in ez.Stats).
+## https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.cKDTree.query.html
+##
+## With k = 1, targetFC gets a NEAR_DIST field (the distance in the units of
+## the coordinate system of sourceFC), a NEAR_FID field (the ObjectID of the
+## nearest feature) and a NEAR_<field> field for each of fields, holding its
+## value in the nearest feature.  With k > 1, there is a set of these fields
+## for every neighbor, suffixed with _1 to _k.  Features without a neighbor
+## within maxDistance (or without a location) get NULLs.  Existing NEAR_ fields
+## with the same names (e.g. from a previous run) are overwritten.
+def nearestJoin(targetFC, sourceFC, k = 1, maxDistance = None, fields = [],
+                chunkSize = 500000):
+    if type(fields) == str:
+        fields = [fields]
+
+    ## Read the locations and fields of sourceFC
+    sourceOIDs = []
+    sourceXY = []
+    columnChunks = [[] for field in fields]
+    with arcpy.da.SearchCursor(sourceFC, ["OID@", "SHAPE@XY"] + fields) as cursor:
+        for chunk in chunkIterable(cursor, chunkSize):
+            rows = [row for row in chunk if row[1] != None and row[1][0] != None]
+            if len(rows) == 0:
+                continue
+            sourceOIDs.append(numpy.array([row[0] for row in rows], dtype = numpy.float64))
+            sourceXY.append(numpy.array([row[1] for row in rows], dtype = numpy.float64))
+            for i in range(len(fields)):
+                columnChunks[i].append(_compactArray([row[i + 2] for row in rows]))
+    if len(sourceOIDs) == 0:
+        raise ValueError("%s does not have any features with a location" % sourceFC)
+
+    sourceOIDs = numpy.concatenate(sourceOIDs)
+    sourceColumns = []
+    for chunks in columnChunks:
+        column = _concatenateChunks(chunks)
+        nulls = numpy.concatenate([chunkNulls for array, chunkNulls in chunks])
+        ## Numbers are written as floats with NaN for NULL, anything else as
+        ## objects with None for NULL (see writeColumns)
+        if column.dtype.kind in "biuf":
+            column = column.astype(numpy.float64)
+            column[nulls] = numpy.nan
+        else:
+            column = column.astype(object)
+            column[nulls] = None
+        ## The last element is used for features without a neighbor
+        sourceColumns.append(numpy.concatenate([column, numpy.array([numpy.nan if column.dtype.kind == "f" else None], dtype = column.dtype)]))
+    sourceOIDs = numpy.concatenate([sourceOIDs, [numpy.nan]])
+
+    tree = cKDTree(numpy.concatenate(sourceXY))
+    del sourceXY
+
+    ## Query the locations of targetFC a chunk at a time
+    k = min(k, tree.n)
+    upperBound = numpy.inf if maxDistance == None else maxDistance
+    oids = []
+    distances = []
+    neighbors = []
+    spatialReference = arcpy.Describe(sourceFC).spatialReference
+    with arcpy.da.SearchCursor(targetFC, ["OID@", "SHAPE@XY"], spatial_reference = spatialReference) as cursor:
+        for chunk in chunkIterable(cursor, chunkSize):
+            rows = list(chunk)
+            oids.append(numpy.array([row[0] for row in rows], dtype = numpy.int64))
+            xy = numpy.array([row[1] if row[1] != None and row[1][0] != None else (numpy.nan, numpy.nan)
+                              for row in rows], dtype = numpy.float64).reshape(-1, 2)
+            hasLocation = numpy.isfinite(xy).all(axis = 1)
+            chunkDistances = numpy.repeat(numpy.inf, len(rows) * k).reshape(-1, k)
+            chunkNeighbors = numpy.repeat(tree.n, len(rows) * k).reshape(-1, k)
+            if hasLocation.any():
+                queryDistances, queryNeighbors = tree.query(xy[hasLocation], k = k, distance_upper_bound = upperBound)
+                chunkDistances[hasLocation] = numpy.asarray(queryDistances).reshape(-1, k)
+                chunkNeighbors[hasLocation] = numpy.asarray(queryNeighbors).reshape(-1, k)
+            distances.append(chunkDistances)
+            neighbors.append(chunkNeighbors)
+
+    oids = numpy.concatenate(oids) if len(oids) > 0 else numpy.zeros(0, dtype = numpy.int64)
+    distances = numpy.concatenate(distances) if len(distances) > 0 else numpy.zeros((0, k))
+    neighbors = numpy.concatenate(neighbors) if len(neighbors) > 0 else numpy.zeros((0, k), dtype = numpy.int64)
+    distances[~numpy.isfinite(distances)] = numpy.nan
+
+    sourceFieldTypes = [fieldTypeKeyword(getFieldObject(sourceFC, field)) for field in fields]
+    outputColumns = []
+    for rank in range(k):
+        suffix = "" if k == 1 else "_%s" % (rank + 1)
+        outputColumns.append(["NEAR_DIST%s" % suffix, "DOUBLE", distances[:, rank]])
+        outputColumns.append(["NEAR_FID%s" % suffix, "LONG", sourceOIDs[neighbors[:, rank]]])
+        for field, fieldType, column in zip(fields, sourceFieldTypes, sourceColumns):
+            outputColumns.append(["NEAR_%s%s" % (field, suffix), fieldType, column[neighbors[:, rank]]])
+
+    return writeColumns(targetFC, oids, outputColumns)
+
 if __name__ == "__main__":
     
     
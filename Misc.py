@@ -2,6 +2,7 @@ import string
 import random
 import itertools
 import re
+import sys
 
 def pctDifference(x1, x2):
     return abs(x1 - x2) / ((x1 + x2) / 2)
@@ -45,6 +46,25 @@ def chunkIterable(iterable, chunkSize):
             return
         yield itertools.chain((first_el,), chunk_it)
 
+## Returns the peak memory use of this process in bytes, or None if it cannot
+## be determined.  The resource module only exists on Unix (where ru_maxrss is
+## in kilobytes, except on macOS where it is in bytes); on Windows the optional
+## psutil package reports the peak working set.
+## https://docs.python.org/2/library/resource.html
+## https://psutil.readthedocs.io/en/latest/#psutil.Process.memory_info
+def peakMemoryUsage():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    except ImportError:
+        return None
+
 # Adapted from http://stackoverflow.com/a/2130035
 def chunkList(seq, num):
     avg = len(seq) / float(num)
@@ -0,0 +1,360 @@
+from __future__ import division
+import re
+import numbers
+import numpy
+
+## This module evaluates SQL where clauses (the kind passed to
+## SelectLayerByAttribute or MakeFeatureLayer) against NumPy arrays.
+## This makes it possible to read the fields of a data set once and then
+## evaluate many queries against each chunk of rows as vectorized boolean
+## masks, instead of asking ArcGIS to scan the data set once per query.
+##
+## The supported subset of SQL is:
+##      Field names             POP10, "POP10", [POP10] (case-insensitive)
+##      Literals                12, -3.5, 1e6, 'text' ('' escapes a quote), NULL
+##      Arithmetic              + - * / and parentheses
+##      Comparisons             = <> != < <= > >=
+##      Predicates              IS [NOT] NULL, [NOT] IN (...),
+##                              [NOT] BETWEEN ... AND ..., [NOT] LIKE '...'
+##      Logic                   AND, OR, NOT
+## Anything else (functions, dates, subqueries) raises an UnsupportedQueryError
+## when the query is compiled.  Unlike a data source, comparisons never convert
+## between text and numbers (e.g. POP10 = '5'): comparing the two raises an
+## UnsupportedQueryError when the query is evaluated.  Either way, the query
+## can still be run by the data source (e.g. with SelectLayerByAttribute).
+##
+## NULLs follow SQL's three-valued logic: a comparison involving a NULL is
+## neither true nor false, and NOT of an unknown result is still unknown.
+## Internally every predicate is evaluated to a pair of boolean arrays
+## (isTrue, isFalse); rows where both are False are unknown.  A query
+## selects the rows where it is true, exactly like a where clause.
+
+## Raised for queries this module cannot evaluate.  It is a ValueError, so
+## existing code catching ValueError keeps working.
+class UnsupportedQueryError(ValueError):
+    pass
+
+_tokenPattern = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?) |
+        (?P<string>'(?:[^']|'')*') |
+        (?P<quoted>"[^"]+"|\[[^\]]+\]) |
+        (?P<name>[A-Za-z_][A-Za-z0-9_.]*) |
+        (?P<operator><>|!=|<=|>=|=|<|>|\(|\)|,|\+|-|\*|/)
+    )""", re.VERBOSE)
+
+_keywords = ["AND", "OR", "NOT", "IN", "BETWEEN", "IS", "NULL", "LIKE"]
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _tokenPattern.match(query, position)
+        if match == None or match.end() == position:
+            raise UnsupportedQueryError("Unable to parse the query at: %s" % query[position:])
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "number":
+            tokens.append(("LITERAL", float(text)))
+        elif kind == "string":
+            tokens.append(("LITERAL", text[1:-1].replace("''", "'")))
+        elif kind == "quoted":
+            tokens.append(("FIELD", text[1:-1]))
+        elif kind == "name":
+            if text.upper() in _keywords:
+                tokens.append((text.upper(), text))
+            else:
+                tokens.append(("FIELD", text))
+        else:
+            tokens.append((text, text))
+    tokens.append(("END", None))
+    return tokens
+
+def _isNull(values):
+    if values.dtype.kind == "f":
+        return numpy.isnan(values)
+    elif values.dtype.kind == "O":
+        return numpy.equal(values, None)
+    else:
+        return numpy.zeros(values.shape, dtype = bool)
+
+## Returns "NUMBER", "TEXT" or "OTHER" for the values of an array, or None
+## if they are all NULL
+def _valueKind(values):
+    if values.dtype.kind in "biuf":
+        return "NUMBER" if _isNull(values).all() == False else None
+    for value in values:
+        if value != None:
+            return "TEXT" if isinstance(value, basestring) else "OTHER"
+    return None
+
+def _compare(operator, left, right):
+    leftKind, rightKind = _valueKind(left), _valueKind(right)
+    if leftKind != None and rightKind != None and leftKind != rightKind:
+        raise UnsupportedQueryError("Unable to compare %s values with %s values" % (leftKind.lower(), rightKind.lower()))
+    ## Compares only the rows where neither side is NULL
+    valid = ~(_isNull(left) | _isNull(right))
+    result = numpy.zeros(valid.shape, dtype = bool)
+    leftValues, rightValues = left[valid], right[valid]
+    if operator == "=":
+        result[valid] = leftValues == rightValues
+    elif operator in ["<>", "!="]:
+        result[valid] = leftValues != rightValues
+    elif operator == "<":
+        result[valid] = leftValues < rightValues
+    elif operator == "<=":
+        result[valid] = leftValues <= rightValues
+    elif operator == ">":
+        result[valid] = leftValues > rightValues
+    elif operator == ">=":
+        result[valid] = leftValues >= rightValues
+    return result & valid, ~result & valid
+
+def _likeToRegex(pattern):
+    regex = ""
+    for character in pattern:
+        if character == "%":
+            regex += ".*"
+        elif character == "_":
+            regex += "."
+        else:
+            regex += re.escape(character)
+    return re.compile(regex + "$", re.DOTALL)
+
+class compiledQuery:
+
+    def __init__(self, query):
+        self.query = query
+        self.fields = []
+        if query == None or query.strip() == "":
+            self.root = None
+            return
+        self.tokens = _tokenize(query)
+        self.position = 0
+        self.root = self._parseOr()
+        if self._peek() != "END":
+            raise UnsupportedQueryError("Unexpected '%s' in query: %s" % (self.tokens[self.position][1], query))
+        del self.tokens
+
+    ## ------------------------------------------------------------
+    ## Recursive descent parser producing nested tuples
+    ## ------------------------------------------------------------
+    def _peek(self):
+        return self.tokens[self.position][0]
+
+    def _next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def _expect(self, kind):
+        token = self._next()
+        if token[0] != kind:
+            raise UnsupportedQueryError("Expected '%s' in query: %s" % (kind, self.query))
+        return token
+
+    def _parseOr(self):
+        node = self._parseAnd()
+        while self._peek() == "OR":
+            self._next()
+            node = ("OR", node, self._parseAnd())
+        return node
+
+    def _parseAnd(self):
+        node = self._parseNot()
+        while self._peek() == "AND":
+            self._next()
+            node = ("AND", node, self._parseNot())
+        return node
+
+    def _parseNot(self):
+        if self._peek() == "NOT":
+            self._next()
+            return ("NOT", self._parseNot())
+        return self._parsePredicate()
+
+    def _parsePredicate(self):
+        ## A parenthesis may start either a nested predicate or an arithmetic
+        ## expression, so try the predicate first and backtrack if needed
+        if self._peek() == "(":
+            start = self.position
+            self._next()
+            try:
+                node = self._parseOr()
+                self._expect(")")
+                if node[0] in ["OR", "AND", "NOT", "COMPARE", "ISNULL", "IN", "BETWEEN", "LIKE"]:
+                    return node
+            except UnsupportedQueryError:
+                pass
+            self.position = start
+
+        left = self._parseSum()
+        negate = False
+        if self._peek() == "NOT":
+            self._next()
+            negate = True
+
+        kind = self._peek()
+        if kind in ["=", "<>", "!=", "<", "<=", ">", ">="] and negate == False:
+            self._next()
+            return ("COMPARE", kind, left, self._parseSum())
+        elif kind == "IS" and negate == False:
+            self._next()
+            isNot = False
+            if self._peek() == "NOT":
+                self._next()
+                isNot = True
+            self._expect("NULL")
+            node = ("ISNULL", left)
+            return ("NOT", node) if isNot else node
+        elif kind == "IN":
+            self._next()
+            self._expect("(")
+            values = [self._parseSum()]
+            while self._peek() == ",":
+                self._next()
+                values.append(self._parseSum())
+            self._expect(")")
+            node = ("IN", left, values)
+        elif kind == "BETWEEN":
+            self._next()
+            lower = self._parseSum()
+            self._expect("AND")
+            upper = self._parseSum()
+            node = ("BETWEEN", left, lower, upper)
+        elif kind == "LIKE":
+            self._next()
+            pattern = self._expect("LITERAL")[1]
+            node = ("LIKE", left, _likeToRegex(pattern))
+        else:
+            raise UnsupportedQueryError("Expected a comparison in query: %s" % self.query)
+
+        return ("NOT", node) if negate else node
+
+    def _parseSum(self):
+        node = self._parseProduct()
+        while self._peek() in ["+", "-"]:
+            operator = self._next()[0]
+            node = ("ARITHMETIC", operator, node, self._parseProduct())
+        return node
+
+    def _parseProduct(self):
+        node = self._parseValue()
+        while self._peek() in ["*", "/"]:
+            operator = self._next()[0]
+            node = ("ARITHMETIC", operator, node, self._parseValue())
+        return node
+
+    def _parseValue(self):
+        kind, value = self._next()
+        if kind == "LITERAL":
+            return ("LITERAL", value)
+        elif kind == "NULL":
+            return ("LITERAL", None)
+        elif kind == "FIELD":
+            if value.upper() not in [field.upper() for field in self.fields]:
+                self.fields.append(value)
+            return ("FIELD", value.upper())
+        elif kind == "-":
+            return ("ARITHMETIC", "*", ("LITERAL", -1.0), self._parseValue())
+        elif kind == "(":
+            node = self._parseSum()
+            self._expect(")")
+            return node
+        raise UnsupportedQueryError("Unsupported SQL near '%s' in query: %s" % (value, self.query))
+
+    ## ------------------------------------------------------------
+    ## Evaluation
+    ## ------------------------------------------------------------
+    def _value(self, node, columns, n):
+        if node[0] == "LITERAL":
+            if node[1] == None:
+                return numpy.repeat(numpy.nan, n)
+            elif type(node[1]) == float:
+                return numpy.repeat(node[1], n)
+            array = numpy.empty(n, dtype = object)
+            array[:] = node[1]
+            return array
+        elif node[0] == "FIELD":
+            return columns[node[1]]
+        elif node[0] == "ARITHMETIC":
+            left = self._value(node[2], columns, n).astype(numpy.float64)
+            right = self._value(node[3], columns, n).astype(numpy.float64)
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                if node[1] == "+":
+                    result = left + right
+                elif node[1] == "-":
+                    result = left - right
+                elif node[1] == "*":
+                    result = left * right
+                elif node[1] == "/":
+                    result = left / right
+            ## Division by zero is NULL rather than infinite
+            result[~numpy.isfinite(result)] = numpy.nan
+            return result
+
+    def _truth(self, node, columns, n):
+        kind = node[0]
+        if kind == "AND":
+            leftTrue, leftFalse = self._truth(node[1], columns, n)
+            rightTrue, rightFalse = self._truth(node[2], columns, n)
+            return leftTrue & rightTrue, leftFalse | rightFalse
+        elif kind == "OR":
+            leftTrue, leftFalse = self._truth(node[1], columns, n)
+            rightTrue, rightFalse = self._truth(node[2], columns, n)
+            return leftTrue | rightTrue, leftFalse & rightFalse
+        elif kind == "NOT":
+            isTrue, isFalse = self._truth(node[1], columns, n)
+            return isFalse, isTrue
+        elif kind == "COMPARE":
+            return _compare(node[1], self._value(node[2], columns, n), self._value(node[3], columns, n))
+        elif kind == "ISNULL":
+            isNull = _isNull(self._value(node[1], columns, n))
+            return isNull, ~isNull
+        elif kind == "IN":
+            left = self._value(node[1], columns, n)
+            isTrue = numpy.zeros(n, dtype = bool)
+            for valueNode in node[2]:
+                isTrue |= _compare("=", left, self._value(valueNode, columns, n))[0]
+            isFalse = ~isTrue & ~_isNull(left)
+            return isTrue, isFalse
+        elif kind == "BETWEEN":
+            left = self._value(node[1], columns, n)
+            lowerTrue, lowerFalse = _compare(">=", left, self._value(node[2], columns, n))
+            upperTrue, upperFalse = _compare("<=", left, self._value(node[3], columns, n))
+            return lowerTrue & upperTrue, lowerFalse | upperFalse
+        elif kind == "LIKE":
+            values = self._value(node[1], columns, n)
+            valid = ~_isNull(values)
+            isTrue = numpy.zeros(n, dtype = bool)
+            isTrue[valid] = [node[2].match(value) != None for value in values[valid]]
+            return isTrue, ~isTrue & valid
+        raise UnsupportedQueryError("%s is not a predicate in query: %s" % (kind, self.query))
+
+    def __call__(self, columns):
+        ## columns is a dictionary of equally sized NumPy arrays keyed by the
+        ## upper case field name.  Numeric NULLs are NaN, other NULLs are None.
+        ## Returns a boolean array that is True where the query is true.
+        n = len(next(iter(columns.values())))
+        if self.root == None:
+            return numpy.ones(n, dtype = bool)
+        return self._truth(self.root, columns, n)[0]
+
+def compileQuery(query):
+    return compiledQuery(query)
+
+## Converts a list of values read with a cursor into a NumPy array suitable
+## for compiledQuery: numeric fields become float64 with NULLs as NaN, any other
+## field becomes an object array with NULLs as None.  Since all of the values of
+## a field share a type, the first non-NULL value decides.
+def valuesToArray(values):
+    for value in values:
+        if value != None:
+            if isinstance(value, numbers.Number):
+                return numpy.array(values, dtype = numpy.float64)
+            break
+    array = numpy.empty(len(values), dtype = object)
+    array[:] = values
+    return array
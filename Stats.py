@@ -1,49 +1,750 @@
 from __future__ import division
 import arcpy
 import os
-from copy import copy
+import math
+import time
+from collections import OrderedDict
+from bisect import bisect_right
 from ez.Misc import *
 ##from ez.Describe import *
 from ez.Table import *
-from scipy.stats import chi2_contingency
+from ez.Query import compileQuery, UnsupportedQueryError
+from scipy.stats import chi2_contingency, norm
+from scipy.spatial import cKDTree
+from scipy import sparse
 from numpy import percentile
+import numpy
 
-## This class is from https://github.com/liyanage/python-modules/blob/master/running_stats.py
-## It was originally based on http://www.johndcook.com/standard_deviation.html
+## This class was originally from https://github.com/liyanage/python-modules/blob/master/running_stats.py
+## which was based on http://www.johndcook.com/standard_deviation.html
+## It has since been extended to also track the third and fourth central moments
+## (for skewness and kurtosis) along with the minimum, maximum and sum.
+## Values can be pushed one at a time (push) or as a whole NumPy array (pushMany).
+## pushMany reduces the batch with NumPy and then merges it into the running
+## moments, and merge combines two runningStats objects the same way.  This is
+## the parallel algorithm of Chan et al. generalized to higher moments by Pebay:
+## https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+## https://prod-ng.sandia.gov/techlib-noauth/access-control.cgi/2008/086212.pdf
+## Since merging is exact, partial runningStats built on chunks of a data set or
+## by separate worker processes can be combined into the statistics of the whole.
 class runningStats:
 
     def __init__(self):
-        self.n = 0
-        self.old_m = 0
-        self.new_m = 0
-        self.old_s = 0
-        self.new_s = 0
+        self.clear()
     
     def clear(self):
         self.n = 0
+        self.m1 = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.total = 0.0
+        self.minValue = None
+        self.maxValue = None
         
     def push(self, x):
+        n1 = self.n
         self.n += 1
-        
-        if self.n == 1:
-            self.old_m = self.new_m = x
-            self.old_s = 0
-        else:
-            self.new_m = self.old_m + (x - self.old_m) / self.n
-            self.new_s = self.old_s + (x - self.old_m) * (x - self.new_m)
-            
-            self.old_m = self.new_m
-            self.old_s = self.new_s
+        n = self.n
+
+        delta = x - self.m1
+        deltaN = delta / n
+        deltaN2 = deltaN * deltaN
+        term1 = delta * deltaN * n1
+
+        self.m1 += deltaN
+        self.m4 += term1 * deltaN2 * (n * n - 3 * n + 3) + 6 * deltaN2 * self.m2 - 4 * deltaN * self.m3
+        self.m3 += term1 * deltaN * (n - 2) - 3 * deltaN * self.m2
+        self.m2 += term1
+
+        self.total += x
+        if self.minValue == None or x < self.minValue:
+            self.minValue = x
+        if self.maxValue == None or x > self.maxValue:
+            self.maxValue = x
+
+    def pushMany(self, values):
+        ## NaN values (i.e. NULLs read into a float array) are skipped
+        values = numpy.asarray(values, dtype = numpy.float64).ravel()
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+
+        batch = runningStats()
+        batch.n = len(values)
+        batch.m1 = values.mean()
+        deviations = values - batch.m1
+        squaredDeviations = deviations * deviations
+        batch.m2 = squaredDeviations.sum()
+        batch.m3 = (squaredDeviations * deviations).sum()
+        batch.m4 = (squaredDeviations * squaredDeviations).sum()
+        batch.total = values.sum()
+        batch.minValue = values.min()
+        batch.maxValue = values.max()
+
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.m1, self.m2, self.m3, self.m4 = other.n, other.m1, other.m2, other.m3, other.m4
+            self.total, self.minValue, self.maxValue = other.total, other.minValue, other.maxValue
+            return self
+
+        nA, nB = self.n, other.n
+        n = nA + nB
+        delta = other.m1 - self.m1
+        delta2 = delta * delta
+
+        m1 = self.m1 + delta * nB / n
+        m2 = self.m2 + other.m2 + delta2 * nA * nB / n
+        m3 = (self.m3 + other.m3 + delta2 * delta * nA * nB * (nA - nB) / (n * n) +
+              3 * delta * (nA * other.m2 - nB * self.m2) / n)
+        m4 = (self.m4 + other.m4 + delta2 * delta2 * nA * nB * (nA * nA - nA * nB + nB * nB) / (n * n * n) +
+              6 * delta2 * (nA * nA * other.m2 + nB * nB * self.m2) / (n * n) +
+              4 * delta * (nA * other.m3 - nB * self.m3) / n)
+
+        self.n, self.m1, self.m2, self.m3, self.m4 = n, m1, m2, m3, m4
+        self.total += other.total
+        self.minValue = min(self.minValue, other.minValue)
+        self.maxValue = max(self.maxValue, other.maxValue)
+        return self
 
     def mean(self):
-        return self.new_m if self.n else 0.0
+        return self.m1 if self.n else 0.0
     
-    def variance(self):
-        return self.new_s / (self.n - 1) if self.n > 1 else 0.0
+    ## ddof = 1 is the sample variance, ddof = 0 the population variance
+    def variance(self, ddof = 1):
+        return self.m2 / (self.n - ddof) if self.n > ddof else 0.0
         
-    def stdDev(self):
-        return math.sqrt(self.variance())
+    def stdDev(self, ddof = 1):
+        return math.sqrt(self.variance(ddof))
+
+    def sum(self):
+        return self.total
+
+    def minimum(self):
+        return self.minValue
+
+    def maximum(self):
+        return self.maxValue
+
+    ## Population (biased) skewness, the same as scipy.stats.skew
+    def skewness(self):
+        return math.sqrt(self.n) * self.m3 / self.m2 ** 1.5 if self.m2 > 0 else 0.0
+
+    ## Population (biased) excess kurtosis, the same as scipy.stats.kurtosis
+    def kurtosis(self):
+        return self.n * self.m4 / (self.m2 * self.m2) - 3.0 if self.m2 > 0 else 0.0
+
+## Times runningStats.pushMany (and merge) on batches of random values and
+## compares the results with NumPy computed over all of the values at once
+def benchmarkRunningStats(batchSize = 10 ** 6, batches = 10, display = True):
+    randomState = numpy.random.RandomState(0)
+    data = randomState.lognormal(size = (batches, batchSize))
+
+    stats = runningStats()
+    reportData = []
+    for batch in data:
+        startTime = time.time()
+        stats.pushMany(batch)
+        reportData.append(["pushMany", batchSize, "%.1f" % ((time.time() - startTime) * 1000)])
+
+    startTime = time.time()
+    half = runningStats()
+    half.pushMany(data[:batches // 2])
+    otherHalf = runningStats()
+    otherHalf.pushMany(data[batches // 2:])
+    half.merge(otherHalf)
+    reportData.append(["2 x pushMany + merge", batchSize * batches, "%.1f" % ((time.time() - startTime) * 1000)])
+
+    reportData.append(["Mean error vs NumPy", "", abs(stats.mean() - data.mean())])
+    reportData.append(["StdDev error vs NumPy", "", abs(stats.stdDev(0) - data.std())])
+
+    return ezTable(reportData, ["Step", "Values", "Milliseconds"], title = "runningStats benchmark",
+                   display = display)
+
+## This class keeps the count, sum, mean, sum of squared deviations, minimum and
+## maximum of several value fields for every distinct value of a group key,
+## i.e. a runningStats for every group, with whole chunks of rows pushed at once.
+## The group keys of each chunk are factorized (numpy.unique) into integer group
+## IDs, which are assigned in order of first appearance and kept in self.keys.
+## The counts, sums and squared deviations of the chunk are computed for every
+## group at once with numpy.bincount, the minimum and maximum with
+## numpy.minimum/maximum.reduceat over the rows sorted by group, and the chunk
+## is then merged into the running values with the parallel algorithm of Chan
+## et al. (see runningStats).  Two groupedStats can be merged the same way.
+## NULL group keys (None or NaN) form a group with the key None, and NULL
+## values (NaN) are skipped.
+class groupedStats:
+
+    def __init__(self, fieldCount):
+        self.fieldCount = fieldCount
+        self.keys = []
+        self.groupIDs = {}
+        self.frequency = numpy.zeros(0, dtype = numpy.int64)
+        self.n = numpy.zeros((0, fieldCount))
+        self.m1 = numpy.zeros((0, fieldCount))
+        self.m2 = numpy.zeros((0, fieldCount))
+        self.total = numpy.zeros((0, fieldCount))
+        self.minValue = numpy.zeros((0, fieldCount))
+        self.maxValue = numpy.zeros((0, fieldCount))
+
+    def _addGroups(self, keys):
+        ## Returns the group IDs of a list of keys, adding the new ones
+        ids = []
+        for key in keys:
+            if key not in self.groupIDs:
+                self.groupIDs[key] = len(self.keys)
+                self.keys.append(key)
+            ids.append(self.groupIDs[key])
+
+        added = len(self.keys) - len(self.frequency)
+        if added > 0:
+            self.frequency = numpy.concatenate([self.frequency, numpy.zeros(added, dtype = numpy.int64)])
+            for name, fill in [("n", 0.0), ("m1", 0.0), ("m2", 0.0), ("total", 0.0),
+                               ("minValue", numpy.inf), ("maxValue", -numpy.inf)]:
+                setattr(self, name, numpy.concatenate([getattr(self, name), numpy.repeat(fill, added * self.fieldCount).reshape(added, self.fieldCount)]))
+        return numpy.array(ids, dtype = numpy.int64)
+
+    def factorize(self, keys):
+        keys = numpy.asarray(keys)
+        if keys.dtype.kind == "f":
+            isNull = numpy.isnan(keys)
+        elif keys.dtype.kind == "O":
+            isNull = numpy.equal(keys, None)
+        else:
+            isNull = numpy.zeros(len(keys), dtype = bool)
+
+        ids = numpy.zeros(len(keys), dtype = numpy.int64)
+        if isNull.all() == False:
+            ## numpy.array turns an object array of strings (or dates) into an
+            ## array numpy.unique can sort
+            uniqueKeys, inverse = numpy.unique(numpy.array(keys[~isNull].tolist()), return_inverse = True)
+            ids[~isNull] = self._addGroups(uniqueKeys.tolist())[inverse]
+        if isNull.any():
+            ids[isNull] = self._addGroups([None])[0]
+        return ids
+
+    def pushMany(self, keys, values):
+        ## keys is an array of group keys and values is a (rows x fieldCount)
+        ## array of float values (or a 1-D array when there is a single field)
+        values = numpy.asarray(values, dtype = numpy.float64).reshape(len(keys), self.fieldCount)
+        if len(keys) == 0:
+            return
+        ids = self.factorize(keys)
+        groupCount = len(self.keys)
+
+        batch = groupedStats(self.fieldCount)
+        batch.keys, batch.groupIDs = self.keys, self.groupIDs
+        batch.frequency = numpy.bincount(ids, minlength = groupCount)
+        batch.n = numpy.zeros((groupCount, self.fieldCount))
+        batch.m1 = numpy.zeros((groupCount, self.fieldCount))
+        batch.m2 = numpy.zeros((groupCount, self.fieldCount))
+        batch.total = numpy.zeros((groupCount, self.fieldCount))
+        batch.minValue = numpy.repeat(numpy.inf, groupCount * self.fieldCount).reshape(groupCount, self.fieldCount)
+        batch.maxValue = numpy.repeat(-numpy.inf, groupCount * self.fieldCount).reshape(groupCount, self.fieldCount)
+
+        order = numpy.argsort(ids, kind = "mergesort")
+        sortedIDs = ids[order]
+        starts = numpy.concatenate([[0], numpy.flatnonzero(sortedIDs[1:] != sortedIDs[:-1]) + 1])
+        presentIDs = sortedIDs[starts]
+
+        for i in range(self.fieldCount):
+            column = values[:, i]
+            valid = ~numpy.isnan(column)
+            batch.n[:, i] = numpy.bincount(ids[valid], minlength = groupCount)
+            batch.total[:, i] = numpy.bincount(ids[valid], weights = column[valid], minlength = groupCount)
+            with numpy.errstate(divide = "ignore", invalid = "ignore"):
+                batch.m1[:, i] = numpy.where(batch.n[:, i] > 0, batch.total[:, i] / batch.n[:, i], 0.0)
+            deviations = column[valid] - batch.m1[ids[valid], i]
+            batch.m2[:, i] = numpy.bincount(ids[valid], weights = deviations * deviations, minlength = groupCount)
+
+            sortedColumn = column[order]
+            isNaN = numpy.isnan(sortedColumn)
+            batch.minValue[presentIDs, i] = numpy.minimum.reduceat(numpy.where(isNaN, numpy.inf, sortedColumn), starts)
+            batch.maxValue[presentIDs, i] = numpy.maximum.reduceat(numpy.where(isNaN, -numpy.inf, sortedColumn), starts)
+
+        self._mergeArrays(numpy.arange(groupCount), batch)
+
+    def _mergeArrays(self, ids, other):
+        ## Merges the arrays of other into the rows ids of this object
+        nA, nB = self.n[ids], other.n
+        n = nA + nB
+        delta = other.m1 - self.m1[ids]
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            m1 = numpy.where(n > 0, self.m1[ids] + delta * nB / n, 0.0)
+            m2 = numpy.where(n > 0, self.m2[ids] + other.m2 + delta * delta * nA * nB / n, 0.0)
+        self.n[ids], self.m1[ids], self.m2[ids] = n, m1, m2
+        self.frequency[ids] += other.frequency
+        self.total[ids] += other.total
+        self.minValue[ids] = numpy.minimum(self.minValue[ids], other.minValue)
+        self.maxValue[ids] = numpy.maximum(self.maxValue[ids], other.maxValue)
+
+    def merge(self, other):
+        if other.fieldCount != self.fieldCount:
+            raise ValueError("only groupedStats of the same number of fields can be merged")
+        if len(other.keys) > 0:
+            self._mergeArrays(self._addGroups(other.keys), other)
+        return self
+
+    ## Each of the following returns a (groups x fieldCount) array in the
+    ## order of self.keys.  Groups without any values get NaN, except for the
+    ## count and the sum, which are 0.
+    def count(self):
+        return self.n.astype(numpy.int64)
+
+    def sum(self):
+        return self.total.copy()
+
+    def mean(self):
+        return numpy.where(self.n > 0, self.m1, numpy.nan)
+
+    ## ddof = 1 is the sample variance, ddof = 0 the population variance
+    def variance(self, ddof = 1):
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            return numpy.where(self.n > ddof, self.m2 / (self.n - ddof), numpy.nan)
+
+    def stdDev(self, ddof = 1):
+        return numpy.sqrt(self.variance(ddof))
+
+    def minimum(self):
+        return numpy.where(self.n > 0, self.minValue, numpy.nan)
+
+    def maximum(self):
+        return numpy.where(self.n > 0, self.maxValue, numpy.nan)
+
+## This class keeps the means and the co-moment matrix (the sum of the products
+## of deviations from the means) of several variables, from which their
+## covariance and Pearson correlation matrices follow.  Memory use is O(k ** 2)
+## for k variables regardless of the number of rows pushed.
+## Like runningStats, each batch of rows is reduced with NumPy (a single matrix
+## product) and merged into the running values with the pairwise update of
+## Chan et al. extended to co-moments:
+## https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Covariance
+## so partial results from chunks or worker processes can be merged exactly.
+## Rows can be weighted (for example by population); the weights are treated
+## as frequencies, so a weight of 2 counts the same as two rows.
+## Rows with a NULL (NaN) in any variable or in the weight are skipped.
+class runningCovariance:
+
+    def __init__(self, k):
+        self.k = k
+        self.n = 0
+        self.totalWeight = 0.0
+        self.means = numpy.zeros(k)
+        self.coMoments = numpy.zeros((k, k))
+
+    def pushMany(self, values, weights = None):
+        ## values is a (rows x k) array
+        values = numpy.asarray(values, dtype = numpy.float64).reshape(-1, self.k)
+        valid = ~numpy.isnan(values).any(axis = 1)
+        if weights is not None:
+            weights = numpy.asarray(weights, dtype = numpy.float64).ravel()
+            valid &= ~numpy.isnan(weights)
+            weights = weights[valid]
+        values = values[valid]
+        if len(values) == 0:
+            return
+
+        batch = runningCovariance(self.k)
+        batch.n = len(values)
+        if weights is None:
+            batch.totalWeight = float(len(values))
+            batch.means = values.mean(axis = 0)
+            deviations = values - batch.means
+            batch.coMoments = numpy.dot(deviations.T, deviations)
+        else:
+            batch.totalWeight = weights.sum()
+            if batch.totalWeight == 0:
+                return
+            batch.means = numpy.dot(weights, values) / batch.totalWeight
+            deviations = values - batch.means
+            batch.coMoments = numpy.dot(deviations.T * weights, deviations)
+
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError("only runningCovariance objects with the same number of variables can be merged")
+        if other.totalWeight == 0:
+            return self
+        if self.totalWeight == 0:
+            self.n, self.totalWeight = other.n, other.totalWeight
+            self.means, self.coMoments = other.means.copy(), other.coMoments.copy()
+            return self
+
+        totalWeight = self.totalWeight + other.totalWeight
+        delta = other.means - self.means
+        self.coMoments = self.coMoments + other.coMoments + numpy.outer(delta, delta) * self.totalWeight * other.totalWeight / totalWeight
+        self.means = self.means + delta * other.totalWeight / totalWeight
+        self.totalWeight = totalWeight
+        self.n += other.n
+        return self
+
+    def mean(self):
+        return self.means.copy()
+
+    ## ddof = 1 is the sample covariance, ddof = 0 the population covariance
+    def covariance(self, ddof = 1):
+        if self.totalWeight <= ddof:
+            return numpy.repeat(numpy.nan, self.k * self.k).reshape(self.k, self.k)
+        return self.coMoments / (self.totalWeight - ddof)
+
+    ## Pearson correlation coefficients; NaN for a variable with no variance
+    def correlation(self):
+        standardDeviations = numpy.sqrt(numpy.diag(self.coMoments))
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            correlations = self.coMoments / numpy.outer(standardDeviations, standardDeviations)
+        correlations = numpy.clip(correlations, -1, 1)
+        numpy.fill_diagonal(correlations, numpy.where(standardDeviations > 0, 1.0, numpy.nan))
+        return correlations
+
+## Hashes the values of a NumPy array to 64-bit unsigned integers.
+## Numbers are hashed by the bits of their float64 representation (so 1 and 1.0
+## hash the same) and strings by an FNV-1a hash of their non-zero bytes (so the
+## width of the string dtype does not matter).  Every hash is then scrambled with
+## the splitmix64 finalizer so that all of its bits are well distributed.
+## http://www.isthe.com/chongo/tech/comp/fnv/
+## http://xoshiro.di.unimi.it/splitmix64.c
+def hashArray(values):
+    values = numpy.asarray(values)
+    if values.dtype.kind == "O":
+        values = numpy.array(values.tolist())
+    with numpy.errstate(over = "ignore"):
+        if values.dtype.kind in "SU":
+            byteColumns = numpy.ascontiguousarray(values).view(numpy.uint8).reshape(len(values), -1)
+            hashes = numpy.repeat(numpy.uint64(14695981039346656037), len(values))
+            for i in range(byteColumns.shape[1]):
+                byteColumn = byteColumns[:, i].astype(numpy.uint64)
+                hashes = numpy.where(byteColumn != 0, (hashes ^ byteColumn) * numpy.uint64(1099511628211), hashes)
+        else:
+            hashes = numpy.ascontiguousarray(values.astype(numpy.float64)).view(numpy.uint64)
+
+        hashes = hashes + numpy.uint64(0x9E3779B97F4A7C15)
+        hashes = (hashes ^ (hashes >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        hashes = (hashes ^ (hashes >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+        hashes = hashes ^ (hashes >> numpy.uint64(31))
+    return hashes
+
+## This class estimates the number of distinct values in a stream using
+## a fixed amount of memory (2 ** precision bytes)
+## It is an implementation of the HyperLogLog algorithm:
+## http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+## with the small range correction described there.  With 64-bit hashes the
+## large range correction is unnecessary.  The relative standard error of the
+## estimate is about 1.04 / sqrt(2 ** precision), i.e. 0.8% for precision = 14.
+## Sketches with the same precision can be merged, so a data set can be split
+## into chunks (or processed by several workers) and the sketches combined.
+class hyperLogLog:
+
+    def __init__(self, precision = 14):
+        if precision < 4 or precision > 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.m = 2 ** precision
+        self.registers = numpy.zeros(self.m, dtype = numpy.uint8)
+
+    def push(self, x):
+        self.pushMany([x])
+
+    def pushMany(self, values):
+        hashes = hashArray(values)
+        if len(hashes) == 0:
+            return
+
+        p = numpy.uint64(self.precision)
+        registerIndexes = (hashes >> numpy.uint64(64 - self.precision)).astype(numpy.intp)
+        remainder = hashes << p
+
+        ## Count the leading zeros of the remaining bits with a binary search
+        leadingZeros = numpy.zeros(len(hashes), dtype = numpy.uint8)
+        for shift in (32, 16, 8, 4, 2, 1):
+            isSmall = remainder < numpy.uint64(2 ** (64 - shift))
+            leadingZeros += numpy.where(isSmall, shift, 0).astype(numpy.uint8)
+            remainder = numpy.where(isSmall, remainder << numpy.uint64(shift), remainder)
+
+        ranks = numpy.minimum(leadingZeros + 1, 64 - self.precision + 1).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, registerIndexes, ranks)
 
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("only sketches with the same precision can be merged")
+        self.registers = numpy.maximum(self.registers, other.registers)
+        return self
+
+    def count(self):
+        if self.m == 16:
+            alpha = 0.673
+        elif self.m == 32:
+            alpha = 0.697
+        elif self.m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / self.m)
+
+        estimate = alpha * self.m ** 2 / numpy.sum(2.0 ** -self.registers.astype(numpy.float64))
+        emptyRegisters = numpy.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * self.m and emptyRegisters > 0:
+            estimate = self.m * numpy.log(self.m / emptyRegisters)
+
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+## This class is a Bloom filter: a fixed size bit array that answers whether a
+## value might have been added (with a false positive rate of about errorRate)
+## or definitely was not.  It is used to skip values that cannot match before
+## doing more expensive work, such as spilling them to disk in a join.
+## https://en.wikipedia.org/wiki/Bloom_filter
+## The number of bits and hash functions are chosen for capacity values.
+## The hash functions are derived from the two 32-bit halves of hashArray
+## (h1 + i * h2), as described by Kirsch and Mitzenmacher:
+## https://www.eecs.harvard.edu/~michaelm/postscripts/rsa2008.pdf
+## Values are hashed the same way as hashArray, so 1 and 1.0 are the same value.
+## The bits are packed eight to a byte (bit i is bit i % 8 of byte i // 8).
+class bloomFilter:
+
+    def __init__(self, capacity, errorRate = 0.01):
+        capacity = max(1, capacity)
+        self.bitCount = max(64, int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2)))
+        self.hashCount = max(1, int(round(self.bitCount / capacity * math.log(2))))
+        self.bits = numpy.zeros((self.bitCount + 7) // 8, dtype = numpy.uint8)
+
+    def _positions(self, values):
+        hashes = hashArray(values)
+        low = (hashes & numpy.uint64(0xFFFFFFFF)).astype(numpy.int64)
+        high = (hashes >> numpy.uint64(32)).astype(numpy.int64) | 1
+        return [(low + i * high) % self.bitCount for i in range(self.hashCount)]
+
+    def add(self, x):
+        self.addMany([x])
+
+    def addMany(self, values):
+        if len(values) == 0:
+            return
+        ## Several positions can fall in the same byte, so their masks are
+        ## combined per byte before being set
+        positions = numpy.unique(numpy.concatenate(self._positions(values)))
+        byteIndexes = positions >> 3
+        masks = numpy.left_shift(1, positions & 7).astype(numpy.uint8)
+        starts = numpy.flatnonzero(numpy.concatenate([[True], byteIndexes[1:] != byteIndexes[:-1]]))
+        self.bits[byteIndexes[starts]] |= numpy.bitwise_or.reduceat(masks, starts)
+
+    def contains(self, x):
+        return bool(self.containsMany([x])[0])
+
+    ## Returns a boolean array, False for the values that were never added
+    def containsMany(self, values):
+        result = numpy.ones(len(values), dtype = bool)
+        if len(values) == 0:
+            return result
+        for positions in self._positions(values):
+            result &= ((self.bits[positions >> 3] >> (positions & 7)) & 1).astype(bool)
+        return result
+
+    def merge(self, other):
+        if other.bitCount != self.bitCount or other.hashCount != self.hashCount:
+            raise ValueError("only filters of the same size can be merged")
+        self.bits |= other.bits
+        return self
+
+
+## Reads the ObjectIDs and the specified numeric columns of a data set in a
+## single cursor pass.  Returns the ObjectIDs and an OrderedDict of float64
+## arrays (NULLs as NaN) keyed by column name, all in cursor order.
+def readColumns(inputFC, columns, chunkSize = 500000):
+    ## Imported here because ez.Describe imports this module
+    from ez.Describe import cursorChunks
+
+    oids = []
+    values = OrderedDict((column, []) for column in columns)
+    for chunk in cursorChunks(inputFC, ["OID@"] + list(columns), chunkSize):
+        oids.append(chunk["OID@"].astype(numpy.int64))
+        for column in columns:
+            values[column].append(chunk[column.upper()].astype(numpy.float64))
+
+    if len(oids) == 0:
+        return numpy.zeros(0, dtype = numpy.int64), OrderedDict((column, numpy.zeros(0)) for column in columns)
+
+    for column in columns:
+        values[column] = numpy.concatenate(values[column])
+    return numpy.concatenate(oids), values
+
+## Converts the values of output columns (see writeColumns) to the Python
+## values written by a cursor, one block of rows at a time, so that only a block
+## of every column exists as Python objects: NaN becomes None and the values of
+## SHORT and LONG fields become ints.
+class columnBlocks:
+
+    def __init__(self, outputColumns, blockSize = 10000):
+        self.columns = [(values, fieldType.upper() in ["SHORT", "LONG"])
+                        for fieldName, fieldType, values in outputColumns]
+        self.blockSize = blockSize
+        self.start = None
+        self.rows = None
+
+    def row(self, position):
+        if self.start == None or not self.start <= position < self.start + self.blockSize:
+            self.start = position - position % self.blockSize
+            blockColumns = []
+            for values, isInteger in self.columns:
+                block = values[self.start:self.start + self.blockSize].tolist()
+                if isInteger == True:
+                    blockColumns.append([None if value != value else int(value) for value in block])
+                else:
+                    blockColumns.append([None if value != value else value for value in block])
+            self.rows = zip(*blockColumns)
+        return list(self.rows[position - self.start])
+
+## Writes derived columns back to a data set in a single UpdateCursor pass.
+## outputColumns is a list of [fieldName, fieldType, values] where values is
+## an array aligned with oids (as returned by readColumns) and NaN is written
+## as NULL.  Any fields that do not exist yet are added first with addFields,
+## which is a single Add Fields call on ArcGIS Pro but still one Add Field call
+## per field on ArcMap (see addFields).  Rows whose ObjectID is not in oids
+## (e.g. added after the columns were read) are left as they are.
+## When onlyOIDs is given, only those rows are updated; they are selected with
+## "OBJECTID IN (...)" queries of up to 1000 ObjectIDs instead of a full pass.
+def writeColumns(inputFC, oids, outputColumns, onlyOIDs = None):
+    ## Imported here because ez.FC and ez.Describe import this module
+    from ez.FC import addFields
+    from ez.Describe import listFieldNames
+
+    existingFields = [fieldName.upper() for fieldName in listFieldNames(inputFC)]
+    addFields(inputFC, [[fieldName, fieldType] for fieldName, fieldType, values in outputColumns
+                        if fieldName.upper() not in existingFields])
+
+    outputValues = columnBlocks(outputColumns)
+    fieldNames = ["OID@"] + [outputColumn[0] for outputColumn in outputColumns]
+
+    ## The ObjectIDs are only sorted once a position has to be searched for
+    search = []
+    def findPosition(oid):
+        if len(search) == 0:
+            sortOrder = numpy.argsort(oids, kind = "mergesort")
+            search.extend([sortOrder, oids[sortOrder]])
+        sortOrder, sortedOIDs = search
+        index = numpy.searchsorted(sortedOIDs, oid)
+        if index < len(sortedOIDs) and sortedOIDs[index] == oid:
+            return sortOrder[index]
+        return None
+
+    if onlyOIDs is not None:
+        oidFieldName = arcpy.AddFieldDelimiters(inputFC, arcpy.Describe(inputFC).OIDFieldName)
+        for chunk in chunkIterable(sorted(int(oid) for oid in onlyOIDs), 1000):
+            query = "%s IN (%s)" % (oidFieldName, ",".join(str(oid) for oid in chunk))
+            with arcpy.da.UpdateCursor(inputFC, fieldNames, query) as cursor:
+                for row in cursor:
+                    position = findPosition(row[0])
+                    if position != None:
+                        cursor.updateRow([row[0]] + outputValues.row(position))
+        return True
+
+    ## Rows normally come back in the same order they were read, so the
+    ## position is only searched for when the ObjectIDs stop matching
+    position = 0
+    with arcpy.da.UpdateCursor(inputFC, fieldNames) as cursor:
+        for row in cursor:
+            oid = row[0]
+            if position >= len(oids) or oids[position] != oid:
+                position = findPosition(oid)
+                if position == None:
+                    position = len(oids)
+                    continue
+            cursor.updateRow([oid] + outputValues.row(position))
+            position += 1
+
+    return True
+
+## ------------------------------------------------------------
+## Incremental recomputation of derived columns
+## ------------------------------------------------------------
+## calcPercentageColumns and calcQuantileColumns can keep a sidecar file (a
+## NumPy .npz archive) recording what they last wrote: the source columns, the
+## column totals or quantile breaks, and a checksum of the source values of
+## every row keyed by ObjectID.  On the next run the columns are still read in
+## one pass, but only the rows that are new or whose checksum changed are
+## written, unless a total or a break moved (which changes every row) or one of
+## the output fields is missing, in which case every row is rewritten.
+
+## Returns the default sidecar path for a data set and kind ("PCT" or "QNT").
+## Data sets in a file geodatabase get a file next to the .gdb folder, named
+## after the geodatabase and the data set; shapefiles and tables get a file
+## next to them.  Other workspaces need an explicit sidecar path.
+def sidecarPath(inputFC, kind):
+    catalogPath = arcpy.Describe(inputFC).catalogPath
+    parts = catalogPath.replace("\\", "/").split("/")
+    if any(part.lower().endswith(".sde") or part.lower() == "in_memory" for part in parts):
+        raise ValueError("A sidecar path must be given for %s" % catalogPath)
+    for index, part in enumerate(parts):
+        if part.lower().endswith(".gdb"):
+            name = "_".join([os.path.splitext(part)[0]] + parts[index + 1:])
+            ## Joined with "/" rather than os.path.join, which would make
+            ## "C:" and a name the drive relative path "C:name"
+            return os.path.normpath("/".join(parts[:index] + ["%s.%s.npz" % (name, kind)]))
+    return "%s.%s.npz" % (os.path.splitext(catalogPath)[0], kind)
+
+## A 64-bit checksum of the values of every row, sensitive to column order
+def _rowChecksums(values, columns):
+    checksums = numpy.zeros(len(values[columns[0]]) if len(columns) > 0 else 0, dtype = numpy.uint64)
+    with numpy.errstate(over = "ignore"):
+        for column in columns:
+            checksums = (checksums * numpy.uint64(1099511628211)) ^ hashArray(values[column])
+    return checksums
+
+## Loads a sidecar written by _saveSidecar, returning None if it does not exist
+## or was written for different columns or settings
+def _loadSidecar(path, columns, setting):
+    if path == None or os.path.exists(path) == False:
+        return None
+    archive = numpy.load(path)
+    sidecar = dict((key, archive[key]) for key in archive.files)
+    archive.close()
+    if sidecar["columns"].tolist() != [str(column) for column in columns] or str(sidecar["setting"]) != str(setting):
+        return None
+    return sidecar
+
+## Saved through an open file, since numpy.savez adds ".npz" to a path without
+## it and _loadSidecar would then never find the file
+def _saveSidecar(path, columns, setting, oids, checksums, summary):
+    order = numpy.argsort(oids, kind = "mergesort")
+    with open(path, "wb") as sidecarFile:
+        numpy.savez(sidecarFile, columns = numpy.array([str(column) for column in columns]),
+                    setting = numpy.array(str(setting)), oids = oids[order],
+                    checksums = checksums[order], summary = summary)
+
+## Returns the ObjectIDs of the rows that are new or changed since the sidecar
+def _changedOIDs(sidecar, oids, checksums):
+    if len(sidecar["oids"]) == 0:
+        return oids
+    positions = numpy.clip(numpy.searchsorted(sidecar["oids"], oids), 0, len(sidecar["oids"]) - 1)
+    unchanged = (sidecar["oids"][positions] == oids) & (sidecar["checksums"][positions] == checksums)
+    return oids[~unchanged]
+
+## Writes outputColumns in full, or only for the changed rows when the sidecar
+## is still valid for them (summary is the array of totals or breaks)
+def writeIncrementalColumns(inputFC, oids, values, columns, outputColumns,
+                            setting, summary, sidecar):
+    ## Imported here because ez.Describe imports this module
+    from ez.Describe import listFieldNames
+
+    checksums = _rowChecksums(values, columns)
+    previous = _loadSidecar(sidecar, columns, setting)
+
+    existingFields = [fieldName.upper() for fieldName in listFieldNames(inputFC)]
+    onlyOIDs = None
+    if previous is not None and numpy.array_equal(numpy.isnan(previous["summary"]), numpy.isnan(summary)) \
+       and numpy.array_equal(previous["summary"][~numpy.isnan(summary)], summary[~numpy.isnan(summary)]) \
+       and all(outputColumn[0].upper() in existingFields for outputColumn in outputColumns):
+        onlyOIDs = _changedOIDs(previous, oids, checksums)
+
+    if onlyOIDs is None or len(onlyOIDs) > 0:
+        writeColumns(inputFC, oids, outputColumns, onlyOIDs)
+    _saveSidecar(sidecar, columns, setting, oids, checksums, summary)
+    return True
 
 ## This function creates percentage columns
 ## The total parameter controls how the percentages are calculated
@@ -76,98 +777,546 @@ class runningStats:
 ##      White | Black | Other | PCT_White | PCT_Black | PCT_Other
 ##      ---------------------------------------------------------
 ##      100   | 50    | 50    | 0.5       | 0.25      | 0.25
-def calcPercentageColumns(inputFC, columns, total = "COLUMN"):
+##
+## All of the columns are read in one pass, the percentages are calculated with
+## NumPy and then written back in a single UpdateCursor pass (see readColumns and
+## writeColumns).  NULL values, and rows or columns with a total of 0, result in
+## NULL percentages.  PCT_ fields that already exist are overwritten.
+##
+## incremental = True keeps a sidecar (see writeIncrementalColumns) so that a
+## rerun only rewrites the rows that changed, unless a column total moved.
+## sidecar is its path, by default given by sidecarPath(inputFC, "PCT").
+def calcPercentageColumns(inputFC, columns, total = "COLUMN", chunkSize = 500000,
+                          incremental = False, sidecar = None):
+    if type(columns) == str:
+        columns = [columns]
+
+    oids, values = readColumns(inputFC, columns, chunkSize)
+
     if total == "COLUMN":
-        if type(columns) == str:
-            columns = [columns]
+        totals = [numpy.nansum(values[column]) for column in columns]
+    elif total == "ROW":
+        rowTotals = numpy.nansum(numpy.array([values[column] for column in columns]), axis = 0)
+        totals = [numpy.where(rowTotals > 0, rowTotals, numpy.nan)] * len(columns)
+    else:
+        raise ValueError("total must be 'COLUMN' or 'ROW'")
 
-        columnSums = []
+    outputColumns = []
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        for column, columnTotal in zip(columns, totals):
+            percentages = values[column] / columnTotal
+            percentages[~numpy.isfinite(percentages)] = numpy.nan
+            outputColumns.append(["PCT_%s" % column, "DOUBLE", percentages])
 
-        for column in columns:
-            percentColumn = "PCT_%s" % column
-            arcpy.AddField_management(inputFC, percentColumn, "DOUBLE")
-            columnSums.append(fieldSum(inputFC, column)) 
+    if incremental == True:
+        ## Row totals only affect their own row, so only column totals are kept
+        summary = numpy.array(totals, dtype = numpy.float64) if total == "COLUMN" else numpy.zeros(0)
+        return writeIncrementalColumns(inputFC, oids, values, columns, outputColumns, total, summary,
+                                       sidecar if sidecar != None else sidecarPath(inputFC, "PCT"))
 
-        cursorColumns = copy(columns)
-        for column in columns:
-            cursorColumns.append("PCT_%s" % column)
+    return writeColumns(inputFC, oids, outputColumns)
 
-        cursor = arcpy.da.UpdateCursor(inputFC, cursorColumns)
-        for row in cursor:
-            dataValues  = copy(row[:len(columns)])
-            for columnNumber in range(len(columns)):
-                percentage = dataValues[columnNumber] / columnSums[columnNumber]
-                dataValues.append(percentage)
-            cursor.updateRow(dataValues)
-        del cursor
+## This class estimates quantiles of a stream of values in a small, fixed
+## amount of memory, for data sets that are too large for numpy.percentile.
+## It is an implementation of the KLL sketch:
+## https://arxiv.org/abs/1603.05346
+## based on the reference implementation at
+## https://github.com/edoliberty/streaming-quantiles
+## Values are kept in a hierarchy of compactors; whenever the sketch is full,
+## the first compactor over its capacity is sorted and every other value
+## (starting at a random offset) is promoted to the next level with twice the
+## weight.  The capacity of the levels shrinks geometrically (by 2/3) from the
+## top, so the sketch stores about 3k values no matter how many are pushed.
+##
+## epsilon is the target rank error: a returned quantile q is expected to have
+## a true rank within q +/- epsilon.  k is derived from it as 2 / epsilon, which
+## in testing (see benchmarkQuantileSketch) kept the worst of 99 percentiles
+## within epsilon.  The minimum and maximum are tracked exactly.
+## Sketches with the same k can be merged, so each chunk of a data set (or
+## each worker process) can build its own sketch.
+class quantileSketch:
 
+    def __init__(self, epsilon = 0.01, seed = None):
+        self.epsilon = epsilon
+        self.k = max(8, int(math.ceil(2 / epsilon)))
+        self.compactors = [numpy.zeros(0)]
+        self.n = 0
+        self.minValue = None
+        self.maxValue = None
+        self.randomState = numpy.random.RandomState(seed)
 
-    if total == "ROW":
-        for column in columns:
-            arcpy.AddField_management(inputFC, "PCT_%s" % column, "DOUBLE")
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
 
-        cursorColumns = copy(columns)
-        for column in columns:
-            cursorColumns.append("PCT_%s" % column)
+    def _compress(self):
+        while sum(len(compactor) for compactor in self.compactors) > sum(self._capacity(level) for level in range(len(self.compactors))):
+            for level in range(len(self.compactors)):
+                if len(self.compactors[level]) >= self._capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.compactors.append(numpy.zeros(0))
+                    items = numpy.sort(self.compactors[level])
+                    ## With an odd number of items the smallest one stays behind
+                    leftover = len(items) % 2
+                    promoted = items[leftover + self.randomState.randint(2)::2]
+                    self.compactors[level] = items[:leftover]
+                    self.compactors[level + 1] = numpy.concatenate([self.compactors[level + 1], promoted])
 
-        cursor = arcpy.da.UpdateCursor(inputFC, cursorColumns)
-        for row in cursor:
-            dataValues  = copy(row[:len(columns)])
-            dataSum     = sum(dataValues)
-            if dataSum > 0:
-                for columnNumber in range(len(columns)):
-                    percentage = dataValues[columnNumber] / dataSum
-                    dataValues.append(percentage)
-                cursor.updateRow(dataValues)
-        del cursor
+    def push(self, x):
+        self.pushMany([x])
 
-    return True
+    def pushMany(self, values):
+        ## NaN values (i.e. NULLs read into a float array) are skipped
+        values = numpy.asarray(values, dtype = numpy.float64).ravel()
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.n += len(values)
+        if self.minValue == None or values.min() < self.minValue:
+            self.minValue = values.min()
+        if self.maxValue == None or values.max() > self.maxValue:
+            self.maxValue = values.max()
+
+        self.compactors[0] = numpy.concatenate([self.compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        if other.k != self.k:
+            raise ValueError("only sketches with the same epsilon can be merged")
+        if other.n == 0:
+            return self
+
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(numpy.zeros(0))
+        for level in range(len(other.compactors)):
+            self.compactors[level] = numpy.concatenate([self.compactors[level], other.compactors[level]])
+
+        self.n += other.n
+        self.minValue = other.minValue if self.minValue == None else min(self.minValue, other.minValue)
+        self.maxValue = other.maxValue if self.maxValue == None else max(self.maxValue, other.maxValue)
+        self._compress()
+        return self
+
+    def _sortedItems(self):
+        items = numpy.concatenate(self.compactors)
+        weights = numpy.concatenate([numpy.repeat(2 ** level, len(compactor)) for level, compactor in enumerate(self.compactors)])
+        order = numpy.argsort(items, kind = "mergesort")
+        return items[order], numpy.cumsum(weights[order])
+
+    def quantile(self, q):
+        ## q may be a single fraction (0 to 1) or an array of them
+        if self.n == 0:
+            raise ValueError("the sketch is empty")
+        items, cumulativeWeights = self._sortedItems()
+        q = numpy.asarray(q, dtype = numpy.float64)
+        indexes = numpy.clip(numpy.searchsorted(cumulativeWeights, q * self.n, side = "left"), 0, len(items) - 1)
+        values = items[indexes]
+        values = numpy.where(q <= 0, self.minValue, values)
+        values = numpy.where(q >= 1, self.maxValue, values)
+        return values
 
+    def percentile(self, p):
+        ## Same as quantile, but with p from 0 to 100 like numpy.percentile
+        return self.quantile(numpy.asarray(p, dtype = numpy.float64) / 100)
+
+    def rank(self, x):
+        ## Estimated fraction of the values that are less than or equal to x
+        items, cumulativeWeights = self._sortedItems()
+        index = numpy.searchsorted(items, x, side = "right")
+        return numpy.where(index > 0, cumulativeWeights[numpy.maximum(index - 1, 0)], 0) / self.n
+
+    def __len__(self):
+        return self.n
+
+## Pushes random data into a quantileSketch in chunks (merging half of them
+## through a second sketch) and reports the observed rank error of its
+## percentiles against the exact percentiles from NumPy
+def benchmarkQuantileSketch(n = 2 * 10 ** 6, epsilon = 0.01, chunks = 20, display = True):
+    randomState = numpy.random.RandomState(0)
+    data = randomState.lognormal(size = n)
+
+    startTime = time.time()
+    sketch = quantileSketch(epsilon, seed = 0)
+    otherSketch = quantileSketch(epsilon, seed = 1)
+    for i, chunk in enumerate(numpy.array_split(data, chunks)):
+        if i % 2 == 0:
+            sketch.pushMany(chunk)
+        else:
+            otherSketch.pushMany(chunk)
+    sketch.merge(otherSketch)
+    sketchSeconds = time.time() - startTime
+
+    percentiles = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+    sortedData = numpy.sort(data)
+    reportData = []
+    for p, approximate, exact in zip(percentiles, sketch.percentile(percentiles), percentile(data, percentiles)):
+        observedRank = numpy.searchsorted(sortedData, approximate, side = "right") / n
+        reportData.append([p, exact, approximate, "%.4f" % abs(observedRank - p / 100)])
+
+    title = "quantileSketch (epsilon = %s, %s values, %.2f s)" % (epsilon, n, sketchSeconds)
+    return ezTable(reportData, ["Percentile", "Exact", "Approximate", "Rank Error"], title = title,
+                   display = display)
+
+## Classifies values into n quantiles (quartiles by default) of data
+## The n + 1 breaks are calculated with a single numpy.percentile call.
+## Class i (1 to n) holds the values v with breaks[i - 1] <= v < breaks[i],
+## except the top class which also includes the maximum (breaks[n]).
+## classify works on whole arrays with numpy.searchsorted and returns 0 for
+## NULL (NaN) values and values outside of the range of data, while calling
+## the object on a single value returns None for those.
+## data may also be a quantileSketch, in which case the breaks are estimated
+## from the sketch (interpolationMethod does not apply).
 class quantileCalculator:
     def __init__(self, data, n = 4, interpolationMethod = "linear"):
-        self.valueRanges = []
-        for i in range(1, n + 1):
-            lowerPercentile = (100 / n) * (i - 1)
-            upperPercentile = (100 / n) * i
+        self.n = n
+        percentiles = [(100 / n) * i for i in range(n + 1)]
+        if isinstance(data, quantileSketch):
+            self.breaks = data.percentile(percentiles)
+        else:
+            self.breaks = percentile(data, percentiles, interpolation = interpolationMethod)
+        self.breaksList = self.breaks.tolist()
 
-            lowerPercentileValue = percentile(data, lowerPercentile, interpolation = interpolationMethod)
-            upperPercentileValue = percentile(data, upperPercentile, interpolation = interpolationMethod)
+        self.valueRanges = []
+        for i in range(n):
+            self.valueRanges.append([self.breaks[i], self.breaks[i + 1]])
 
-            self.valueRanges.append([lowerPercentileValue, upperPercentileValue])
+    def classify(self, values):
+        values = numpy.asarray(values, dtype = numpy.float64)
+        ## NaN sorts after every break, so it ends up out of range below
+        classes = numpy.searchsorted(self.breaks, values, side = "right")
+        ## Special case for the top value
+        classes[values == self.breaks[-1]] = self.n
+        classes[classes > self.n] = 0
+        return classes
 
     def __call__(self, x):
-        for i in  xrange(len(self.valueRanges)):
-            lowerLimit, upperLimit  = self.valueRanges[i]
-            if x >= lowerLimit and x < upperLimit:
-                return i + 1
-            ## Special case for the top value
-            if i + 1 == len(self.valueRanges) and x == upperLimit:
-                return i + 1
-
-def calcQuantileColumns(inputFC, columns, n):
+        ## The same rule as classify, but with bisect since NumPy's overhead
+        ## dominates when classifying a single value
+        if x == None or x != x:
+            return None
+        quantile = bisect_right(self.breaksList, x)
+        if x == self.breaksList[-1]:
+            quantile = self.n
+        if quantile == 0 or quantile > self.n:
+            return None
+        return quantile
+
+## Finds the optimal classes for naturalBreaksCalculator.  values are sorted
+## unique values and weights their (positive) weights.  Returns the indexes of
+## the first value of classes 2 to k and the total within-class weighted sum
+## of squared deviations.
+## The classes minimize the within-class sum of squared deviations, which is
+## solved exactly by dynamic programming over the prefix sums of the weights,
+## values and squared values: the best cost of splitting the first i values
+## into j classes is the minimum over t of the best cost of the first t values
+## in j - 1 classes plus the cost of values t to i - 1 as one class.
+## The best t never decreases as i increases, so each layer can be computed by
+## divide and conquer (solve the middle i, then each half only searches its
+## side of the middle's t) in O(m log m) instead of O(m ** 2), as in Ckmeans.1d.dp:
+## https://journal.r-project.org/archive/2011-2/RJournal_2011-2_Wang+Song.pdf
+## All of the subproblems at the same depth of the recursion are solved
+## together with NumPy, so there are only about k log2(m) vectorized steps.
+def _naturalBreakStarts(values, weights, k):
+    m = len(values)
+    ## Centering the values keeps the prefix sums of squares accurate
+    centered = values - numpy.average(values, weights = weights)
+    s0 = numpy.concatenate([[0.0], numpy.cumsum(weights)])
+    s1 = numpy.concatenate([[0.0], numpy.cumsum(weights * centered)])
+    s2 = numpy.concatenate([[0.0], numpy.cumsum(weights * centered * centered)])
+
+    def cost(t, i):
+        ## Sum of squared deviations of values t to i - 1 (t < i)
+        x = s1[i] - s1[t]
+        return numpy.maximum(s2[i] - s2[t] - x * x / (s0[i] - s0[t]), 0)
+
+    previous = numpy.repeat(numpy.inf, m + 1)
+    previous[1:] = cost(numpy.zeros(m, dtype = numpy.int64), numpy.arange(1, m + 1))
+
+    bestStarts = []
+    for j in range(2, k + 1):
+        current = numpy.repeat(numpy.inf, m + 1)
+        best = numpy.zeros(m + 1, dtype = numpy.int64)
+
+        ## Each subproblem solves i in [low, high] searching t in [tLow, tHigh]
+        low, high = numpy.array([j]), numpy.array([m])
+        tLow, tHigh = numpy.array([j - 1]), numpy.array([m - 1])
+        while len(low) > 0:
+            middle = (low + high) // 2
+            lengths = numpy.minimum(middle - 1, tHigh) - tLow + 1
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+            subproblem = numpy.repeat(numpy.arange(len(low)), lengths)
+            t = numpy.arange(lengths.sum()) - offsets[subproblem] + tLow[subproblem]
+
+            totals = previous[t] + cost(t, middle[subproblem])
+            minima = numpy.minimum.reduceat(totals, offsets)
+            ## The first t reaching the minimum of each subproblem
+            positions = numpy.where(totals == minima[subproblem], numpy.arange(len(t)), len(t))
+            bestT = t[numpy.minimum.reduceat(positions, offsets)]
+            current[middle] = minima
+            best[middle] = bestT
+
+            left = low <= middle - 1
+            right = middle + 1 <= high
+            low, high, tLow, tHigh = (numpy.concatenate([low[left], middle[right] + 1]),
+                                      numpy.concatenate([middle[left] - 1, high[right]]),
+                                      numpy.concatenate([tLow[left], bestT[right]]),
+                                      numpy.concatenate([bestT[left], tHigh[right]]))
+        previous = current
+        bestStarts.append(best)
+
+    starts = []
+    i = m
+    for best in reversed(bestStarts):
+        i = best[i]
+        starts.insert(0, i)
+    return starts, previous[m]
+
+## Classifies values into n natural breaks (Jenks) classes of data, i.e. the
+## classes that minimize the sum of squared deviations from the class means.
+## The classes are found exactly by _naturalBreakStarts on the sorted unique
+## values, weighted by how many times they occur (times weights, if given),
+## so the time depends on the number of distinct values and not on len(data).
+## breaks[i - 1] is the smallest value of class i and breaks[n] the maximum, so
+## classify and calling the object work exactly as in quantileCalculator.
+## If data has fewer than n distinct values, there is one class per value
+## (self.n is reduced accordingly).
+## sampleSize limits the classes to a random sample of data for very large
+## data sets (the breaks then only approximate the optimal classes, but the
+## minimum and maximum of all of data are kept).
+## self.gvf is the goodness of variance fit (1 is a perfect fit).
+class naturalBreaksCalculator(quantileCalculator):
+    def __init__(self, data, n = 5, weights = None, sampleSize = None, seed = None):
+        data = numpy.asarray(data, dtype = numpy.float64).ravel()
+        weights = numpy.ones(len(data)) if weights is None else numpy.asarray(weights, dtype = numpy.float64).ravel()
+        valid = ~numpy.isnan(data) & ~numpy.isnan(weights) & (weights > 0)
+        data, weights = data[valid], weights[valid]
+        if len(data) == 0:
+            raise ValueError("data does not contain any values")
+        minValue, maxValue = data.min(), data.max()
+
+        if sampleSize != None and len(data) > sampleSize:
+            sample = numpy.random.RandomState(seed).choice(len(data), sampleSize, replace = False)
+            data, weights = data[sample], weights[sample]
+
+        values, inverse = numpy.unique(data, return_inverse = True)
+        valueWeights = numpy.bincount(inverse, weights = weights)
+
+        self.n = min(n, len(values))
+        starts, withinSquares = _naturalBreakStarts(values, valueWeights, self.n) if self.n > 1 else ([], 0.0)
+        totalSquares = (valueWeights * (values - numpy.average(values, weights = valueWeights)) ** 2).sum()
+        self.gvf = 1 - withinSquares / totalSquares if totalSquares > 0 else 1.0
+
+        self.breaks = numpy.array([minValue] + [values[start] for start in starts] + [maxValue])
+        self.breaksList = self.breaks.tolist()
+
+        self.valueRanges = []
+        for i in range(self.n):
+            self.valueRanges.append([self.breaks[i], self.breaks[i + 1]])
+
+## Adds a JNK_ column with the natural breaks class (1 to n) of every value of
+## each column, the same way as calcQuantileColumns (one read pass, vectorized
+## classification and one UpdateCursor pass).  NULL values are left NULL.
+## sampleSize and seed are passed to naturalBreaksCalculator.
+def calcNaturalBreaksColumns(inputFC, columns, n = 5, chunkSize = 500000,
+                             sampleSize = None, seed = None):
     if type(columns) == str:
         columns = [columns]
 
+    oids, values = readColumns(inputFC, columns, chunkSize)
+
+    outputColumns = []
     for column in columns:
-        newColumn = "QNT_%s" % column
-        arcpy.AddField_management(inputFC, newColumn, "SHORT")
-        quantiles = quantileCalculator(fieldValues(inputFC, column), n)
+        columnValues = values[column]
+        classes = numpy.repeat(numpy.nan, len(columnValues))
+        if numpy.isnan(columnValues).all() == False:
+            naturalBreaks = naturalBreaksCalculator(columnValues, n, sampleSize = sampleSize, seed = seed)
+            classes = naturalBreaks.classify(columnValues).astype(numpy.float64)
+            classes[classes == 0] = numpy.nan
+        outputColumns.append(["JNK_%s" % column, "SHORT", classes])
+
+    return writeColumns(inputFC, oids, outputColumns)
+
+## Times naturalBreaksCalculator on increasing numbers of random (all distinct)
+## values, plus a sample of the largest one
+def benchmarkNaturalBreaks(sizes = [10 ** 4, 10 ** 5, 10 ** 6, 2 * 10 ** 6], n = 5,
+                           sampleSize = 10 ** 5, display = True):
+    randomState = numpy.random.RandomState(0)
+    reportData = []
+    for size in sizes + [sizes[-1]]:
+        data = randomState.lognormal(size = size)
+        sampled = len(reportData) == len(sizes)
+        startTime = time.time()
+        naturalBreaks = naturalBreaksCalculator(data, n, sampleSize = sampleSize if sampled else None, seed = 0)
+        seconds = time.time() - startTime
+        reportData.append([size, sampleSize if sampled else size, round(seconds, 3), round(naturalBreaks.gvf, 6),
+                           ", ".join("%.3f" % value for value in naturalBreaks.breaks[1:-1])])
+
+    return ezTable(reportData, ["Values", "Classified", "Seconds", "GVF", "Breaks"],
+                   title = "naturalBreaksCalculator (n = %s)" % n, display = display)
+
+## Adds a QNT_ column with the quantile (1 to n) of every value of each column.
+## All of the columns are read in one pass, classified with quantileCalculator
+## and written back in a single UpdateCursor pass (see readColumns and
+## writeColumns).  NULL values are left NULL.
+##
+## approximate = True is meant for tables whose columns do not fit in memory.
+## The breaks are estimated with one quantileSketch per column (target rank
+## error epsilon) while streaming the columns in chunks, and each row is then
+## classified as it passes through the UpdateCursor, so memory use does not
+## depend on the number of rows.
+##
+## incremental = True keeps a sidecar (see writeIncrementalColumns) so that a
+## rerun only rewrites the rows that changed, unless a break moved.
+## sidecar is its path, by default given by sidecarPath(inputFC, "QNT").
+## It does not apply to approximate = True.
+def calcQuantileColumns(inputFC, columns, n, chunkSize = 500000,
+                        approximate = False, epsilon = 0.01,
+                        incremental = False, sidecar = None):
+    if type(columns) == str:
+        columns = [columns]
+
+    if approximate == True:
+        ## Imported here because ez.Describe and ez.FC import this module
+        from ez.Describe import cursorChunks, listFieldNames
+        from ez.FC import addFields
+
+        sketches = [quantileSketch(epsilon) for column in columns]
+        for chunk in cursorChunks(inputFC, columns, chunkSize):
+            for column, sketch in zip(columns, sketches):
+                sketch.pushMany(chunk[column.upper()].astype(numpy.float64))
+
+        quantiles = [quantileCalculator(sketch, n) if sketch.n > 0 else None for sketch in sketches]
+
+        existingFields = [fieldName.upper() for fieldName in listFieldNames(inputFC)]
+        addFields(inputFC, [["QNT_%s" % column, "SHORT"] for column in columns
+                            if ("QNT_%s" % column).upper() not in existingFields])
 
-        cursor = arcpy.da.UpdateCursor(inputFC, [column, newColumn])
+        cursor = arcpy.da.UpdateCursor(inputFC, columns + ["QNT_%s" % column for column in columns])
         for row in cursor:
-            if row[0] <> None:
-                cursor.updateRow([row[0], quantiles(row[0])])
-            else:
-                cursor.updateRow([None, None])
+            values = row[:len(columns)]
+            cursor.updateRow(values + [quantiles[i](values[i]) if quantiles[i] != None else None
+                                       for i in range(len(columns))])
         del cursor
 
-    return True
+        return True
+
+    oids, values = readColumns(inputFC, columns, chunkSize)
+
+    outputColumns = []
+    breaks = []
+    for column in columns:
+        columnValues = values[column]
+        classes = numpy.repeat(numpy.nan, len(columnValues))
+        columnBreaks = numpy.repeat(numpy.nan, n + 1)
+        if numpy.isnan(columnValues).all() == False:
+            quantiles = quantileCalculator(columnValues[~numpy.isnan(columnValues)], n)
+            classes = quantiles.classify(columnValues).astype(numpy.float64)
+            classes[classes == 0] = numpy.nan
+            columnBreaks = quantiles.breaks
+        outputColumns.append(["QNT_%s" % column, "SHORT", classes])
+        breaks.append(columnBreaks)
+
+    if incremental == True:
+        return writeIncrementalColumns(inputFC, oids, values, columns, outputColumns, n,
+                                       numpy.array(breaks, dtype = numpy.float64).ravel(),
+                                       sidecar if sidecar != None else sidecarPath(inputFC, "QNT"))
+
+    return writeColumns(inputFC, oids, outputColumns)
+
+## Pearson's chi-square statistic of each table in counts, a
+## (tables x rows x columns) array, against the expected counts under
+## independence computed from the margins of that table.  Cells whose expected
+## count is zero (an empty row or column) do not contribute.
+def _chiSquareStatistics(counts):
+    counts = counts.astype(numpy.float64)
+    totals = counts.sum(axis = (1, 2))
+    expected = counts.sum(axis = 2)[:, :, None] * counts.sum(axis = 1)[:, None, :] / numpy.maximum(totals, 1)[:, None, None]
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        cells = (counts - expected) ** 2 / expected
+    cells[expected == 0] = 0
+    return cells.sum(axis = (1, 2))
+
+## Draws tables from the multinomial distribution of the observed total over
+## the cell probabilities under independence, one batch of tables per entry of
+## batches (a list of [batchIndex, size]), and counts how many have a
+## chi-square statistic at least as large as the observed one.
+## It is a module level function so that multiprocessing can pickle it.
+## Every batch has its own random stream, seeded with [seed, batchIndex], so
+## the result does not depend on how the batches are split across workers.
+def _monteCarloWorker(arguments):
+    probabilities, total, shape, observedStatistic, seed, batches = arguments
 
+    ## Allow for rounding error when comparing with the observed statistic
+    threshold = observedStatistic * (1 - 1e-7)
+    atLeastObserved = 0
+    for batchIndex, size in batches:
+        randomState = numpy.random.RandomState([seed, batchIndex])
+        draws = randomState.multinomial(total, probabilities, size = size).reshape((size,) + shape)
+        atLeastObserved += int((_chiSquareStatistics(draws) >= threshold).sum())
+    return atLeastObserved
+
+## method = "ASYMPTOTIC" uses scipy's chi2_contingency, which relies on the
+##      chi-square approximation (unreliable when expected counts are small)
+## method = "MONTECARLO" compares Pearson's chi-square statistic (without Yates'
+##      correction) to resamples tables drawn from the multinomial distribution
+##      under independence, as in R's chisq.test(simulate.p.value = TRUE) but
+##      without fixing the margins.
+##      The p-value is (1 + number of resamples >= observed) / (resamples + 1),
+##      and its Monte Carlo standard error is sqrt(p * (1 - p) / resamples).
+##      The resamples are drawn in batches of batchSize, which can be split
+##      across workers processes (by default they are all drawn in this
+##      process; a Pool of workers imports arcpy again in every process and
+##      does not work inside ArcMap).  The results are reproducible for a given
+##      seed, whatever the number of workers.  The standard error is reported
+##      in the results table along with the p-value.
+## Returns the test statistic, p-value, degrees of freedom and expected table.
+## returnStandardError = True adds the standard error of the p-value after the
+##      p-value (None with method = "ASYMPTOTIC").
 def contigencyAnalysis(dataTable,
                        rowNames = None, columnNames = None,
-                       display = True, outputFile = None):
-    
-    testStatistic, pValue, degreesOfFreedom, expectedTable = chi2_contingency(dataTable)
+                       display = True, outputFile = None,
+                       method = "ASYMPTOTIC", resamples = 100000, seed = None,
+                       workers = 1, batchSize = 10000, returnStandardError = False):
+
+    standardError = None
+    if method.upper() == "ASYMPTOTIC":
+        testStatistic, pValue, degreesOfFreedom, expectedTable = chi2_contingency(dataTable)
+
+    elif method.upper() == "MONTECARLO":
+        observed = numpy.asarray(dataTable, dtype = numpy.int64)
+        total = int(observed.sum())
+        expectedTable = numpy.outer(observed.sum(axis = 1), observed.sum(axis = 0)) / total
+        degreesOfFreedom = (observed.shape[0] - 1) * (observed.shape[1] - 1)
+        testStatistic = _chiSquareStatistics(observed[None])[0]
+
+        if seed == None:
+            seed = numpy.random.randint(2 ** 31 - 1)
+        batches = [[batchIndex, min(batchSize, resamples - start)]
+                   for batchIndex, start in enumerate(range(0, resamples, batchSize))]
+        workers = max(1, min(workers, len(batches)))
+
+        probabilities = (expectedTable / total).ravel()
+        probabilities /= probabilities.sum()
+        arguments = [(probabilities, total, observed.shape, testStatistic, seed, batches[i::workers])
+                     for i in range(workers)]
+
+        if workers == 1:
+            counts = [_monteCarloWorker(arguments[0])]
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            try:
+                counts = pool.map(_monteCarloWorker, arguments)
+            finally:
+                pool.close()
+                pool.join()
+
+        pValue = (1 + sum(counts)) / (resamples + 1)
+        standardError = math.sqrt(pValue * (1 - pValue) / resamples)
+
+    else:
+        raise ValueError("method must be 'ASYMPTOTIC' or 'MONTECARLO'")
 
     
     outputDataTable = ezTable(dataTable, columnNames, rowNames, summarizeColumns ="SUM", summarizeRows = "SUM", title = "Observed Counts", display = display, returnFormat = "MATRIX")
@@ -183,34 +1332,276 @@ def contigencyAnalysis(dataTable,
                     ["Degrees of Freedom", degreesOfFreedom],
                     ["p-value", pValueString]]
 
+    if method.upper() == "MONTECARLO":
+        resultsTable += [["Monte Carlo Standard Error", round(standardError, 6)],
+                         ["Resamples", resamples],
+                         ["Seed", seed]]
+
     outputResultsTable = ezTable(resultsTable, title="Results", display = display, returnFormat = "MATRIX")
 
     if outputFile <> None:
         outputMatrix = outputDataTable + [['']] + outputExpectedTable + [['']] + outputResultsTable
         matrixToCSV(outputMatrix, outputFile)
 
+    if returnStandardError == True:
+        return testStatistic, pValue, standardError, degreesOfFreedom, expectedTable
     return testStatistic, pValue, degreesOfFreedom, expectedTable
 
+## Counts the rows of a data set matching every pair of a row query and a
+## column query, returning a len(rowQueries) x len(columnQueries) table.
+## Only the fields referenced by the queries are read, in a single cursor pass.
+## Every query is evaluated as a vectorized boolean mask over each chunk of rows
+## (see ez.Query) and the whole table is filled at once with a matrix product
+## of the row masks and the column masks.
+def crossTabulate(inputOBJ, rowQueries, columnQueries, chunkSize = 500000):
+    ## Imported here because ez.Describe imports this module
+    from ez.Describe import cursorChunks
+
+    rowPredicates       = [compileQuery(query) for query in rowQueries]
+    columnPredicates    = [compileQuery(query) for query in columnQueries]
+
+    fields = []
+    for predicate in rowPredicates + columnPredicates:
+        for field in predicate.fields:
+            if field.upper() not in [existingField.upper() for existingField in fields]:
+                fields.append(field)
+    ## Rows still have to be counted when no query references a field
+    if len(fields) == 0:
+        fields = ["OID@"]
+
+    dataTable = numpy.zeros((len(rowQueries), len(columnQueries)), dtype = numpy.int64)
+
+    for columns in cursorChunks(inputOBJ, fields, chunkSize):
+        rowMasks    = numpy.array([predicate(columns) for predicate in rowPredicates], dtype = numpy.int64)
+        columnMasks = numpy.array([predicate(columns) for predicate in columnPredicates], dtype = numpy.int64)
+        dataTable += numpy.dot(rowMasks, columnMasks.T)
+
+    return dataTable.tolist()
+
+## method = "NUMPY" builds the table with crossTabulate (one pass over inputFC).
+##      Queries that compileQuery cannot evaluate (SQL outside its subset, or
+##      text compared with numbers, which the data source would convert) raise
+##      an UnsupportedQueryError and fall back to "QUERY".
+## method = "QUERY" selects and counts the features of every cell with ArcGIS
+##      (one pass per cell), which supports any SQL the data source does
 def contigencyTable1FC(inputFC, rowQueries, columnQueries,
                        columnNames = None, rowNames = None,
-                       display = True, outputFile = None):
-    dataTable = []
+                       display = True, outputFile = None,
+                       method = "NUMPY", chunkSize = 500000):
 
-    inputLYR = randomString()
-    arcpy.MakeFeatureLayer_management(inputFC, inputLYR)
+    if method.upper() not in ["NUMPY", "QUERY"]:
+        raise ValueError("method must be 'NUMPY' or 'QUERY'")
 
-    for rowQuery in rowQueries:
-        newRow = []
-        for columnQuery in columnQueries:
-            query = "(%s) AND (%s)" % (rowQuery, columnQuery)
-            newRow.append(countFeatures(inputLYR, query))
-        dataTable.append(newRow)
+    dataTable = None
+    if method.upper() == "NUMPY":
+        try:
+            dataTable = crossTabulate(inputFC, rowQueries, columnQueries, chunkSize)
+        except UnsupportedQueryError:
+            dataTable = None
+
+    if dataTable == None:
+        ## Imported here because ez.Describe imports this module
+        from ez.Describe import countFeatures
+
+        dataTable = []
+
+        inputLYR = randomString()
+        arcpy.MakeFeatureLayer_management(inputFC, inputLYR)
+
+        for rowQuery in rowQueries:
+            newRow = []
+            for columnQuery in columnQueries:
+                query = "(%s) AND (%s)" % (rowQuery, columnQuery)
+                arcpy.SelectLayerByAttribute_management(inputLYR, "NEW_SELECTION", query)
+                newRow.append(countFeatures(inputLYR))
+            dataTable.append(newRow)
+
+        arcpy.Delete_management(inputLYR)
 
     return contigencyAnalysis(dataTable, rowNames, columnNames, display, outputFile)
 
+## Returns the rings (exterior and interior) of an arcpy Polygon as a list of
+## N x 2 NumPy arrays of vertex coordinates.  Within a part, interior rings
+## follow the exterior ring and are separated from it by None.
+## http://pro.arcgis.com/en/pro-app/arcpy/get-started/reading-geometries.htm
+def polygonRings(polygon):
+    rings = []
+    for part in polygon:
+        ring = []
+        for point in part:
+            if point is None:
+                if len(ring) > 0:
+                    rings.append(numpy.array(ring, dtype = numpy.float64))
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if len(ring) > 0:
+            rings.append(numpy.array(ring, dtype = numpy.float64))
+    return rings
+
+## Returns a boolean array indicating which of the points (x, y) fall inside
+## the polygon made up of rings.  This is the even-odd (ray casting) rule [1]
+## applied to the edges of every ring at once, so holes and multipart polygons
+## are handled without knowing which ring is which.  The edges are processed
+## in blocks so that each block is a single vectorized NumPy operation.
+## Points exactly on an edge may fall either way.
+## [1] https://wrf.ecse.rpi.edu/Research/Short_Notes/pnpoly.html
+def pointsInPolygon(x, y, rings, blockSize = 4000000):
+    startX = numpy.concatenate([ring[:, 0] for ring in rings])
+    startY = numpy.concatenate([ring[:, 1] for ring in rings])
+    endX = numpy.concatenate([numpy.roll(ring[:, 0], -1) for ring in rings])
+    endY = numpy.concatenate([numpy.roll(ring[:, 1], -1) for ring in rings])
+
+    ## Horizontal edges can never be crossed by a horizontal ray
+    crossable = startY != endY
+    startX, startY, endX, endY = startX[crossable], startY[crossable], endX[crossable], endY[crossable]
+
+    crossings = numpy.zeros(len(x), dtype = numpy.int64)
+    edgesPerBlock = max(1, blockSize // max(len(x), 1))
+    for i in range(0, len(startX), edgesPerBlock):
+        x1, y1 = startX[i:i + edgesPerBlock, None], startY[i:i + edgesPerBlock, None]
+        x2, y2 = endX[i:i + edgesPerBlock, None], endY[i:i + edgesPerBlock, None]
+        spansY = (y1 > y) != (y2 > y)
+        intersectX = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        crossings += (spansY & (x < intersectX)).sum(axis = 0)
+
+    return crossings % 2 == 1
+
+## A uniform grid over a set of points, used to find the points that
+## may fall inside a bounding box without testing every point.
+## The points are sorted by grid cell, so the points of a row of cells
+## are a contiguous slice of the sorted order.
+class pointGrid:
+
+    def __init__(self, x, y, pointsPerCell = 16):
+        self.x, self.y = x, y
+        self.minX, self.minY = x.min(), y.min()
+        cellsPerSide = max(1, int(numpy.sqrt(len(x) / pointsPerCell)))
+        self.cellWidth = max((x.max() - self.minX) / cellsPerSide, 1e-12)
+        self.cellHeight = max((y.max() - self.minY) / cellsPerSide, 1e-12)
+        self.columns = cellsPerSide + 1
+        self.rows = cellsPerSide + 1
+
+        cellIDs = self._column(x) + self._row(y) * self.columns
+        self.order = numpy.argsort(cellIDs, kind = "mergesort")
+        self.cellStarts = numpy.searchsorted(cellIDs[self.order], numpy.arange(self.columns * self.rows + 1))
+
+    def _column(self, x):
+        return numpy.clip(((x - self.minX) // self.cellWidth).astype(numpy.int64), 0, self.columns - 1)
+
+    def _row(self, y):
+        return numpy.clip(((y - self.minY) // self.cellHeight).astype(numpy.int64), 0, self.rows - 1)
+
+    def candidates(self, minX, minY, maxX, maxY):
+        ## Returns the indexes of the points inside the bounding box
+        firstColumn, lastColumn = self._column(numpy.array(minX)), self._column(numpy.array(maxX))
+        firstRow, lastRow = self._row(numpy.array(minY)), self._row(numpy.array(maxY))
+        slices = []
+        for row in range(firstRow, lastRow + 1):
+            start = self.cellStarts[row * self.columns + firstColumn]
+            end = self.cellStarts[row * self.columns + lastColumn + 1]
+            slices.append(self.order[start:end])
+        indexes = numpy.concatenate(slices)
+        inBox = (self.x[indexes] >= minX) & (self.x[indexes] <= maxX) & (self.y[indexes] >= minY) & (self.y[indexes] <= maxY)
+        return indexes[inBox]
+
+## Counts the points matching every point query that fall inside any polygon
+## matching every polygon query, returning a len(polygonQueries) x
+## len(pointQueries) table.  This is what selecting the polygons by attribute,
+## the points by attribute and then the points by location does for each cell,
+## but each feature class is read only once:
+##      1. The coordinates of the points and the fields referenced by the point
+##         queries are read and every point query is evaluated as a mask.
+##      2. The polygons are read along with the fields referenced by the polygon
+##         queries.  The points that may be inside each polygon are found with
+##         a grid index (pointGrid) and then tested exactly (pointsInPolygon).
+##      3. When the point queries do not overlap, every point gets a class code
+##         and each row of the table is a numpy.bincount of the codes of the
+##         points inside the row's polygons.  Otherwise the masks are multiplied.
+## The points are projected to the spatial reference of polygonFC.
+def pointInPolygonCrossTabulate(pointFC, polygonFC, pointQueries, polygonQueries,
+                                chunkSize = 500000):
+    ## Imported here because ez.Describe imports this module
+    from ez.Describe import cursorChunks
+
+    pointPredicates     = [compileQuery(query) for query in pointQueries]
+    polygonPredicates   = [compileQuery(query) for query in polygonQueries]
+
+    def queryFields(predicates):
+        fields = []
+        for predicate in predicates:
+            for field in predicate.fields:
+                if field.upper() not in [existingField.upper() for existingField in fields]:
+                    fields.append(field)
+        return fields
+
+    spatialReference = arcpy.Describe(polygonFC).spatialReference
+
+    x, y, pointMasks = [], [], []
+    for columns in cursorChunks(pointFC, ["SHAPE@X", "SHAPE@Y"] + queryFields(pointPredicates), chunkSize,
+                                spatialReference = spatialReference):
+        hasShape = ~numpy.isnan(columns["SHAPE@X"])
+        x.append(columns["SHAPE@X"][hasShape])
+        y.append(columns["SHAPE@Y"][hasShape])
+        pointMasks.append(numpy.array([predicate(columns)[hasShape] for predicate in pointPredicates]).reshape(len(pointPredicates), -1))
+    x, y = numpy.concatenate(x), numpy.concatenate(y)
+    pointMasks = numpy.concatenate(pointMasks, axis = 1)
+
+    dataTable = numpy.zeros((len(polygonQueries), len(pointQueries)), dtype = numpy.int64)
+    if len(x) == 0:
+        return dataTable.tolist()
+
+    grid = pointGrid(x, y)
+    insidePolygons = numpy.zeros((len(polygonQueries), len(x)), dtype = bool)
+
+    for columns in cursorChunks(polygonFC, ["SHAPE@"] + queryFields(polygonPredicates), chunkSize):
+        polygonMasks = numpy.array([predicate(columns) for predicate in polygonPredicates]).reshape(len(polygonPredicates), -1)
+        for i in numpy.nonzero(polygonMasks.any(axis = 0))[0]:
+            polygon = columns["SHAPE@"][i]
+            if polygon is None:
+                continue
+            extent = polygon.extent
+            candidates = grid.candidates(extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+            if len(candidates) == 0:
+                continue
+            inside = candidates[pointsInPolygon(x[candidates], y[candidates], polygonRings(polygon))]
+            for queryIndex in numpy.nonzero(polygonMasks[:, i])[0]:
+                insidePolygons[queryIndex, inside] = True
+
+    if pointMasks.sum(axis = 0).max() <= 1:
+        ## Each point belongs to at most one point query: code len(pointQueries)
+        ## marks points that match no query
+        classCodes = numpy.where(pointMasks.any(axis = 0), pointMasks.argmax(axis = 0), len(pointQueries))
+        for queryIndex in range(len(polygonQueries)):
+            dataTable[queryIndex] = numpy.bincount(classCodes[insidePolygons[queryIndex]],
+                                                   minlength = len(pointQueries) + 1)[:len(pointQueries)]
+    else:
+        dataTable = numpy.dot(insidePolygons.astype(numpy.int64), pointMasks.T.astype(numpy.int64))
+
+    return dataTable.tolist()
+
+## method = "NUMPY" builds the table with pointInPolygonCrossTabulate
+##      (one pass over each feature class).  Queries that compileQuery cannot
+##      evaluate fall back to "QUERY" (see contigencyTable1FC).
+## method = "QUERY" uses attribute and location selections for every cell
 def contigencyTable2FC(pointFC, polygonFC, pointQueries, polygonQueries,
                        pointNames = None, polygonNames = None,
-                       display = True, outputFile = None):
+                       display = True, outputFile = None,
+                       method = "NUMPY", chunkSize = 500000):
+
+    if method.upper() not in ["NUMPY", "QUERY"]:
+        raise ValueError("method must be 'NUMPY' or 'QUERY'")
+
+    if method.upper() == "NUMPY":
+        try:
+            dataTable = pointInPolygonCrossTabulate(pointFC, polygonFC, pointQueries, polygonQueries, chunkSize)
+        except UnsupportedQueryError:
+            dataTable = None
+        if dataTable != None:
+            return contigencyAnalysis(dataTable, polygonNames, pointNames, display, outputFile)
+
+    ## Imported here because ez.Describe imports this module
+    from ez.Describe import countFeatures
 
     pointLYR = randomString()
     polygonLYR = randomString()
@@ -232,7 +1623,283 @@ def contigencyTable2FC(pointFC, polygonFC, pointQueries, polygonQueries,
     return contigencyAnalysis(dataTable, polygonNames, pointNames, display, outputFile)
     
 
+## ------------------------------------------------------------
+## Spatial autocorrelation
+## ------------------------------------------------------------
+## Spatial weights say which features are neighbors of which.  They are built
+## once from the centroids of the features of a feature class with a KD-tree
+## (scipy.spatial.cKDTree) and kept as a binary scipy.sparse CSR matrix, where
+## row i has a 1 in column j if feature j is a neighbor of feature i (a
+## feature is never its own neighbor).  Rows and columns are in ObjectID order.
+## The weights can be saved to a .npz file and reused for any number of fields.
+class spatialWeights:
+
+    def __init__(self, oids, matrix, method, parameter):
+        self.oids = oids
+        self.matrix = matrix.tocsr()
+        self.method = method
+        self.parameter = parameter
+
+    def __len__(self):
+        return len(self.oids)
+
+    def neighborCounts(self):
+        return numpy.diff(self.matrix.indptr)
+
+    ## Saved through an open file so that path is used as given (numpy.savez
+    ## adds ".npz" to a path without it, see _saveSidecar)
+    def save(self, path):
+        with open(path, "wb") as weightsFile:
+            numpy.savez(weightsFile, oids = self.oids, data = self.matrix.data, indices = self.matrix.indices,
+                        indptr = self.matrix.indptr, shape = numpy.array(self.matrix.shape),
+                        method = numpy.array(self.method), parameter = numpy.array(self.parameter))
+
+    ## Returns the rows of the weights matching an array of ObjectIDs
+    def positions(self, oids):
+        positions = numpy.clip(numpy.searchsorted(self.oids, oids), 0, max(len(self.oids) - 1, 0))
+        if len(oids) != len(self.oids) or (self.oids[positions] != oids).any():
+            raise ValueError("The spatial weights were built for a different set of features")
+        return positions
+
+def loadSpatialWeights(path):
+    archive = numpy.load(path)
+    matrix = sparse.csr_matrix((archive["data"], archive["indices"], archive["indptr"]),
+                               shape = tuple(archive["shape"]))
+    weights = spatialWeights(archive["oids"], matrix, str(archive["method"]), float(archive["parameter"]))
+    archive.close()
+    return weights
+
+## Builds the spatial weights of the features of inputFC from their centroids
+## (SHAPE@XY) with a cKDTree:
+## method = "DISTANCE_BAND" makes every feature within distance of a feature
+##      its neighbor.  By default distance is the smallest distance that gives
+##      every feature at least one neighbor (as ArcGIS does).
+## method = "KNN" makes the k nearest features of a feature its neighbors
+##      (note that this is not symmetric)
+## If cacheFile is given and was saved with the same method and parameter, the
+## weights are loaded from it instead, otherwise they are built and saved to it.
+## Distances are in the units of the coordinate system of inputFC.
+def buildSpatialWeights(inputFC, method = "DISTANCE_BAND", distance = None, k = 8,
+                        cacheFile = None):
+    method = method.upper()
+    if method not in ["DISTANCE_BAND", "KNN"]:
+        raise ValueError("method must be 'DISTANCE_BAND' or 'KNN'")
+
+    if cacheFile != None and os.path.exists(cacheFile):
+        weights = loadSpatialWeights(cacheFile)
+        if weights.method == method and ((method == "KNN" and weights.parameter == k) or
+                                         (method == "DISTANCE_BAND" and distance in [None, weights.parameter])):
+            return weights
+
+    centroids = arcpy.da.FeatureClassToNumPyArray(inputFC, ["OID@", "SHAPE@XY"])
+    order = numpy.argsort(centroids["OID@"], kind = "mergesort")
+    oids = centroids["OID@"][order].astype(numpy.int64)
+    xy = centroids["SHAPE@XY"][order].astype(numpy.float64)
+    n = len(oids)
+    tree = cKDTree(xy)
+
+    if method == "DISTANCE_BAND":
+        if distance == None:
+            distance = float(tree.query(xy, k = 2)[0][:, 1].max())
+        pairs = tree.query_pairs(distance)
+        if isinstance(pairs, set):
+            pairs = numpy.array(sorted(pairs), dtype = numpy.int64).reshape(-1, 2)
+        rows = numpy.concatenate([pairs[:, 0], pairs[:, 1]])
+        columns = numpy.concatenate([pairs[:, 1], pairs[:, 0]])
+        parameter = distance
+
+    else:
+        neighbors = tree.query(xy, k = min(k + 1, n))[1].reshape(n, -1)
+        ## Drop each feature itself, or the farthest neighbor if another feature
+        ## at the same location came back in its place
+        keep = neighbors != numpy.arange(n)[:, None]
+        keep[keep.all(axis = 1), -1] = False
+        rows = numpy.repeat(numpy.arange(n), keep.sum(axis = 1))
+        columns = neighbors[keep]
+        parameter = k
+
+    matrix = sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape = (n, n))
+    weights = spatialWeights(oids, matrix, method, parameter)
+    if cacheFile != None:
+        weights.save(cacheFile)
+    return weights
+
+## The number of permutations to draw at once for n features when every
+## permutation needs about bytesPerValue bytes of temporary arrays per feature,
+## so that a batch stays under about 100 MB (unless batchSize is given)
+_permutationMemory = 100 * 1024 ** 2
+
+def _permutationBatchSize(n, batchSize, bytesPerValue):
+    if batchSize != None:
+        return batchSize
+    return int(max(1, _permutationMemory // (max(n, 1) * bytesPerValue)))
+
+## Moran's I of values (an array in the order of matrix, without NULLs) for the
+## weights in matrix (row standardized first if rowStandardize = True).
+## The z-score and p-value assume normality, as in ArcGIS's Spatial
+## Autocorrelation tool.  With permutations > 0, the pseudo p-value compares
+## I with the values of I after randomly permuting the values between features,
+## computed in batches as one sparse matrix product per batch (of batchSize
+## permutations, by default as many as fit in about 100 MB):
+## p = (1 + number of permutations at least as extreme) / (permutations + 1)
+## https://pro.arcgis.com/en/pro-app/tool-reference/spatial-statistics/h-how-spatial-autocorrelation-moran-s-i-spatial-st.htm
+def moransI(values, matrix, permutations = 999, seed = None, rowStandardize = True,
+            batchSize = None):
+    values = numpy.asarray(values, dtype = numpy.float64)
+    matrix = sparse.csr_matrix(matrix, dtype = numpy.float64)
+    n = len(values)
+    if rowStandardize == True:
+        rowSums = numpy.asarray(matrix.sum(axis = 1)).ravel()
+        matrix = sparse.diags(numpy.where(rowSums > 0, 1 / numpy.maximum(rowSums, 1e-300), 0)).dot(matrix).tocsr()
+
+    z = values - values.mean()
+    s0 = matrix.sum()
+    statistic = n / s0 * z.dot(matrix.dot(z)) / z.dot(z)
+
+    expected = -1 / (n - 1)
+    symmetric = matrix + matrix.T
+    s1 = symmetric.multiply(symmetric).sum() / 2
+    s2 = ((numpy.asarray(matrix.sum(axis = 1)).ravel() + numpy.asarray(matrix.sum(axis = 0)).ravel()) ** 2).sum()
+    variance = (n * n * s1 - n * s2 + 3 * s0 * s0) / ((n * n - 1) * s0 * s0) - expected * expected
+    zScore = (statistic - expected) / math.sqrt(variance)
+
+    results = OrderedDict([("I", statistic), ("Expected I", expected), ("Variance", variance),
+                           ("z-score", zScore), ("p-value", 2 * norm.sf(abs(zScore)))])
+
+    if permutations > 0:
+        randomState = numpy.random.RandomState(seed)
+        ## The random keys, their argsort, the permuted values, their lag and
+        ## product are five n x batchSize arrays of 8 byte values
+        batchSize = _permutationBatchSize(n, batchSize, 40)
+        permutedStatistics = []
+        done = 0
+        while done < permutations:
+            size = min(batchSize, permutations - done)
+            permuted = z[randomState.rand(size, n).argsort(axis = 1)].T
+            permutedStatistics.append(n / s0 * (permuted * matrix.dot(permuted)).sum(axis = 0) / z.dot(z))
+            done += size
+        permutedStatistics = numpy.concatenate(permutedStatistics)
+        larger = int((permutedStatistics >= statistic).sum())
+        results["Permutations"] = permutations
+        results["Pseudo p-value"] = (1 + min(larger, permutations - larger)) / (permutations + 1)
+
+    return results
+
+## Getis-Ord Gi* z-scores of values (an array in the order of matrix, without
+## NULLs), using the binary weights in matrix plus every feature itself.
+## Returns the z-scores and their two-sided p-values (normal approximation).
+## With permutations > 0, the p-values are instead pseudo p-values from
+## conditional permutations: every feature keeps its own value while its
+## neighbors are replaced with random other features.  As in PySAL, every
+## permutation draws one random set of features that is shared by all of the
+## features (skipping the feature itself), so each batch of permutations is a
+## few vectorized operations (batchSize permutations at once, by default as
+## many as fit in about 100 MB).
+## https://pro.arcgis.com/en/pro-app/tool-reference/spatial-statistics/h-how-hot-spot-analysis-getis-ord-gi-spatial-stati.htm
+def getisOrdGiStar(values, matrix, permutations = 0, seed = None, batchSize = None):
+    values = numpy.asarray(values, dtype = numpy.float64)
+    matrix = sparse.csr_matrix(matrix, dtype = numpy.float64)
+    n = len(values)
+
+    mean = values.mean()
+    standardDeviation = math.sqrt((values * values).mean() - mean * mean)
+    ## Binary weights including the feature itself
+    weightSums = numpy.diff(matrix.indptr) + 1.0
+    denominators = standardDeviation * numpy.sqrt((n * weightSums - weightSums * weightSums) / (n - 1))
+
+    localSums = matrix.dot(values) + values
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        zScores = (localSums - mean * weightSums) / denominators
+        pValues = 2 * norm.sf(numpy.abs(zScores))
+
+    if permutations > 0:
+        randomState = numpy.random.RandomState(seed)
+        neighborCounts = numpy.diff(matrix.indptr)
+        maxNeighbors = int(neighborCounts.max()) if n > 0 else 0
+        features = numpy.arange(n)
+        larger = numpy.zeros(n, dtype = numpy.int64)
+        ## The sums, the neighbor IDs, their values and the masked values are
+        ## four n x batchSize arrays of 8 byte values
+        batchSize = _permutationBatchSize(n, batchSize, 32)
+        done = 0
+        while done < permutations and maxNeighbors > 0:
+            size = min(batchSize, permutations - done)
+            ## size sets of maxNeighbors distinct positions among the n - 1 other features
+            randomIDs = numpy.array([randomState.permutation(n - 1)[:maxNeighbors] for i in range(size)])
+            permutedSums = numpy.zeros((n, size))
+            for j in range(maxNeighbors):
+                ## Skip over each feature itself
+                ids = randomIDs[:, j][None, :] + (randomIDs[:, j][None, :] >= features[:, None])
+                permutedSums += numpy.where((j < neighborCounts)[:, None], values[ids], 0)
+            permutedSums += values[:, None]
+            larger += (permutedSums >= localSums[:, None]).sum(axis = 1)
+            done += size
+        pValues = (1 + numpy.minimum(larger, permutations - larger)) / (permutations + 1)
+
+    return zScores, pValues
+
+## Prints (and optionally saves) Moran's I for each of fields, reusing the same
+## spatial weights (see buildSpatialWeights).  Features with a NULL value are
+## left out of the calculation for that field.  Returns an OrderedDict of the
+## results of moransI keyed by field.
+def moransIAnalysis(inputFC, fields, weights, permutations = 999, seed = None,
+                    rowStandardize = True, display = True, outputFile = None,
+                    chunkSize = 500000):
+    if type(fields) == str:
+        fields = [fields]
+
+    oids, values = readColumns(inputFC, fields, chunkSize)
+    positions = weights.positions(oids)
+
+    results = OrderedDict()
+    for field in fields:
+        valid = ~numpy.isnan(values[field])
+        matrix = weights.matrix[positions[valid]][:, positions[valid]]
+        results[field] = moransI(values[field][valid], matrix, permutations, seed, rowStandardize)
+
+    resultsTable = [[field] + list(fieldResults.values()) for field, fieldResults in results.items()]
+    columnHeaders = ["Field"] + list(results[fields[0]].keys())
+    outputResultsTable = ezTable(resultsTable, columnHeaders, title = "Moran's I", display = display,
+                                 returnFormat = "MATRIX")
+    if outputFile != None:
+        matrixToCSV(outputResultsTable, outputFile)
+
+    return results
+
+## Adds GIZ_ (Gi* z-score) and GIP_ (p-value) columns for each of fields,
+## reusing the same spatial weights (see buildSpatialWeights).  The columns are
+## read in one pass and written back in a single UpdateCursor pass (see
+## readColumns and writeColumns).  Features with a NULL value get NULLs and are
+## left out of the calculation for that field.
+def calcHotSpotColumns(inputFC, fields, weights, permutations = 0, seed = None,
+                       chunkSize = 500000):
+    if type(fields) == str:
+        fields = [fields]
+
+    oids, values = readColumns(inputFC, fields, chunkSize)
+    positions = weights.positions(oids)
+
+    outputColumns = []
+    for field in fields:
+        valid = ~numpy.isnan(values[field])
+        matrix = weights.matrix[positions[valid]][:, positions[valid]]
+        zScores = numpy.repeat(numpy.nan, len(oids))
+        pValues = numpy.repeat(numpy.nan, len(oids))
+        zScores[valid], pValues[valid] = getisOrdGiStar(values[field][valid], matrix, permutations, seed)
+        outputColumns += [["GIZ_%s" % field, "DOUBLE", zScores], ["GIP_%s" % field, "DOUBLE", pValues]]
+
+    return writeColumns(inputFC, oids, outputColumns)
+
+## Runs the benchmarks of this module, which use millions of values (about
+## 80 MB per array), so they are not run by default below
+def runBenchmarks():
+    benchmarkRunningStats()
+    benchmarkQuantileSketch()
+    benchmarkNaturalBreaks()
+
 if __name__ == "__main__":
+    ##runBenchmarks()
+
     ##inputFC = "C:\\NHGIS\\NHGIS2010.gdb\\Blockgroups"
 
     ##print calcPercentageColumns(inputFC, ["CM1AA", "CM1AB", "CM1AC", "CM1AD", "CM1AE", "CM1AF", "CM1AG"])